@@ -3,47 +3,53 @@
 # ============================================================
 # DATABASE CONFIGURATION NOTES:
 # 
-# CURRENT: SQLite (for local development)
+# DEVELOPMENT: SQLite (default)
 # PRODUCTION: SQL Server (for client deployment)
 #
-# To switch to SQL Server:
-# 1. Comment out: import sqlite3
-# 2. Uncomment: import pyodbc
-# 3. Comment out: DATABASE_PATH line
-# 4. Uncomment: SQLSERVER_CONFIG section
-# 5. Replace get_db_connection() function with SQL Server version
-#
-# See production/DEPLOYMENT_GUIDE.md for detailed instructions
+# The backend is chosen with DB_TYPE in production/config.py (or the DB_TYPE
+# environment variable) - no code changes are needed to switch. See the
+# DATABASE BACKENDS section below and production/DEPLOYMENT_GUIDE.md
 # ============================================================
 
 import os
+import atexit
+import base64
+import csv
+import io
+import json
 import logging
+import multiprocessing
+import queue
+import re
 import secrets
 import smtplib
+import threading
+import tempfile
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
 from datetime import datetime, timedelta
 from functools import wraps
-import bcrypt
-
-# ============================================================
-# DATABASE DRIVER IMPORT
-# ============================================================
-# DEVELOPMENT (SQLite) - Currently Active
 import sqlite3
+import bcrypt
 
-# PRODUCTION (SQL Server) - Uncomment for client deployment
-# import pyodbc
-# ============================================================
-
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, g, has_app_context
 from flask_jwt_extended import JWTManager, jwt_required, create_access_token, create_refresh_token, get_jwt_identity, get_jwt
 from flask_cors import CORS
 from flask_limiter import Limiter
 from flask_limiter.util import get_remote_address
+import numpy as np
 import pandas as pd
 from werkzeug.utils import secure_filename
 
+from production import config as app_config
+
 # Initialize Flask app
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'ves-hrms-secure-key-change-in-prod')
@@ -68,19 +74,9 @@ limiter = Limiter(
 # ============================================================
 # DATABASE CONFIGURATION
 # ============================================================
-# DEVELOPMENT (SQLite) - Currently Active
-DATABASE_TYPE = 'sqlite'
-DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'ves_hrms.db')
-
-# PRODUCTION (SQL Server) - Uncomment below and comment SQLite above
-# DATABASE_TYPE = 'sqlserver'
-# SQLSERVER_CONFIG = {
-#     'server': os.environ.get('DB_SERVER', 'localhost'),
-#     'database': os.environ.get('DB_NAME', 'VES_HRMS'),
-#     'username': os.environ.get('DB_USER', 'ves_hrms_app'),
-#     'password': os.environ.get('DB_PASSWORD', ''),
-#     'driver': 'ODBC Driver 17 for SQL Server'
-# }
+# DB_TYPE selects the backend: 'sqlite' (development) or 'sqlserver' (production)
+DATABASE_TYPE = app_config.DB_TYPE
+DATABASE_PATH = app_config.SQLITE_PATH
 # ============================================================
 
 # Create uploads directory
@@ -107,10 +103,127 @@ LOG_FORMAT = '%(asctime)s | %(levelname)-8s | User: %(user)s | IP: %(ip)s | %(en
 DATE_FORMAT = '%Y-%m-%d %H:%M:%S'
 
 # Create rotating file handlers
-from logging.handlers import RotatingFileHandler, TimedRotatingFileHandler
+from logging.handlers import QueueHandler, RotatingFileHandler, TimedRotatingFileHandler
+
+# Request threads never touch the log files. Each logger gets a QueueHandler
+# tagged with a route; one listener thread pulls records off the shared queue
+# in batches, hands them to that route's file/console handlers and flushes
+# each file once per batch. If the queue fills up (e.g. a slow rotation),
+# LOG_QUEUE_POLICY decides whether callers wait ('block', up to
+# LOG_QUEUE_BLOCK_TIMEOUT) or the record is dropped ('drop'); either way
+# lost records are counted in log_pipeline.stats().
+
+class BatchedFlushMixin:
+    """Stream handler that leaves flushing to the log listener (once per batch)"""
+    def flush(self):
+        pass
+
+    def flush_batch(self):
+        super().flush()
+
+class BatchedRotatingFileHandler(BatchedFlushMixin, RotatingFileHandler):
+    pass
+
+class BatchedTimedRotatingFileHandler(BatchedFlushMixin, TimedRotatingFileHandler):
+    pass
+
+class BatchedStreamHandler(BatchedFlushMixin, logging.StreamHandler):
+    pass
+
+class RoutedQueueHandler(QueueHandler):
+    """Queues records for the listener thread, tagged with the handlers they belong to"""
+
+    def __init__(self, pipeline, route):
+        super().__init__(pipeline.queue)
+        self.pipeline = pipeline
+        self.route = route
+
+    def prepare(self, record):
+        record = super().prepare(record)
+        record.log_route = self.route
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.enqueue(record)
+
+class LogPipeline:
+    """Single background thread that writes every log file and the console"""
+
+    def __init__(self, routes, queue_size, policy, block_timeout, batch_size):
+        if policy not in ('block', 'drop'):
+            raise ValueError(f"Unknown LOG_QUEUE_POLICY '{policy}' (expected 'block' or 'drop')")
+        self.routes = routes
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.policy = policy
+        self.block_timeout = block_timeout
+        self.batch_size = batch_size
+        self._lock = threading.Lock()
+        self._thread = None
+        self.counters = {'queued': 0, 'written': 0, 'batches': 0, 'dropped': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def handler(self, route):
+        return RoutedQueueHandler(self, route)
+
+    def enqueue(self, record):
+        try:
+            if self.policy == 'block':
+                self.queue.put(record, timeout=self.block_timeout)
+            else:
+                self.queue.put_nowait(record)
+            self._count('queued')
+        except queue.Full:
+            self._count('dropped')
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='log-listener', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stopping = batch[-1] is None
+            self._write([record for record in batch if record is not None])
+            if stopping:
+                return
+
+    def _write(self, records):
+        touched = set()
+        for record in records:
+            for handler in self.routes[record.log_route]:
+                if record.levelno >= handler.level:
+                    handler.handle(record)
+                    touched.add(handler)
+        for handler in touched:
+            try:
+                handler.flush_batch()
+            except Exception:
+                pass
+        self._count('written', len(records))
+        self._count('batches')
+
+    def stop(self, timeout=10):
+        """Write out everything still queued before the process exits"""
+        if self._thread is None or not self._thread.is_alive():
+            return
+        self.queue.put(None)  # sentinel - goes in behind the records already queued
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=self.queue.qsize(), policy=self.policy)
 
 # 1. Application Log - General app operations (10MB max, keep 10 backups)
-app_log_handler = RotatingFileHandler(
+app_log_handler = BatchedRotatingFileHandler(
     os.path.join(LOGS_DIR, 'app.log'),
     maxBytes=10*1024*1024,  # 10MB
     backupCount=10,
@@ -120,7 +233,7 @@ app_log_handler.setLevel(logging.INFO)
 app_log_handler.setFormatter(DetailedFormatter(LOG_FORMAT, DATE_FORMAT))
 
 # 2. Error Log - Only errors and critical issues
-error_log_handler = RotatingFileHandler(
+error_log_handler = BatchedRotatingFileHandler(
     os.path.join(LOGS_DIR, 'error.log'),
     maxBytes=10*1024*1024,
     backupCount=10,
@@ -130,7 +243,7 @@ error_log_handler.setLevel(logging.ERROR)
 error_log_handler.setFormatter(DetailedFormatter(LOG_FORMAT, DATE_FORMAT))
 
 # 3. Security/Audit Log - Login, logout, sensitive operations
-security_log_handler = RotatingFileHandler(
+security_log_handler = BatchedRotatingFileHandler(
     os.path.join(LOGS_DIR, 'security.log'),
     maxBytes=10*1024*1024,
     backupCount=20,  # Keep more security logs
@@ -143,7 +256,7 @@ security_log_handler.setFormatter(DetailedFormatter(
 ))
 
 # 4. Database Log - All DB operations
-db_log_handler = RotatingFileHandler(
+db_log_handler = BatchedRotatingFileHandler(
     os.path.join(LOGS_DIR, 'database.log'),
     maxBytes=10*1024*1024,
     backupCount=10,
@@ -156,7 +269,7 @@ db_log_handler.setFormatter(DetailedFormatter(
 ))
 
 # 5. API Access Log - All API requests
-access_log_handler = TimedRotatingFileHandler(
+access_log_handler = BatchedTimedRotatingFileHandler(
     os.path.join(LOGS_DIR, 'access.log'),
     when='midnight',
     interval=1,
@@ -170,32 +283,43 @@ access_log_handler.setFormatter(DetailedFormatter(
 ))
 
 # Console handler for development
-console_handler = logging.StreamHandler()
+console_handler = BatchedStreamHandler()
 console_handler.setLevel(logging.INFO)
 console_handler.setFormatter(logging.Formatter('%(asctime)s - %(levelname)s - %(message)s'))
 
+# One listener thread feeds all of the handlers above
+log_pipeline = LogPipeline(
+    routes={
+        'app': [app_log_handler, error_log_handler, console_handler],
+        'security': [security_log_handler, console_handler],
+        'database': [db_log_handler],
+        'access': [access_log_handler],
+    },
+    queue_size=app_config.LOG_QUEUE_SIZE,
+    policy=app_config.LOG_QUEUE_POLICY,
+    block_timeout=app_config.LOG_QUEUE_BLOCK_TIMEOUT,
+    batch_size=app_config.LOG_BATCH_SIZE
+)
+
 # Configure main logger
 logger = logging.getLogger('ves_hrms')
 logger.setLevel(logging.DEBUG)
-logger.addHandler(app_log_handler)
-logger.addHandler(error_log_handler)
-logger.addHandler(console_handler)
+logger.addHandler(log_pipeline.handler('app'))
 
 # Security logger
 security_logger = logging.getLogger('ves_hrms.security')
 security_logger.setLevel(logging.INFO)
-security_logger.addHandler(security_log_handler)
-security_logger.addHandler(console_handler)
+security_logger.addHandler(log_pipeline.handler('security'))
 
 # Database logger
 db_logger = logging.getLogger('ves_hrms.database')
 db_logger.setLevel(logging.DEBUG)
-db_logger.addHandler(db_log_handler)
+db_logger.addHandler(log_pipeline.handler('database'))
 
 # Access logger
 access_logger = logging.getLogger('ves_hrms.access')
 access_logger.setLevel(logging.INFO)
-access_logger.addHandler(access_log_handler)
+access_logger.addHandler(log_pipeline.handler('access'))
 
 # Helper function to get client IP
 def get_client_ip():
@@ -215,24 +339,28 @@ def get_user_agent():
 @app.before_request
 def log_request_start():
     """Log incoming request"""
-    request.start_time = datetime.now()
+    g.request_started = time.perf_counter()
+
+def get_request_identity():
+    """
+    Username the route's @jwt_required already verified, or '-' for
+    public routes and rejected tokens. Never decodes the token again.
+    """
+    try:
+        return get_jwt_identity() or '-'
+    except RuntimeError:
+        return '-'
 
 @app.after_request
 def log_request_end(response):
     """Log request completion with duration"""
     try:
         duration = 0
-        if hasattr(request, 'start_time'):
-            duration = int((datetime.now() - request.start_time).total_seconds() * 1000)
+        if 'request_started' in g:
+            duration = round((time.perf_counter() - g.request_started) * 1000, 1)
         
-        # Get current user if authenticated
-        current_user = '-'
-        try:
-            from flask_jwt_extended import get_jwt_identity, verify_jwt_in_request
-            verify_jwt_in_request(optional=True)
-            current_user = get_jwt_identity() or '-'
-        except:
-            pass
+        # Identity captured when the route's jwt_required ran
+        current_user = get_request_identity()
         
         # Log to access log
         access_logger.info('', extra={
@@ -289,97 +417,1537 @@ def log_db(operation, table=None, details=None):
 logger.info("=== VES HRMS Server Starting ===", extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
 logger.info(f"Logs directory: {LOGS_DIR}", extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
 
-# JWT blacklist (in production, use Redis)
-blacklisted_tokens = set()
-
-@jwt.token_in_blocklist_loader
-def check_if_token_revoked(jwt_header, jwt_payload):
-    return jwt_payload['jti'] in blacklisted_tokens
-
 # ============================================================
-# DATABASE CONNECTION FUNCTION
+# DATABASE BACKENDS
 # ============================================================
-# This function handles both SQLite (dev) and SQL Server (production)
-# 
-# FOR PRODUCTION: Replace this entire function with the SQL Server version below
+# The backend is picked once at startup from production/config.DB_TYPE:
+#   'sqlite'    - development, single file next to app.py
+#   'sqlserver' - client deployment (pyodbc, imported only when selected)
+# Each backend owns its connection pool, the dialect-specific SQL fragments
+# the routes need (db_backend.now, db_backend.upsert(...), ...) and a row
+# adapter so rows support row['column'], row[0] and dict(row) everywhere.
+#
+# Connections are created once and shared across the process through a
+# bounded pool. Inside a request, get_db_connection() always hands back the
+# same connection (kept on flask.g) so role_required, audit_log and the route
+# itself don't each open their own; it goes back to the pool on teardown.
 # ============================================================
 
-def get_db_connection():
+class PoolTimeout(Exception):
+    """Raised when no pooled connection frees up within the pool timeout"""
+    pass
+
+class ConnectionPool:
+    """Bounded, thread-safe pool of DB-API connections shared by the whole process"""
+
+    def __init__(self, connect, max_size, timeout, health_check_interval, name='database'):
+        self._connect = connect
+        self._timeout = timeout
+        self._health_check_interval = health_check_interval
+        self._idle = deque()  # (connection, last_released) - LIFO keeps warm connections hot
+        self._slots = threading.BoundedSemaphore(max_size)
+        self._lock = threading.Lock()
+        self.name = name
+        self.max_size = max_size
+        self.counters = {'created': 0, 'reused': 0, 'discarded': 0, 'timeouts': 0, 'in_use': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def _is_healthy(self, connection):
+        """Cheap liveness probe for connections that sat idle for a while"""
+        try:
+            cursor = connection.cursor()
+            cursor.execute("SELECT 1")
+            cursor.fetchone()
+            cursor.close()
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, connection):
+        self._count('discarded')
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Check a connection out of the pool, opening a new one if none are idle"""
+        if not self._slots.acquire(timeout=self._timeout):
+            self._count('timeouts')
+            raise PoolTimeout(f"No {self.name} connection available after {self._timeout}s")
+        try:
+            while True:
+                with self._lock:
+                    item = self._idle.pop() if self._idle else None
+                if item is None:
+                    connection = self._connect()
+                    self._count('created')
+                    break
+                connection, last_released = item
+                if (time.monotonic() - last_released) < self._health_check_interval or self._is_healthy(connection):
+                    self._count('reused')
+                    break
+                log_db('DISCARD', 'database', 'Stale pooled connection failed health check')
+                self._discard(connection)
+        except Exception:
+            self._slots.release()
+            raise
+        self._count('in_use')
+        return connection
+
+    def release(self, connection, discard=False):
+        """Return a connection to the pool, rolling back anything left uncommitted"""
+        try:
+            if not discard:
+                try:
+                    connection.rollback()
+                except Exception:
+                    discard = True
+            if discard:
+                self._discard(connection)
+            else:
+                with self._lock:
+                    self._idle.append((connection, time.monotonic()))
+        finally:
+            self._count('in_use', -1)
+            self._slots.release()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, idle=len(self._idle), max_size=self.max_size)
+
+
+class PooledConnection:
     """
-    Get database connection
-    
-    DEVELOPMENT (SQLite) - Currently Active
-    Returns SQLite connection with row_factory for dict-like access
+    Handle around a pooled connection. close() gives the connection back to
+    the pool instead of closing it. Request-scoped handles are shared by every
+    get_db_connection() call in the request and only roll back uncommitted work
+    once the last holder closes; the pool gets it back in teardown_appcontext.
     """
-    try:
-        connection = sqlite3.connect(DATABASE_PATH)
+
+    def __init__(self, pool, connection, request_scoped=False):
+        self._pool = pool
+        self._connection = connection
+        self._request_scoped = request_scoped
+        self._holders = 0
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def close(self):
+        if self._connection is None:
+            return
+        if not self._request_scoped:
+            self.release()
+            return
+        self._holders = max(0, self._holders - 1)
+        if self._holders == 0:
+            try:
+                self._connection.rollback()
+            except Exception:
+                pass
+
+    def release(self, discard=False):
+        connection, self._connection = self._connection, None
+        if connection is not None:
+            self._pool.release(connection, discard=discard)
+
+
+class DatabaseBackend(ABC):
+    """
+    Base class for a database backend - connection factory, pool and SQL dialect
+
+    Routes only ever see get_db_connection() and the fragments below, never
+    the driver module itself.
+    """
+    name = 'database'
+    driver_errors = ()     # exception classes get_db_connection() turns into None
+    now = None             # SQL expression for the current timestamp
+
+    def __init__(self, pool_size, pool_timeout):
+        self.pool = ConnectionPool(
+            self.connect,
+            max_size=pool_size,
+            timeout=pool_timeout,
+            health_check_interval=app_config.DB_POOL_HEALTH_CHECK_INTERVAL,
+            name=self.name
+        )
+
+    @abstractmethod
+    def connect(self):
+        raise NotImplementedError
+
+    def self_check(self):
+        """Startup check - log what the backend is actually running with"""
+        return {}
+
+    # ---------- dialect fragments ----------
+    @abstractmethod
+    def days_ago(self, placeholder='?'):
+        """SQL date expression for 'today minus <placeholder> days'"""
+        raise NotImplementedError
+
+    @abstractmethod
+    def limit(self, count):
+        """Clause appended after ORDER BY to return at most `count` rows"""
+        raise NotImplementedError
+
+    def explain(self, cursor, query, params=()):
+        """Plan steps for a query as text lines, or None if the backend can't show them"""
+        return None
+
+    @abstractmethod
+    def upsert(self, table, columns, key_columns, expressions=None):
+        """
+        INSERT that updates the existing row when `key_columns` already match
+
+        `columns` are bound with ? placeholders in order; `expressions` maps
+        extra columns to raw SQL (e.g. {'processed_at': db_backend.now}).
+        """
+        raise NotImplementedError
+
+    @abstractmethod
+    def insert_ignore(self, table, columns, key_columns):
+        """INSERT that silently does nothing when `key_columns` already match"""
+        raise NotImplementedError
+
+
+class SQLiteBackend(DatabaseBackend):
+    """Development backend - a single SQLite file tuned by a pragma profile"""
+    name = 'SQLite'
+    driver_errors = (sqlite3.Error,)
+    now = "datetime('now')"
+
+    def __init__(self):
+        if app_config.SQLITE_PRAGMA_PROFILE not in app_config.SQLITE_PRAGMA_PROFILES:
+            raise ValueError(f"Unknown SQLITE_PRAGMA_PROFILE '{app_config.SQLITE_PRAGMA_PROFILE}'")
+        self.pragmas = app_config.SQLITE_PRAGMA_PROFILES[app_config.SQLITE_PRAGMA_PROFILE]
+        super().__init__(app_config.SQLITE_POOL_SIZE, app_config.SQLITE_POOL_TIMEOUT)
+
+    def connect(self):
+        """Open a new SQLite connection for the pool, rows come back as sqlite3.Row"""
+        # Pooled connections move between request threads, one thread at a time
+        connection = sqlite3.connect(DATABASE_PATH, check_same_thread=False)
         connection.row_factory = sqlite3.Row  # Enable dict-like access
-        log_db('CONNECT', 'database', 'SQLite connection established')
+        for pragma, value in self.pragmas.items():
+            connection.execute(f"PRAGMA {pragma} = {value}")
+        log_db('CONNECT', 'database', f"SQLite connection established (profile={app_config.SQLITE_PRAGMA_PROFILE})")
         return connection
-    except sqlite3.Error as err:
+
+    def self_check(self):
+        """Report the pragmas actually in effect and flag any the database refused"""
+        readable = {
+            'synchronous': {0: 'OFF', 1: 'NORMAL', 2: 'FULL', 3: 'EXTRA'},
+            'temp_store': {0: 'DEFAULT', 1: 'FILE', 2: 'MEMORY'},
+        }
+        conn = get_db_connection()
+        if not conn:
+            return {}
+        try:
+            active = {}
+            for pragma, wanted in self.pragmas.items():
+                value = conn.execute(f"PRAGMA {pragma}").fetchone()[0]
+                value = readable.get(pragma, {}).get(value, value)
+                active[pragma] = value
+                if str(value).upper() != str(wanted).upper():
+                    logger.warning(f"SQLite pragma {pragma}={value} (profile asked for {wanted})",
+                                   extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
+        finally:
+            conn.close()
+        summary = ', '.join(f"{k}={v}" for k, v in active.items()) or 'SQLite defaults'
+        logger.info(f"SQLite profile '{app_config.SQLITE_PRAGMA_PROFILE}': {summary}",
+                    extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
+        return active
+
+    def days_ago(self, placeholder='?'):
+        return f"date('now', '-' || {placeholder} || ' days')"
+
+    def limit(self, count):
+        return f"LIMIT {int(count)}"
+
+    def explain(self, cursor, query, params=()):
+        cursor.execute(f"EXPLAIN QUERY PLAN {query}", params)
+        return [row['detail'] for row in cursor.fetchall()]
+
+    def upsert(self, table, columns, key_columns, expressions=None):
+        expressions = expressions or {}
+        all_columns = list(columns) + list(expressions)
+        values = ['?'] * len(columns) + list(expressions.values())
+        updates = ', '.join(f"{c} = excluded.{c}" for c in all_columns if c not in key_columns)
+        return (f"INSERT INTO {table} ({', '.join(all_columns)}) VALUES ({', '.join(values)}) "
+                f"ON CONFLICT ({', '.join(key_columns)}) DO UPDATE SET {updates}")
+
+    def insert_ignore(self, table, columns, key_columns):
+        return (f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))}) "
+                f"ON CONFLICT ({', '.join(key_columns)}) DO NOTHING")
+
+
+class Row(tuple):
+    """
+    Lightweight result row for pyodbc - a plain tuple plus a column-name index
+    shared by every row of the same result set, so nothing is copied per row.
+    Supports row['column'], row[0], row.keys() and dict(row) like sqlite3.Row.
+    """
+    __slots__ = ()
+    _columns = ()
+    _index = {}
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            return tuple.__getitem__(self, self._index[key])
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return self._columns
+
+
+_row_classes = {}
+
+def _row_class(description):
+    """Row subclass for a cursor.description, built once per distinct column list"""
+    columns = tuple(column[0] for column in description)
+    row_class = _row_classes.get(columns)
+    if row_class is None:
+        row_class = type('Row', (Row,), {
+            '__slots__': (),
+            '_columns': columns,
+            '_index': {name: idx for idx, name in enumerate(columns)},
+        })
+        _row_classes[columns] = row_class
+    return row_class
+
+
+class SQLServerCursor:
+    """pyodbc cursor that returns Row objects and exposes lastrowid like sqlite3"""
+
+    def __init__(self, cursor):
+        self._cursor = cursor
+        self._row_class = None
+        self._lastrowid = None
+        self._lastrowid_pending = False
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+    def __iter__(self):
+        return iter(self.fetchall())
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(sql, params) if params else self._cursor.execute(sql)
+        self._row_class = _row_class(self._cursor.description) if self._cursor.description else None
+        self._lastrowid_pending = sql.lstrip()[:6].upper() == 'INSERT'
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        self._cursor.executemany(sql, list(seq_of_params))
+        self._row_class = None
+        return self
+
+    @property
+    def lastrowid(self):
+        # Only looked up when a caller asks for it; @@IDENTITY is per-session
+        if self._lastrowid_pending:
+            self._cursor.execute("SELECT CAST(@@IDENTITY AS INT)")
+            value = self._cursor.fetchone()
+            self._lastrowid = value[0] if value else None
+            self._lastrowid_pending = False
+        return self._lastrowid
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        return self._row_class(row) if row is not None else None
+
+    def fetchmany(self, size=None):
+        rows = self._cursor.fetchmany(size) if size else self._cursor.fetchmany()
+        return [self._row_class(row) for row in rows]
+
+    def fetchall(self):
+        row_class = self._row_class
+        return [row_class(row) for row in self._cursor.fetchall()]
+
+
+class SQLServerConnection:
+    """pyodbc connection with the sqlite3-style conveniences the routes use"""
+
+    def __init__(self, connection):
+        self._connection = connection
+
+    def __getattr__(self, name):
+        return getattr(self._connection, name)
+
+    def cursor(self):
+        return SQLServerCursor(self._connection.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+
+class SQLServerBackend(DatabaseBackend):
+    """Production backend - SQL Server through pyodbc"""
+    name = 'SQL Server'
+    now = "GETDATE()"
+
+    def __init__(self):
+        import pyodbc  # Only needed on servers that actually run SQL Server
+        self.pyodbc = pyodbc
+        self.driver_errors = (pyodbc.Error,)
+        self.config = app_config.SQLSERVER_CONFIG
+        super().__init__(self.config['pool_size'], self.config['pool_timeout'])
+
+    def connect(self):
+        """Open a new SQL Server connection for the pool"""
+        conn_str = (
+            f"DRIVER={{{self.config['driver']}}};"
+            f"SERVER={self.config['server']};"
+            f"DATABASE={self.config['database']};"
+            f"UID={self.config['username']};"
+            f"PWD={self.config['password']};"
+            "TrustServerCertificate=yes;"
+        )
+        connection = self.pyodbc.connect(conn_str)
+        log_db('CONNECT', 'database', 'SQL Server connection established')
+        return SQLServerConnection(connection)
+
+    def self_check(self):
+        conn = get_db_connection()
+        if not conn:
+            return {}
+        try:
+            version = conn.execute("SELECT @@VERSION AS version").fetchone()['version']
+        finally:
+            conn.close()
+        logger.info(f"SQL Server {self.config['server']}/{self.config['database']}: {version.splitlines()[0]}",
+                    extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
+        return {'version': version}
+
+    def days_ago(self, placeholder='?'):
+        return f"CAST(DATEADD(day, -{placeholder}, GETDATE()) AS DATE)"
+
+    def limit(self, count):
+        return f"OFFSET 0 ROWS FETCH NEXT {int(count)} ROWS ONLY"
+
+    def _merge(self, table, columns, key_columns, expressions, update):
+        expressions = expressions or {}
+        all_columns = list(columns) + list(expressions)
+        values = ['?'] * len(columns) + list(expressions.values())
+        source = ', '.join(f"{v} AS {c}" for c, v in zip(all_columns, values))
+        match = ' AND '.join(f"target.{c} = source.{c}" for c in key_columns)
+        sql = (f"MERGE INTO {table} WITH (HOLDLOCK) AS target "
+               f"USING (SELECT {source}) AS source ON {match} ")
+        if update:
+            updates = ', '.join(f"{c} = source.{c}" for c in all_columns if c not in key_columns)
+            sql += f"WHEN MATCHED THEN UPDATE SET {updates} "
+        sql += (f"WHEN NOT MATCHED THEN INSERT ({', '.join(all_columns)}) "
+                f"VALUES ({', '.join(f'source.{c}' for c in all_columns)});")
+        return sql
+
+    def upsert(self, table, columns, key_columns, expressions=None):
+        return self._merge(table, columns, key_columns, expressions, update=True)
+
+    def insert_ignore(self, table, columns, key_columns):
+        return self._merge(table, columns, key_columns, None, update=False)
+
+
+DB_BACKENDS = {
+    'sqlite': SQLiteBackend,
+    'sqlserver': SQLServerBackend,
+}
+
+if DATABASE_TYPE not in DB_BACKENDS:
+    raise ValueError(f"Unknown DB_TYPE '{DATABASE_TYPE}' (expected one of: {', '.join(DB_BACKENDS)})")
+db_backend = DB_BACKENDS[DATABASE_TYPE]()
+db_pool = db_backend.pool
+
+def get_db_connection(request_scoped=True):
+    """
+    Get database connection from the active backend's pool
+
+    Inside a request/app context the same connection is returned for every
+    call and released in teardown_appcontext; outside one (startup, scripts,
+    background threads) the caller owns it until conn.close(). Pass
+    request_scoped=False for a connection that has to outlive the request,
+    e.g. one a streamed response reads from.
+    """
+    try:
+        if request_scoped and has_app_context():
+            conn = g.get('_db_conn')
+            if conn is None:
+                conn = PooledConnection(db_pool, db_pool.acquire(), request_scoped=True)
+                g._db_conn = conn
+            conn._holders += 1
+            return conn
+        return PooledConnection(db_pool, db_pool.acquire())
+    except (PoolTimeout,) + db_backend.driver_errors as err:
         logger.error(f"Database connection error: {err}", extra={'user': '-', 'ip': '-', 'endpoint': 'db_connect'})
         return None
 
-# ============================================================
-# PRODUCTION SQL SERVER VERSION - Uncomment below and comment SQLite above
-# ============================================================
-# def get_db_connection():
-#     """
-#     Get SQL Server database connection
-#     
-#     PRODUCTION (SQL Server) - For client deployment with SSMS
-#     Returns pyodbc connection
-#     """
-#     try:
-#         conn_str = (
-#             f"DRIVER={{{SQLSERVER_CONFIG['driver']}}};"
-#             f"SERVER={SQLSERVER_CONFIG['server']};"
-#             f"DATABASE={SQLSERVER_CONFIG['database']};"
-#             f"UID={SQLSERVER_CONFIG['username']};"
-#             f"PWD={SQLSERVER_CONFIG['password']};"
-#             "TrustServerCertificate=yes;"
-#         )
-#         connection = pyodbc.connect(conn_str)
-#         log_db('CONNECT', 'database', 'SQL Server connection established')
-#         return connection
-#     except pyodbc.Error as err:
-#         logger.error(f"Database connection error: {err}", extra={'user': '-', 'ip': '-', 'endpoint': 'db_connect'})
-#         return None
-#
-# # Helper class to make SQL Server results dict-like (similar to sqlite3.Row)
-# class DictRow:
-#     """Makes pyodbc row accessible like a dictionary"""
-#     def __init__(self, cursor, row):
-#         self._data = {}
-#         for idx, column in enumerate(cursor.description):
-#             self._data[column[0]] = row[idx]
-#     
-#     def __getitem__(self, key):
-#         return self._data[key]
-#     
-#     def keys(self):
-#         return self._data.keys()
-#     
-#     def values(self):
-#         return self._data.values()
-#     
-#     def items(self):
-#         return self._data.items()
-# ============================================================
+@app.teardown_appcontext
+def release_db_connection(exception=None):
+    """Hand the request's pooled connection back once the request is done"""
+    conn = g.pop('_db_conn', None)
+    if conn is not None:
+        conn.release()
+
+db_backend.self_check()
+
+# ============== ATTENDANCE ROLLUPS ==============
+# attendance_rollup_monthly (employee, month) and attendance_rollup_daily
+# (department, date) hold the status/late/early/hours counts the dashboards,
+# reports and payroll used to re-aggregate from attendance on every call.
+# Every attendance write calls refresh_attendance_rollups() for the rows it
+# touched, in the same transaction; that re-aggregates only those employee-
+# months and department-dates. Moving an employee to another department or
+# deleting them refreshes the daily rows of every date they have attendance
+# on. rebuild_attendance_rollups() recomputes them from
+# scratch - run it (repair_attendance_rollups.py) after writing attendance
+# outside the app, e.g. with seed.py.
+
+ATTENDANCE_ROLLUP_COLUMNS = ['recorded_days', 'present_days', 'absent_days', 'half_days', 'leave_days', 'ot_days',
+                             'late_days', 'early_days', 'total_hours', 'present_hours', 'hours_days']
+
+# What makes an attendance row (alias a) count as a late / early-leave day
+ATTENDANCE_LATE_SQL = "a.is_late = 1"
+ATTENDANCE_EARLY_SQL = "a.is_early_leave = 1"
+
+ATTENDANCE_ROLLUP_AGGREGATES = f"""
+    COUNT(*),
+    SUM(CASE WHEN a.status = 'Present' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN a.status = 'Absent' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN a.status = 'Half-Day' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN a.status = 'Leave' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN a.status = 'OT' THEN 1 ELSE 0 END),
+    SUM(CASE WHEN {ATTENDANCE_LATE_SQL} THEN 1 ELSE 0 END),
+    SUM(CASE WHEN {ATTENDANCE_EARLY_SQL} THEN 1 ELSE 0 END),
+    ROUND(COALESCE(SUM(a.hours_worked), 0), 2),
+    ROUND(COALESCE(SUM(CASE WHEN a.status = 'Present' THEN a.hours_worked END), 0), 2),
+    COUNT(a.hours_worked)
+"""
+
+ATTENDANCE_ROLLUP_MONTHLY_INSERT = f"""
+    INSERT INTO attendance_rollup_monthly (employee_id, month, {', '.join(ATTENDANCE_ROLLUP_COLUMNS)}, updated_at)
+    SELECT a.employee_id, {{month}}, {ATTENDANCE_ROLLUP_AGGREGATES}, {db_backend.now}
+    FROM attendance a
+"""
+
+ATTENDANCE_ROLLUP_DAILY_INSERT = f"""
+    INSERT INTO attendance_rollup_daily (department, date, {', '.join(ATTENDANCE_ROLLUP_COLUMNS)}, updated_at)
+    SELECT COALESCE(u.department, ''), a.date, {ATTENDANCE_ROLLUP_AGGREGATES}, {db_backend.now}
+    FROM attendance a JOIN users u ON u.employee_id = a.employee_id
+"""
+
+# One employee-month / one department-date, refreshed after a write
+ATTENDANCE_ROLLUP_MONTH_REFRESH_SQL = [
+    "DELETE FROM attendance_rollup_monthly WHERE employee_id = ? AND month = ?",
+    ATTENDANCE_ROLLUP_MONTHLY_INSERT.format(month='?') +
+    "WHERE a.employee_id = ? AND a.date >= ? AND a.date < ? GROUP BY a.employee_id",
+]
+ATTENDANCE_ROLLUP_DAY_REFRESH_SQL = [
+    "DELETE FROM attendance_rollup_daily WHERE department = ? AND date = ?",
+    ATTENDANCE_ROLLUP_DAILY_INSERT +
+    "WHERE COALESCE(u.department, '') = ? AND a.date = ? GROUP BY COALESCE(u.department, ''), a.date",
+]
+
+# Everything, in one pass per table
+ATTENDANCE_ROLLUP_REBUILD_SQL = {
+    'sqlite': [
+        "DELETE FROM attendance_rollup_monthly",
+        ATTENDANCE_ROLLUP_MONTHLY_INSERT.format(month='substr(a.date, 1, 7)') +
+        "GROUP BY a.employee_id, substr(a.date, 1, 7)",
+        "DELETE FROM attendance_rollup_daily",
+        ATTENDANCE_ROLLUP_DAILY_INSERT + "GROUP BY COALESCE(u.department, ''), a.date",
+    ],
+    'sqlserver': [
+        "DELETE FROM attendance_rollup_monthly",
+        ATTENDANCE_ROLLUP_MONTHLY_INSERT.format(month='CONVERT(CHAR(7), a.date, 120)') +
+        "GROUP BY a.employee_id, CONVERT(CHAR(7), a.date, 120)",
+        "DELETE FROM attendance_rollup_daily",
+        ATTENDANCE_ROLLUP_DAILY_INSERT + "GROUP BY COALESCE(u.department, ''), a.date",
+    ],
+}
 
-def get_system_setting(key, default=None):
-    """Get a system setting from the database"""
+def refresh_attendance_rollups(cursor, keys, departments=()):
+    """
+    Re-aggregate the rollup rows covering these (employee_id, date)
+    attendance rows. Daily rows are redone for each employee's current
+    department; `departments` adds more for the same dates - the one an
+    employee just moved out of, or was deleted from.
+    """
+    keys = {(employee_id, str(date)[:10]) for employee_id, date in keys}
+    months = {(employee_id, date[:7]) for employee_id, date in keys}
+    delete_month, insert_month = ATTENDANCE_ROLLUP_MONTH_REFRESH_SQL
+    cursor.executemany(delete_month, list(months))
+    cursor.executemany(insert_month, [
+        (month, employee_id, *month_bounds(*month.split('-'))) for employee_id, month in months])
+    
+    employee_ids = sorted({employee_id for employee_id, _ in keys})
+    department_of = {}
+    for i in range(0, len(employee_ids), 500):
+        chunk = employee_ids[i:i + 500]
+        cursor.execute(
+            f"SELECT employee_id, COALESCE(department, '') AS department FROM users "
+            f"WHERE employee_id IN ({', '.join('?' * len(chunk))})", chunk)
+        department_of.update((row['employee_id'], row['department']) for row in cursor.fetchall())
+    days = {(department_of[employee_id], date) for employee_id, date in keys if employee_id in department_of}
+    days.update((department or '', date) for department in departments for _, date in keys)
+    delete_day, insert_day = ATTENDANCE_ROLLUP_DAY_REFRESH_SQL
+    cursor.executemany(delete_day, sorted(days))
+    cursor.executemany(insert_day, sorted(days))
+
+def attendance_range_source(date_from, date_to):
+    """
+    Subquery (and params) with per-employee attendance counts for the
+    inclusive range date_from..date_to: whole months are read from
+    attendance_rollup_monthly and only the partial months at either end
+    from attendance. Raises ValueError for dates that aren't YYYY-MM-DD.
+    """
+    start = datetime.strptime(date_from, '%Y-%m-%d')
+    end = datetime.strptime(date_to, '%Y-%m-%d') + timedelta(days=1)
+    first_month = start if start.day == 1 else (start.replace(day=1) + timedelta(days=32)).replace(day=1)
+    last_month = end.replace(day=1)
+    if first_month >= last_month:
+        first_month = last_month = end  # no whole month - all of it from attendance
+    day = lambda d: d.strftime('%Y-%m-%d')
+    return f"""
+        SELECT employee_id, recorded_days, present_days, absent_days, late_days, early_days, total_hours, hours_days
+        FROM attendance_rollup_monthly
+        WHERE month >= ? AND month < ?
+        UNION ALL
+        SELECT a.employee_id, 1,
+               CASE WHEN a.status = 'Present' THEN 1 ELSE 0 END,
+               CASE WHEN a.status = 'Absent' THEN 1 ELSE 0 END,
+               CASE WHEN {ATTENDANCE_LATE_SQL} THEN 1 ELSE 0 END,
+               CASE WHEN {ATTENDANCE_EARLY_SQL} THEN 1 ELSE 0 END,
+               a.hours_worked,
+               CASE WHEN a.hours_worked IS NULL THEN 0 ELSE 1 END
+        FROM attendance a
+        WHERE (a.date >= ? AND a.date < ?) OR (a.date >= ? AND a.date < ?)
+    """, [first_month.strftime('%Y-%m'), last_month.strftime('%Y-%m'),
+          day(start), day(first_month), day(last_month), day(end)]
+
+def rebuild_attendance_rollups(cursor):
+    """Recompute both rollup tables from attendance; returns the row counts"""
+    for statement in ATTENDANCE_ROLLUP_REBUILD_SQL[DATABASE_TYPE]:
+        cursor.execute(statement)
+    counts = {}
+    for table in ('attendance_rollup_monthly', 'attendance_rollup_daily'):
+        cursor.execute(f"SELECT COUNT(*) AS n FROM {table}")
+        counts[table] = cursor.fetchone()['n']
+    return counts
+
+# ============== ATTENDANCE FLAGS ==============
+# Late arrival and early leave are stored on the attendance row when it is
+# written (is_late/late_by_minutes, is_early_leave/early_by_minutes). Rows
+# from before those columns only say so in their notes - "Late by 12 minutes
+# | Early leave by 40 minutes" - which the attendance_flags schema update
+# parses once.
+
+LATE_NOTE_PATTERN = r'\bLate by (\d+) minutes'
+EARLY_NOTE_PATTERN = r'\bEarly leave by (\d+) minutes'
+
+ATTENDANCE_FLAGS_UPDATE_SQL = """
+    UPDATE attendance SET is_late = ?, late_by_minutes = ?, is_early_leave = ?, early_by_minutes = ?
+    WHERE id = ?
+"""
+
+def backfill_attendance_flags(cursor, batch_size=5000):
+    """Schema update step setting the late/early flags of unflagged rows from their notes"""
+    cursor.execute("""
+        SELECT id, notes FROM attendance
+        WHERE is_late = 0 AND is_early_leave = 0 AND (notes LIKE '%Late%' OR notes LIKE '%Early leave%')
+    """)
+    rows = pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()], columns=['id', 'notes'])
+    notes = rows['notes'].astype(str)
+    late_by = notes.str.extract(LATE_NOTE_PATTERN, expand=False).fillna(0).astype(int)
+    early_by = notes.str.extract(EARLY_NOTE_PATTERN, expand=False).fillna(0).astype(int)
+    # A note that just says "Late" still counted as a late day before
+    is_late = notes.str.contains(r'\bLate\b') | (late_by > 0)
+    is_early = notes.str.contains('Early leave', regex=False)
+    flagged = is_late | is_early
+    updates = list(zip(is_late[flagged].astype(int).tolist(), late_by[flagged].tolist(),
+                       is_early[flagged].astype(int).tolist(), early_by[flagged].tolist(),
+                       rows.loc[flagged, 'id'].tolist()))
+    for i in range(0, len(updates), batch_size):
+        cursor.executemany(ATTENDANCE_FLAGS_UPDATE_SQL, updates[i:i + batch_size])
+
+# ============== SCHEMA UPDATES ==============
+# Tables and columns added after init_sqlite.sql / init_sqlserver.sql were
+# first run. Each update is applied once per database at startup and recorded
+# in schema_migrations, so existing installs don't need the init scripts
+# re-run. Fresh databases get the same objects from the init scripts.
+
+SCHEMA_MIGRATIONS_DDL = {
+    'sqlite': """CREATE TABLE IF NOT EXISTS schema_migrations (
+                     name TEXT PRIMARY KEY,
+                     applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+                 )""",
+    'sqlserver': """IF OBJECT_ID('schema_migrations', 'U') IS NULL
+                    CREATE TABLE schema_migrations (
+                        name NVARCHAR(100) PRIMARY KEY,
+                        applied_at DATETIME DEFAULT GETDATE()
+                    )""",
+}
+
+def sqlite_add_column(table, column, definition):
+    """Schema update step adding a column unless the table already has it (SQLite has no ADD COLUMN IF NOT EXISTS)"""
+    def step(cursor):
+        cursor.execute(f"PRAGMA table_info({table})")
+        if column not in {row['name'] for row in cursor.fetchall()}:
+            cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return step
+
+# Statements are SQL strings, or callables taking the cursor for steps that
+# need to look at the current schema first
+SCHEMA_UPDATES = [
+    ('revoked_tokens', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS revoked_tokens (
+                   token_key TEXT PRIMARY KEY,
+                   expires_at REAL NOT NULL,
+                   revoked_at REAL NOT NULL
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at)",
+            "CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires_at ON revoked_tokens(expires_at)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('revoked_tokens', 'U') IS NULL
+               CREATE TABLE revoked_tokens (
+                   token_key NVARCHAR(64) PRIMARY KEY,
+                   expires_at FLOAT NOT NULL,
+                   revoked_at FLOAT NOT NULL
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_revoked_tokens_revoked_at')
+               CREATE INDEX idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at)""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_revoked_tokens_expires_at')
+               CREATE INDEX idx_revoked_tokens_expires_at ON revoked_tokens(expires_at)""",
+        ],
+    }),
+    ('settings_version', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS settings_version (
+                   id INTEGER PRIMARY KEY CHECK (id = 1),
+                   version INTEGER NOT NULL DEFAULT 0
+               )""",
+            "INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('settings_version', 'U') IS NULL
+               CREATE TABLE settings_version (
+                   id INT PRIMARY KEY CHECK (id = 1),
+                   version INT NOT NULL DEFAULT 0
+               )""",
+            "IF NOT EXISTS (SELECT 1 FROM settings_version) INSERT INTO settings_version (id, version) VALUES (1, 0)",
+        ],
+    }),
+    ('email_outbox', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS email_outbox (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   to_email TEXT NOT NULL,
+                   subject TEXT NOT NULL,
+                   html_body TEXT NOT NULL,
+                   purpose TEXT DEFAULT 'general',
+                   status TEXT NOT NULL DEFAULT 'Pending' CHECK (status IN ('Pending', 'Sending', 'Sent', 'Failed', 'Skipped')),
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   next_attempt_at REAL NOT NULL,
+                   claimed_at REAL,
+                   last_error TEXT,
+                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                   sent_at DATETIME
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('email_outbox', 'U') IS NULL
+               CREATE TABLE email_outbox (
+                   id INT IDENTITY(1,1) PRIMARY KEY,
+                   to_email NVARCHAR(255) NOT NULL,
+                   subject NVARCHAR(500) NOT NULL,
+                   html_body NVARCHAR(MAX) NOT NULL,
+                   purpose NVARCHAR(50) DEFAULT 'general',
+                   status NVARCHAR(20) NOT NULL DEFAULT 'Pending' CHECK (status IN ('Pending', 'Sending', 'Sent', 'Failed', 'Skipped')),
+                   attempts INT NOT NULL DEFAULT 0,
+                   next_attempt_at FLOAT NOT NULL,
+                   claimed_at FLOAT,
+                   last_error NVARCHAR(MAX),
+                   created_at DATETIME DEFAULT GETDATE(),
+                   sent_at DATETIME
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_email_outbox_due')
+               CREATE INDEX idx_email_outbox_due ON email_outbox(status, next_attempt_at)""",
+        ],
+    }),
+    ('payroll_runs', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS payroll_runs (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   month TEXT NOT NULL,
+                   employee_id TEXT,
+                   status TEXT NOT NULL DEFAULT 'Queued' CHECK (status IN ('Queued', 'Running', 'Completed', 'Failed', 'Cancelled')),
+                   total_employees INTEGER,
+                   processed_employees INTEGER NOT NULL DEFAULT 0,
+                   last_employee_id TEXT,
+                   attempts INTEGER NOT NULL DEFAULT 0,
+                   claim_token TEXT,
+                   heartbeat_at REAL,
+                   error TEXT,
+                   requested_by TEXT,
+                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                   started_at DATETIME,
+                   finished_at DATETIME
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_payroll_runs_status ON payroll_runs(status)",
+            "CREATE INDEX IF NOT EXISTS idx_payroll_runs_month ON payroll_runs(month)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('payroll_runs', 'U') IS NULL
+               CREATE TABLE payroll_runs (
+                   id INT IDENTITY(1,1) PRIMARY KEY,
+                   month NVARCHAR(7) NOT NULL,
+                   employee_id NVARCHAR(50),
+                   status NVARCHAR(20) NOT NULL DEFAULT 'Queued' CHECK (status IN ('Queued', 'Running', 'Completed', 'Failed', 'Cancelled')),
+                   total_employees INT,
+                   processed_employees INT NOT NULL DEFAULT 0,
+                   last_employee_id NVARCHAR(50),
+                   attempts INT NOT NULL DEFAULT 0,
+                   claim_token NVARCHAR(64),
+                   heartbeat_at FLOAT,
+                   error NVARCHAR(MAX),
+                   requested_by NVARCHAR(100),
+                   created_at DATETIME DEFAULT GETDATE(),
+                   started_at DATETIME,
+                   finished_at DATETIME
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_payroll_runs_status')
+               CREATE INDEX idx_payroll_runs_status ON payroll_runs(status)""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_payroll_runs_month')
+               CREATE INDEX idx_payroll_runs_month ON payroll_runs(month)""",
+        ],
+    }),
+    ('payroll_stale', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS payroll_stale (
+                   employee_id TEXT NOT NULL,
+                   month TEXT NOT NULL,
+                   reason TEXT,
+                   marked_at REAL NOT NULL,
+                   PRIMARY KEY (employee_id, month)
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_payroll_stale_month ON payroll_stale(month)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('payroll_stale', 'U') IS NULL
+               CREATE TABLE payroll_stale (
+                   employee_id NVARCHAR(50) NOT NULL,
+                   month NVARCHAR(7) NOT NULL,
+                   reason NVARCHAR(100),
+                   marked_at FLOAT NOT NULL,
+                   CONSTRAINT pk_payroll_stale PRIMARY KEY (employee_id, month)
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_payroll_stale_month')
+               CREATE INDEX idx_payroll_stale_month ON payroll_stale(month)""",
+        ],
+    }),
+    ('payroll_stale_mark_id', {
+        'sqlite': [sqlite_add_column('payroll_stale', 'mark_id', "TEXT NOT NULL DEFAULT ''")],
+        'sqlserver': ["IF COL_LENGTH('payroll_stale', 'mark_id') IS NULL "
+                      "ALTER TABLE payroll_stale ADD mark_id NVARCHAR(32) NOT NULL DEFAULT ''"],
+    }),
+    ('users_designation', {
+        'sqlite': [sqlite_add_column('users', 'designation', 'TEXT')],
+        'sqlserver': [
+            "IF COL_LENGTH('users', 'designation') IS NULL ALTER TABLE users ADD designation NVARCHAR(100)",
+        ],
+    }),
+    ('holidays_scope', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS holidays (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   date DATE NOT NULL UNIQUE,
+                   description TEXT NOT NULL,
+                   is_optional INTEGER DEFAULT 0,
+                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+               )""",
+            sqlite_add_column('holidays', 'employee_category', 'TEXT'),
+            sqlite_add_column('holidays', 'shift', 'TEXT'),
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('holidays', 'U') IS NULL
+               CREATE TABLE holidays (
+                   id INT IDENTITY(1,1) PRIMARY KEY,
+                   date DATE NOT NULL UNIQUE,
+                   description NVARCHAR(200) NOT NULL,
+                   is_optional BIT DEFAULT 0,
+                   created_at DATETIME DEFAULT GETDATE()
+               )""",
+            "IF COL_LENGTH('holidays', 'employee_category') IS NULL ALTER TABLE holidays ADD employee_category NVARCHAR(10)",
+            "IF COL_LENGTH('holidays', 'shift') IS NULL ALTER TABLE holidays ADD shift NVARCHAR(10)",
+        ],
+    }),
+    ('leave_ledger', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS leave_ledger (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   leave_id INTEGER,
+                   employee_id TEXT NOT NULL,
+                   leave_year INTEGER NOT NULL,
+                   leave_month INTEGER NOT NULL,
+                   leave_type TEXT NOT NULL,
+                   event TEXT NOT NULL,
+                   pending_delta REAL NOT NULL DEFAULT 0,
+                   approved_delta REAL NOT NULL DEFAULT 0,
+                   actor TEXT,
+                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_leave_ledger_leave ON leave_ledger(leave_id)",
+            "CREATE INDEX IF NOT EXISTS idx_leave_ledger_emp_year ON leave_ledger(employee_id, leave_year)",
+            """CREATE TABLE IF NOT EXISTS leave_totals (
+                   employee_id TEXT NOT NULL,
+                   leave_year INTEGER NOT NULL,
+                   leave_month INTEGER NOT NULL,
+                   leave_type TEXT NOT NULL,
+                   pending_days REAL NOT NULL DEFAULT 0,
+                   approved_days REAL NOT NULL DEFAULT 0,
+                   updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                   PRIMARY KEY (employee_id, leave_year, leave_month, leave_type)
+               )""",
+            # Opening entries for requests made before the ledger existed
+            """INSERT INTO leave_ledger (leave_id, employee_id, leave_year, leave_month, leave_type, event,
+                                       pending_delta, approved_delta, actor, created_at)
+               SELECT id, employee_id, CAST(strftime('%Y', start_date) AS INTEGER), CAST(strftime('%m', start_date) AS INTEGER),
+                      leave_type, 'OPENING',
+                      CASE WHEN status = 'Pending' THEN days_requested ELSE 0 END,
+                      CASE WHEN status = 'Approved' THEN days_requested ELSE 0 END,
+                      'SYSTEM', COALESCE(applied_on, CURRENT_TIMESTAMP)
+               FROM leave_applications WHERE status IN ('Pending', 'Approved')""",
+            """INSERT INTO leave_totals (employee_id, leave_year, leave_month, leave_type, pending_days, approved_days)
+               SELECT employee_id, leave_year, leave_month, leave_type, SUM(pending_delta), SUM(approved_delta)
+               FROM leave_ledger GROUP BY employee_id, leave_year, leave_month, leave_type
+               UNION ALL
+               SELECT employee_id, leave_year, 0, leave_type, SUM(pending_delta), SUM(approved_delta)
+               FROM leave_ledger GROUP BY employee_id, leave_year, leave_type""",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('leave_ledger', 'U') IS NULL
+               CREATE TABLE leave_ledger (
+                   id INT IDENTITY(1,1) PRIMARY KEY,
+                   leave_id INT,
+                   employee_id NVARCHAR(50) NOT NULL,
+                   leave_year INT NOT NULL,
+                   leave_month INT NOT NULL,
+                   leave_type NVARCHAR(20) NOT NULL,
+                   event NVARCHAR(20) NOT NULL,
+                   pending_delta FLOAT NOT NULL DEFAULT 0,
+                   approved_delta FLOAT NOT NULL DEFAULT 0,
+                   actor NVARCHAR(100),
+                   created_at DATETIME DEFAULT GETDATE()
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_leave_ledger_leave')
+               CREATE INDEX idx_leave_ledger_leave ON leave_ledger(leave_id)""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_leave_ledger_emp_year')
+               CREATE INDEX idx_leave_ledger_emp_year ON leave_ledger(employee_id, leave_year)""",
+            """IF OBJECT_ID('leave_totals', 'U') IS NULL
+               CREATE TABLE leave_totals (
+                   employee_id NVARCHAR(50) NOT NULL,
+                   leave_year INT NOT NULL,
+                   leave_month INT NOT NULL,
+                   leave_type NVARCHAR(20) NOT NULL,
+                   pending_days FLOAT NOT NULL DEFAULT 0,
+                   approved_days FLOAT NOT NULL DEFAULT 0,
+                   updated_at DATETIME DEFAULT GETDATE(),
+                   CONSTRAINT pk_leave_totals PRIMARY KEY (employee_id, leave_year, leave_month, leave_type)
+               )""",
+            """IF OBJECT_ID('leave_applications', 'U') IS NOT NULL
+               INSERT INTO leave_ledger (leave_id, employee_id, leave_year, leave_month, leave_type, event,
+                                         pending_delta, approved_delta, actor, created_at)
+               SELECT id, employee_id, YEAR(start_date), MONTH(start_date), leave_type, 'OPENING',
+                      CASE WHEN status = 'Pending' THEN days_requested ELSE 0 END,
+                      CASE WHEN status = 'Approved' THEN days_requested ELSE 0 END,
+                      'SYSTEM', COALESCE(applied_on, GETDATE())
+               FROM leave_applications WHERE status IN ('Pending', 'Approved')""",
+            """INSERT INTO leave_totals (employee_id, leave_year, leave_month, leave_type, pending_days, approved_days)
+               SELECT employee_id, leave_year, leave_month, leave_type, SUM(pending_delta), SUM(approved_delta)
+               FROM leave_ledger GROUP BY employee_id, leave_year, leave_month, leave_type
+               UNION ALL
+               SELECT employee_id, leave_year, 0, leave_type, SUM(pending_delta), SUM(approved_delta)
+               FROM leave_ledger GROUP BY employee_id, leave_year, leave_type""",
+        ],
+    }),
+    ('covering_indexes_month_queries', {
+        'sqlite': [
+            "CREATE INDEX IF NOT EXISTS idx_attendance_emp_date_status ON attendance(employee_id, date, status, hours_worked)",
+            "DROP INDEX IF EXISTS idx_attendance_emp_date",  # same prefix as the index above
+            "CREATE INDEX IF NOT EXISTS idx_leave_applications_emp_start ON leave_applications(employee_id, start_date, leave_type, status)",
+            "ANALYZE",
+        ],
+        'sqlserver': [
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_emp_date_status')
+               CREATE INDEX idx_attendance_emp_date_status ON attendance(employee_id, date) INCLUDE (status, hours_worked)""",
+            """IF OBJECT_ID('leave_applications', 'U') IS NOT NULL
+               AND NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_leave_applications_emp_start')
+               CREATE INDEX idx_leave_applications_emp_start ON leave_applications(employee_id, start_date) INCLUDE (leave_type, status)""",
+        ],
+    }),
+    # The hour-calculation triggers refer to in_time/out_time columns that
+    # attendance never had, so every INSERT/UPDATE on it failed; check-out
+    # already calculates hours_worked itself.
+    ('drop_attendance_hour_triggers', {
+        'sqlite': [
+            "DROP TRIGGER IF EXISTS calculate_hours_insert",
+            "DROP TRIGGER IF EXISTS calculate_hours_update",
+        ],
+        'sqlserver': [],
+    }),
+    ('attendance_punches', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS attendance_punches (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                employee_id TEXT NOT NULL,
+                punched_at DATETIME NOT NULL,
+                direction TEXT CHECK (direction IN ('IN', 'OUT')),
+                device_id TEXT,
+                source TEXT,
+                imported_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                UNIQUE(employee_id, punched_at)
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_attendance_punches_time ON attendance_punches(punched_at)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('attendance_punches', 'U') IS NULL
+               CREATE TABLE attendance_punches (
+                   id INT IDENTITY(1,1) PRIMARY KEY,
+                   employee_id NVARCHAR(50) NOT NULL,
+                   punched_at DATETIME NOT NULL,
+                   direction NVARCHAR(3) CHECK (direction IN ('IN', 'OUT')),
+                   device_id NVARCHAR(50),
+                   source NVARCHAR(255),
+                   imported_at DATETIME DEFAULT GETDATE(),
+                   CONSTRAINT uq_attendance_punches UNIQUE (employee_id, punched_at)
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_punches_time')
+               CREATE INDEX idx_attendance_punches_time ON attendance_punches(punched_at)""",
+        ],
+    }),
+    # Full clock-in/out timestamps, so a night shift's session can end on the
+    # next calendar day. Existing rows are backfilled from date + time, with a
+    # clock-out earlier than the clock-in moved to the next day and its hours
+    # (negative until now) and Present/Half-Day status recalculated.
+    ('attendance_sessions', {
+        'sqlite': [
+            sqlite_add_column('attendance', 'clock_in_at', 'DATETIME'),
+            sqlite_add_column('attendance', 'clock_out_at', 'DATETIME'),
+            """UPDATE attendance SET clock_in_at = date || ' ' || clock_in
+               WHERE clock_in IS NOT NULL AND clock_in_at IS NULL""",
+            """UPDATE attendance
+               SET clock_out_at = CASE WHEN clock_out < clock_in THEN date(date, '+1 day') ELSE date END || ' ' || clock_out
+               WHERE clock_out IS NOT NULL AND clock_in IS NOT NULL AND clock_out_at IS NULL""",
+            """UPDATE attendance
+               SET hours_worked = ROUND((julianday(clock_out_at) - julianday(clock_in_at)) * 24, 2),
+                   status = CASE WHEN status NOT IN ('Present', 'Half-Day') THEN status
+                                 WHEN (julianday(clock_out_at) - julianday(clock_in_at)) * 24 >= 4 THEN 'Present'
+                                 ELSE 'Half-Day' END
+               WHERE clock_out < clock_in OR hours_worked < 0""",
+        ],
+        'sqlserver': [
+            "IF COL_LENGTH('attendance', 'clock_in_at') IS NULL ALTER TABLE attendance ADD clock_in_at DATETIME",
+            "IF COL_LENGTH('attendance', 'clock_out_at') IS NULL ALTER TABLE attendance ADD clock_out_at DATETIME",
+            """UPDATE attendance SET clock_in_at = CAST(date AS DATETIME) + CAST(clock_in AS DATETIME)
+               WHERE clock_in IS NOT NULL AND clock_in_at IS NULL""",
+            """UPDATE attendance
+               SET clock_out_at = DATEADD(day, CASE WHEN clock_out < clock_in THEN 1 ELSE 0 END,
+                                          CAST(date AS DATETIME) + CAST(clock_out AS DATETIME))
+               WHERE clock_out IS NOT NULL AND clock_in IS NOT NULL AND clock_out_at IS NULL""",
+            """UPDATE attendance
+               SET hours_worked = ROUND(DATEDIFF(second, clock_in_at, clock_out_at) / 3600.0, 2),
+                   status = CASE WHEN status NOT IN ('Present', 'Half Day') THEN status
+                                 WHEN DATEDIFF(second, clock_in_at, clock_out_at) >= 4 * 3600 THEN 'Present'
+                                 ELSE 'Half Day' END
+               WHERE clock_out < clock_in OR hours_worked < 0""",
+        ],
+    }),
+    ('attendance_flags', {
+        'sqlite': [
+            sqlite_add_column('attendance', 'is_late', 'INTEGER NOT NULL DEFAULT 0'),
+            sqlite_add_column('attendance', 'late_by_minutes', 'INTEGER NOT NULL DEFAULT 0'),
+            sqlite_add_column('attendance', 'is_early_leave', 'INTEGER NOT NULL DEFAULT 0'),
+            sqlite_add_column('attendance', 'early_by_minutes', 'INTEGER NOT NULL DEFAULT 0'),
+            backfill_attendance_flags,
+            # Month and refresh queries read the flags too, so the covering index carries them
+            "DROP INDEX IF EXISTS idx_attendance_emp_date_status",
+            """CREATE INDEX idx_attendance_emp_date_status
+               ON attendance(employee_id, date, status, hours_worked, is_late, is_early_leave)""",
+            "CREATE INDEX IF NOT EXISTS idx_attendance_late ON attendance(date, employee_id) WHERE is_late = 1",
+            "CREATE INDEX IF NOT EXISTS idx_attendance_early_leave ON attendance(date, employee_id) WHERE is_early_leave = 1",
+            "ANALYZE",
+        ],
+        'sqlserver': [
+            "IF COL_LENGTH('attendance', 'is_late') IS NULL ALTER TABLE attendance ADD is_late BIT NOT NULL DEFAULT 0",
+            "IF COL_LENGTH('attendance', 'late_by_minutes') IS NULL ALTER TABLE attendance ADD late_by_minutes INT NOT NULL DEFAULT 0",
+            "IF COL_LENGTH('attendance', 'is_early_leave') IS NULL ALTER TABLE attendance ADD is_early_leave BIT NOT NULL DEFAULT 0",
+            "IF COL_LENGTH('attendance', 'early_by_minutes') IS NULL ALTER TABLE attendance ADD early_by_minutes INT NOT NULL DEFAULT 0",
+            # The columns existed here but nothing set them
+            "UPDATE attendance SET is_late = 0 WHERE is_late IS NULL",
+            "UPDATE attendance SET is_early_leave = 0 WHERE is_early_leave IS NULL",
+            backfill_attendance_flags,
+            """IF EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_emp_date_status')
+               DROP INDEX idx_attendance_emp_date_status ON attendance""",
+            """CREATE INDEX idx_attendance_emp_date_status ON attendance(employee_id, date)
+               INCLUDE (status, hours_worked, is_late, is_early_leave)""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_late')
+               CREATE INDEX idx_attendance_late ON attendance(date, employee_id) WHERE is_late = 1""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_early_leave')
+               CREATE INDEX idx_attendance_early_leave ON attendance(date, employee_id) WHERE is_early_leave = 1""",
+        ],
+    }),
+    ('attendance_rollups', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS attendance_rollup_monthly (
+                   employee_id TEXT NOT NULL,
+                   month TEXT NOT NULL,
+                   recorded_days INTEGER NOT NULL DEFAULT 0,
+                   present_days INTEGER NOT NULL DEFAULT 0,
+                   absent_days INTEGER NOT NULL DEFAULT 0,
+                   half_days INTEGER NOT NULL DEFAULT 0,
+                   leave_days INTEGER NOT NULL DEFAULT 0,
+                   ot_days INTEGER NOT NULL DEFAULT 0,
+                   late_days INTEGER NOT NULL DEFAULT 0,
+                   early_days INTEGER NOT NULL DEFAULT 0,
+                   total_hours REAL NOT NULL DEFAULT 0,
+                   present_hours REAL NOT NULL DEFAULT 0,
+                   hours_days INTEGER NOT NULL DEFAULT 0,
+                   updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                   PRIMARY KEY (employee_id, month),
+                   FOREIGN KEY (employee_id) REFERENCES users(employee_id) ON DELETE CASCADE
+               )""",
+            """CREATE TABLE IF NOT EXISTS attendance_rollup_daily (
+                   department TEXT NOT NULL,
+                   date DATE NOT NULL,
+                   recorded_days INTEGER NOT NULL DEFAULT 0,
+                   present_days INTEGER NOT NULL DEFAULT 0,
+                   absent_days INTEGER NOT NULL DEFAULT 0,
+                   half_days INTEGER NOT NULL DEFAULT 0,
+                   leave_days INTEGER NOT NULL DEFAULT 0,
+                   ot_days INTEGER NOT NULL DEFAULT 0,
+                   late_days INTEGER NOT NULL DEFAULT 0,
+                   early_days INTEGER NOT NULL DEFAULT 0,
+                   total_hours REAL NOT NULL DEFAULT 0,
+                   present_hours REAL NOT NULL DEFAULT 0,
+                   hours_days INTEGER NOT NULL DEFAULT 0,
+                   updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                   PRIMARY KEY (department, date)
+               )""",
+            "CREATE INDEX IF NOT EXISTS idx_attendance_rollup_monthly_month ON attendance_rollup_monthly(month)",
+            "CREATE INDEX IF NOT EXISTS idx_attendance_rollup_daily_date ON attendance_rollup_daily(date)",
+        ] + ATTENDANCE_ROLLUP_REBUILD_SQL['sqlite'],
+        'sqlserver': [
+            """IF OBJECT_ID('attendance_rollup_monthly', 'U') IS NULL
+               CREATE TABLE attendance_rollup_monthly (
+                   employee_id NVARCHAR(50) NOT NULL,
+                   month NVARCHAR(7) NOT NULL,
+                   recorded_days INT NOT NULL DEFAULT 0,
+                   present_days INT NOT NULL DEFAULT 0,
+                   absent_days INT NOT NULL DEFAULT 0,
+                   half_days INT NOT NULL DEFAULT 0,
+                   leave_days INT NOT NULL DEFAULT 0,
+                   ot_days INT NOT NULL DEFAULT 0,
+                   late_days INT NOT NULL DEFAULT 0,
+                   early_days INT NOT NULL DEFAULT 0,
+                   total_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+                   present_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+                   hours_days INT NOT NULL DEFAULT 0,
+                   updated_at DATETIME DEFAULT GETDATE(),
+                   CONSTRAINT pk_attendance_rollup_monthly PRIMARY KEY (employee_id, month),
+                   CONSTRAINT fk_attendance_rollup_employee FOREIGN KEY (employee_id) REFERENCES users(employee_id) ON DELETE CASCADE
+               )""",
+            """IF OBJECT_ID('attendance_rollup_daily', 'U') IS NULL
+               CREATE TABLE attendance_rollup_daily (
+                   department NVARCHAR(100) NOT NULL,
+                   date DATE NOT NULL,
+                   recorded_days INT NOT NULL DEFAULT 0,
+                   present_days INT NOT NULL DEFAULT 0,
+                   absent_days INT NOT NULL DEFAULT 0,
+                   half_days INT NOT NULL DEFAULT 0,
+                   leave_days INT NOT NULL DEFAULT 0,
+                   ot_days INT NOT NULL DEFAULT 0,
+                   late_days INT NOT NULL DEFAULT 0,
+                   early_days INT NOT NULL DEFAULT 0,
+                   total_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+                   present_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+                   hours_days INT NOT NULL DEFAULT 0,
+                   updated_at DATETIME DEFAULT GETDATE(),
+                   CONSTRAINT pk_attendance_rollup_daily PRIMARY KEY (department, date)
+               )""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_rollup_monthly_month')
+               CREATE INDEX idx_attendance_rollup_monthly_month ON attendance_rollup_monthly(month)""",
+            """IF NOT EXISTS (SELECT 1 FROM sys.indexes WHERE name = 'idx_attendance_rollup_daily_date')
+               CREATE INDEX idx_attendance_rollup_daily_date ON attendance_rollup_daily(date)""",
+        ] + ATTENDANCE_ROLLUP_REBUILD_SQL['sqlserver'],
+    }),
+    # Rollups built before attendance_flags counted late/early days from notes
+    ('attendance_rollups_from_flags', ATTENDANCE_ROLLUP_REBUILD_SQL),
+    # A date can hold one holiday per category/shift scope - e.g. a W001-only
+    # and an M001-only holiday on the same day - instead of one per date.
+    # SQLite can't drop a column constraint, so the table is rebuilt.
+    ('calendar_version', {
+        'sqlite': [
+            """CREATE TABLE IF NOT EXISTS calendar_version (
+                   id INTEGER PRIMARY KEY CHECK (id = 1),
+                   version INTEGER NOT NULL DEFAULT 0
+               )""",
+            "INSERT OR IGNORE INTO calendar_version (id, version) VALUES (1, 0)",
+        ],
+        'sqlserver': [
+            """IF OBJECT_ID('calendar_version', 'U') IS NULL
+               CREATE TABLE calendar_version (
+                   id INT PRIMARY KEY CHECK (id = 1),
+                   version INT NOT NULL DEFAULT 0
+               )""",
+            "IF NOT EXISTS (SELECT 1 FROM calendar_version) INSERT INTO calendar_version (id, version) VALUES (1, 0)",
+        ],
+    }),
+    ('holidays_scope_key', {
+        'sqlite': [
+            "DROP TABLE IF EXISTS holidays_rebuild",
+            """CREATE TABLE holidays_rebuild (
+                   id INTEGER PRIMARY KEY AUTOINCREMENT,
+                   date DATE NOT NULL,
+                   description TEXT NOT NULL,
+                   is_optional INTEGER DEFAULT 0,
+                   employee_category TEXT,
+                   shift TEXT,
+                   created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+               )""",
+            """INSERT INTO holidays_rebuild (id, date, description, is_optional, employee_category, shift, created_at)
+               SELECT id, date, description, is_optional, employee_category, shift, created_at FROM holidays""",
+            "DROP TABLE holidays",
+            "ALTER TABLE holidays_rebuild RENAME TO holidays",
+            """CREATE UNIQUE INDEX IF NOT EXISTS uq_holidays_scope
+               ON holidays(date, COALESCE(employee_category, ''), COALESCE(shift, ''))""",
+            "CREATE INDEX IF NOT EXISTS idx_holidays_optional ON holidays(is_optional)",
+        ],
+        'sqlserver': [
+            # The date-only UNIQUE was declared inline, so its name is generated
+            """DECLARE @constraint NVARCHAR(200) = (
+                   SELECT TOP 1 kc.name FROM sys.key_constraints kc
+                   WHERE kc.parent_object_id = OBJECT_ID('holidays') AND kc.type = 'UQ'
+                     AND (SELECT COUNT(*) FROM sys.index_columns ic
+                          WHERE ic.object_id = kc.parent_object_id AND ic.index_id = kc.unique_index_id) = 1)
+               IF @constraint IS NOT NULL EXEC('ALTER TABLE holidays DROP CONSTRAINT ' + @constraint)""",
+            # SQL Server UNIQUE treats NULLs as equal, so NULL (= every) scopes collide as intended
+            """IF NOT EXISTS (SELECT 1 FROM sys.key_constraints WHERE name = 'uq_holidays_scope')
+               ALTER TABLE holidays ADD CONSTRAINT uq_holidays_scope UNIQUE (date, employee_category, shift)""",
+        ],
+    }),
+    # Welcome and reset emails carry temporary passwords; finished rows keep no body
+    ('email_outbox_redact_finished', {
+        'sqlite': ["UPDATE email_outbox SET html_body = '' WHERE status IN ('Sent', 'Failed', 'Skipped')"],
+        'sqlserver': ["UPDATE email_outbox SET html_body = '' WHERE status IN ('Sent', 'Failed', 'Skipped')"],
+    }),
+]
+
+def apply_schema_updates():
+    """Run any SCHEMA_UPDATES this database hasn't seen yet"""
+    conn = get_db_connection()
+    if not conn:
+        return
+    try:
+        cursor = conn.cursor()
+        cursor.execute(SCHEMA_MIGRATIONS_DDL[DATABASE_TYPE])
+        conn.commit()
+        cursor.execute("SELECT name FROM schema_migrations")
+        applied = {row['name'] for row in cursor.fetchall()}
+        for name, statements in SCHEMA_UPDATES:
+            if name in applied:
+                continue
+            for statement in statements[DATABASE_TYPE]:
+                if callable(statement):
+                    statement(cursor)
+                else:
+                    cursor.execute(statement)
+            cursor.execute("INSERT INTO schema_migrations (name) VALUES (?)", (name,))
+            conn.commit()
+            logger.info(f"Applied schema update '{name}'", extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
+    finally:
+        conn.close()
+
+apply_schema_updates()
+
+# ============== DATE-RANGE QUERIES ==============
+# Month and year filters are always written as half-open ranges on the raw
+# column (date >= first day AND date < first day of the next period) so they
+# can seek (employee_id, date)-style indexes; never wrap the column in a
+# function. The per-employee dashboard queries are kept here with a plan
+# check that runs at startup and warns if one of them starts scanning.
+
+def month_bounds(year, month):
+    """('YYYY-MM-01', first day of the next month) for a half-open month range"""
+    year, month = int(year), int(month)
+    next_year, next_month = (year + 1, 1) if month == 12 else (year, month + 1)
+    return f"{year:04d}-{month:02d}-01", f"{next_year:04d}-{next_month:02d}-01"
+
+def year_bounds(year):
+    """('YYYY-01-01', first day of the next year) for a half-open year range"""
+    year = int(year)
+    return f"{year:04d}-01-01", f"{year + 1:04d}-01-01"
+
+ATTENDANCE_MONTH_ROLLUP_SQL = """
+    SELECT present_days, absent_days, half_days, leave_days, ot_days,
+           late_days, early_days, total_hours
+    FROM attendance_rollup_monthly
+    WHERE employee_id = ? AND month = ?
+"""
+
+EMPLOYEE_LEAVES_SQL = """
+    SELECT id, leave_type, start_date, end_date, days_requested, is_half_day, 
+           half_day_session, reason, status, approved_by, approved_on, 
+           rejection_reason, applied_on
+    FROM leave_applications 
+    WHERE employee_id = ? AND start_date >= ? AND start_date < ?
+"""
+
+# (name, query, sample params, index the plan must use)
+QUERY_PLAN_CHECKS = [
+    ('attendance_month_rollup', ATTENDANCE_MONTH_ROLLUP_SQL, ('-', '2000-01'), None),
+    ('attendance_rollup_refresh', ATTENDANCE_ROLLUP_MONTH_REFRESH_SQL[1], ('2000-01', '-', *month_bounds(2000, 1)),
+     'idx_attendance_emp_date_status'),
+    ('employee_leaves_year', EMPLOYEE_LEAVES_SQL, ('-', *year_bounds(2000)), 'idx_leave_applications_emp_start'),
+    ('leave_totals_lookup', "SELECT pending_days, approved_days FROM leave_totals "
+                            "WHERE employee_id = ? AND leave_year = ? AND leave_month = ? AND leave_type = ?",
+     ('-', 2000, 1, 'CL'), None),
+]
+
+def check_query_plans():
+    """EXPLAIN each QUERY_PLAN_CHECKS query; {name: problem} for any that scans a table or misses its index"""
+    problems = {}
+    conn = get_db_connection()
+    if not conn:
+        return problems
     try:
+        cursor = conn.cursor()
+        for name, query, params, index in QUERY_PLAN_CHECKS:
+            plan = db_backend.explain(cursor, query, params)
+            if plan is None:
+                return problems  # backend can't show plans
+            scans = [step for step in plan if step.startswith('SCAN ')]
+            if scans:
+                problems[name] = '; '.join(scans)
+            elif index and not any(index in step for step in plan):
+                problems[name] = f"not using {index}: {'; '.join(plan)}"
+    finally:
+        conn.close()
+    for name, problem in problems.items():
+        logger.warning(f"Query plan regression in '{name}': {problem}",
+                       extra={'user': 'SYSTEM', 'ip': 'localhost', 'endpoint': 'startup'})
+    return problems
+
+QUERY_PLAN_PROBLEMS = check_query_plans() if app_config.QUERY_PLAN_CHECKS else {}
+
+# ============== TOKEN REVOCATION ==============
+# Logged-out tokens (by jti) and force-logged-out sessions (by session_id)
+# live in the revoked_tokens table, so every worker process sees them and
+# they survive restarts. Each worker mirrors the unexpired rows in a dict:
+# the per-request check is a dict lookup, and the table is only read again
+# (incrementally, by revoked_at) every REVOCATION_SYNC_INTERVAL seconds.
+# Rows are dropped once the token they revoke would have expired anyway.
+
+class RevocationStore:
+    """Shared JWT revocation list with a per-process in-memory mirror"""
+
+    def __init__(self, sync_interval, prune_interval):
+        self.sync_interval = sync_interval
+        self.prune_interval = prune_interval
+        self._revoked = {}  # token_key -> expires_at (epoch seconds)
+        self._sync_lock = threading.Lock()
+        self._last_sync = float('-inf')
+        self._last_prune = float('-inf')
+        self._synced_to = 0.0  # newest revoked_at already mirrored
+
+    def is_revoked(self, *keys):
+        if time.monotonic() - self._last_sync >= self.sync_interval:
+            self.sync()
+        now = time.time()
+        for key in keys:
+            expires_at = self._revoked.get(key)
+            if expires_at is not None and expires_at > now:
+                return True
+        return False
+
+    def revoke(self, key, expires_at):
+        """Revoke a jti/session_id until `expires_at` - effective immediately in this process"""
+        self._revoked[key] = expires_at
         conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT setting_value FROM system_settings WHERE setting_key = ?", (key,))
-            result = cursor.fetchone()
+        if not conn:
+            logger.error(f"Token revocation not persisted for {key}", extra={'user': '-', 'ip': '-', 'endpoint': 'revoke'})
+            return
+        try:
+            conn.cursor().execute(
+                db_backend.upsert('revoked_tokens', ('token_key', 'expires_at', 'revoked_at'), key_columns=('token_key',)),
+                (key, expires_at, time.time())
+            )
+            conn.commit()
+        finally:
             conn.close()
-            return result['setting_value'] if result else default
-    except Exception as e:
-        logger.error(f"Error getting setting {key}: {e}")
-    return default
+
+    def sync(self):
+        """Pull revocations made by other workers since the last sync"""
+        if not self._sync_lock.acquire(blocking=False):
+            return  # another thread is already syncing - use the mirror as is
+        conn = None
+        try:
+            self._last_sync = time.monotonic()
+            now = time.time()
+            conn = get_db_connection()
+            if not conn:
+                return
+            cursor = conn.cursor()
+            # Re-read a little history so rows committed late by another worker aren't missed
+            cursor.execute(
+                "SELECT token_key, expires_at, revoked_at FROM revoked_tokens WHERE revoked_at > ? AND expires_at > ?",
+                (self._synced_to - 60, now)
+            )
+            for row in cursor.fetchall():
+                self._revoked[row['token_key']] = row['expires_at']
+                self._synced_to = max(self._synced_to, row['revoked_at'])
+            if time.monotonic() - self._last_prune >= self.prune_interval:
+                self._last_prune = time.monotonic()
+                cursor.execute("DELETE FROM revoked_tokens WHERE expires_at <= ?", (now,))
+                conn.commit()
+                for key, expires_at in list(self._revoked.items()):
+                    if expires_at <= now:
+                        self._revoked.pop(key, None)
+        except Exception as e:
+            logger.error(f"Token revocation sync error: {e}", extra={'user': '-', 'ip': '-', 'endpoint': 'revoke'})
+        finally:
+            if conn:
+                conn.close()
+            self._sync_lock.release()
+
+    def stats(self):
+        return {'revoked': len(self._revoked), 'synced_to': self._synced_to}
+
+
+token_revocations = RevocationStore(
+    sync_interval=app_config.REVOCATION_SYNC_INTERVAL,
+    prune_interval=app_config.REVOCATION_PRUNE_INTERVAL
+)
+token_revocations.sync()
+
+@jwt.token_in_blocklist_loader
+def check_if_token_revoked(jwt_header, jwt_payload):
+    return token_revocations.is_revoked(jwt_payload['jti'], jwt_payload.get('session_id'))
+
+# ============================================================
+# IN-PROCESS CACHE
+# ============================================================
+
+class TTLCache:
+    """Small thread-safe LRU cache whose entries also expire after `ttl` seconds"""
+
+    def __init__(self, max_size, ttl):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = threading.Lock()
+        self.counters = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > time.monotonic():
+                self._data.move_to_end(key)
+                self.counters['hits'] += 1
+                return item[1]
+            if item is not None:
+                del self._data[key]
+            self.counters['misses'] += 1
+            return default
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            self._data[key] = (time.monotonic() + (ttl or self.ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.counters['evictions'] += 1
+
+    def invalidate(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, size=len(self._data), max_size=self.max_size)
+
+# ============== SYSTEM SETTINGS CACHE ==============
+# All of system_settings is loaded with one query and served from memory.
+# update_settings() bumps settings_version in the same transaction; every
+# worker compares that single number at most every SETTINGS_CHECK_INTERVAL
+# seconds and reloads the whole table when it has moved.
+
+class SettingsCache:
+    """In-memory copy of system_settings, reloaded when settings_version changes"""
+
+    def __init__(self, check_interval):
+        self.check_interval = check_interval
+        self._values = None
+        self._version = None
+        self._last_check = float('-inf')
+        self._lock = threading.Lock()
+        self.counters = {'checks': 0, 'reloads': 0}
+
+    def get(self, key, default=None):
+        values = self._current()
+        return values[key] if key in values else default
+
+    def _current(self):
+        if self._values is None or time.monotonic() - self._last_check >= self.check_interval:
+            self._refresh()
+        return self._values or {}
+
+    def _refresh(self):
+        with self._lock:
+            if self._values is not None and time.monotonic() - self._last_check < self.check_interval:
+                return  # another thread refreshed while we waited
+            conn = get_db_connection()
+            if not conn:
+                return  # keep serving what we have
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT version FROM settings_version WHERE id = 1")
+                row = cursor.fetchone()
+                version = row['version'] if row else None
+                self.counters['checks'] += 1
+                if self._values is None or version != self._version:
+                    cursor.execute("SELECT setting_key, setting_value FROM system_settings")
+                    self._values = {r['setting_key']: r['setting_value'] for r in cursor.fetchall()}
+                    self._version = version
+                    self.counters['reloads'] += 1
+                self._last_check = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error loading system settings: {e}")
+            finally:
+                conn.close()
+
+    def invalidate(self):
+        """Reload on the next read - other workers follow via settings_version"""
+        with self._lock:
+            self._values = None
+
+    def stats(self):
+        return dict(self.counters, version=self._version, keys=len(self._values or {}))
+
+
+settings_cache = SettingsCache(check_interval=app_config.SETTINGS_CHECK_INTERVAL)
+
+def get_system_setting(key, default=None):
+    """Get a system setting (served from the settings cache)"""
+    return settings_cache.get(key, default)
 
 def get_email_config():
     """Get email configuration from database"""
@@ -392,24 +1960,284 @@ def get_email_config():
         'FRONTEND_URL': get_system_setting('frontend_url', 'http://localhost:3000')
     }
 
+# ============== WORK CALENDAR ==============
+# Working days for a month come from the weekly off-days (WORK_WEEKMASK, or a
+# per-category override) minus the holidays that apply: a holiday with no
+# employee_category/shift applies to everyone, otherwise only to that
+# category/shift; optional holidays never reduce working days. Results are
+# memoized per (month, category, shift). Holiday edits bump calendar_version
+# in the same transaction; every worker compares it at most every
+# CALENDAR_CHECK_INTERVAL seconds and drops its memoized months when it moved.
+
+class WorkCalendar:
+    """Memoized working-day counts per month from the weekly pattern and the holidays table"""
+
+    def __init__(self, weekmask, category_weekmasks, ttl, check_interval):
+        self.weekmask = weekmask
+        self.category_weekmasks = category_weekmasks
+        self.check_interval = check_interval
+        self._cache = TTLCache(max_size=1024, ttl=ttl)
+        self._version = None
+        self._last_check = float('-inf')
+        self._lock = threading.Lock()
+
+    def _check_version(self):
+        """Drop memoized months if another worker changed the holidays since the last check"""
+        if time.monotonic() - self._last_check < self.check_interval:
+            return
+        with self._lock:
+            if time.monotonic() - self._last_check < self.check_interval:
+                return  # another thread checked while we waited
+            conn = get_db_connection()
+            if not conn:
+                return  # keep serving what we have
+            try:
+                cursor = conn.cursor()
+                cursor.execute("SELECT version FROM calendar_version WHERE id = 1")
+                row = cursor.fetchone()
+                version = row['version'] if row else None
+                if version != self._version:
+                    self._cache.clear()
+                    self._version = version
+                self._last_check = time.monotonic()
+            except Exception as e:
+                logger.error(f"Error checking calendar version: {e}")
+            finally:
+                conn.close()
+
+    def holidays(self, month):
+        """Holiday rows (dicts) falling in a YYYY-MM month"""
+        self._check_version()
+        key = ('holidays', month)
+        rows = self._cache.get(key)
+        if rows is None:
+            start, end = self._bounds(month)
+            conn = get_db_connection()
+            if not conn:
+                # Counting the month without its holidays would be wrong, and cached
+                raise RuntimeError('Database connection failed')
+            try:
+                cursor = conn.cursor()
+                cursor.execute(
+                    """SELECT id, date, description, is_optional, employee_category, shift
+                       FROM holidays WHERE date >= ? AND date < ? ORDER BY date""",
+                    (str(start), str(end))
+                )
+                rows = [dict(row, date=str(row['date'])[:10]) for row in cursor.fetchall()]
+            finally:
+                conn.close()
+            self._cache.set(key, rows)
+        return rows
+
+    def period(self, month, category=None, shift=None):
+        """(start_date, end_date, working_days) for a YYYY-MM month"""
+        self._check_version()
+        key = ('period', month, category, shift)
+        period = self._cache.get(key)
+        if period is None:
+            start, end = self._bounds(month)
+            closed = [h['date'] for h in self.holidays(month)
+                      if not h['is_optional']
+                      and h['employee_category'] in (None, '', category)
+                      and h['shift'] in (None, '', shift)]
+            weekmask = self.category_weekmasks.get(category, self.weekmask)
+            working_days = int(np.busday_count(start, end, weekmask=weekmask, holidays=closed))
+            period = (str(start), str(end - 1), working_days)
+            self._cache.set(key, period)
+        return period
+
+    def working_days(self, month, category=None, shift=None):
+        return self.period(month, category, shift)[2]
+
+    @staticmethod
+    def _bounds(month):
+        """First day of the month and first day of the next one"""
+        start = np.datetime64(f"{month}-01", 'D')
+        return start, (np.datetime64(month, 'M') + 1).astype('datetime64[D]')
+
+    def invalidate(self):
+        """Recompute on the next read - other workers follow via calendar_version"""
+        with self._lock:
+            self._cache.clear()
+            self._last_check = float('-inf')
+
+    def stats(self):
+        return dict(self._cache.stats(), version=self._version)
+
+
+work_calendar = WorkCalendar(
+    weekmask=app_config.WORK_WEEKMASK,
+    category_weekmasks=app_config.WORK_WEEKMASK_BY_CATEGORY,
+    ttl=app_config.CALENDAR_CACHE_TTL,
+    check_interval=app_config.CALENDAR_CHECK_INTERVAL
+)
+
+# ============== AUDIT LOG WRITER ==============
+# audit_log() only queues the event; a background thread writes queued events
+# to audit_logs in one transaction per batch (every AUDIT_BATCH_SIZE events or
+# AUDIT_FLUSH_INTERVAL seconds, whichever comes first). Batches that can't be
+# written - DB down, or the queue is full - are appended to a JSON-lines spill
+# file and replayed on the next successful flush.
+
+AUDIT_INSERT_SQL = "INSERT INTO audit_logs (user_id, action, details, ip_address, user_agent, timestamp) VALUES (?, ?, ?, ?, ?, ?)"
+
+class AuditLogWriter:
+    """Background writer that batches audit_logs inserts"""
+
+    def __init__(self, batch_size, flush_interval, queue_size, spill_path):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spill_path = spill_path
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._spill_lock = threading.Lock()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counters = {'queued': 0, 'written': 0, 'batches': 0, 'spilled': 0, 'replayed': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='audit-log-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, event):
+        """Queue one (user_id, action, details, ip, user_agent, timestamp) row"""
+        try:
+            self._queue.put_nowait(event)
+            self._count('queued')
+        except queue.Full:
+            # Never make the request wait on the audit trail - keep it on disk instead
+            self._spill([event])
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            try:
+                batch = self._collect()
+                if batch:
+                    self._flush(batch)
+            except Exception as e:
+                # Keep the writer alive - a dead thread would silently stop the audit trail
+                logger.error(f"Audit log writer error: {e}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'audit_writer'})
+
+    def _collect(self):
+        """Block for the first event, then gather more until the batch is full or the interval passes"""
+        try:
+            batch = [self._queue.get(timeout=self.flush_interval)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            remaining = 0 if self._stop.is_set() else deadline - time.monotonic()
+            try:
+                # Past the deadline (or shutting down) only take what is already queued
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, rows):
+        conn = get_db_connection()
+        if not conn:
+            return False
+        try:
+            conn.cursor().executemany(AUDIT_INSERT_SQL, rows)
+            conn.commit()
+            return True
+        except Exception as e:
+            logger.error(f"Audit log flush error: {e}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'audit_writer'})
+            return False
+        finally:
+            conn.close()
+
+    def _flush(self, batch):
+        if not self._write(batch):
+            self._spill(batch)
+            return
+        self._count('written', len(batch))
+        self._count('batches')
+        log_db('INSERT', 'audit_logs', f"{len(batch)} audit events")
+        if os.path.exists(self.spill_path):
+            self._replay()
+
+    def _spill(self, rows):
+        with self._spill_lock:
+            with open(self.spill_path, 'a', encoding='utf-8') as spill:
+                for row in rows:
+                    spill.write(json.dumps(row) + '\n')
+                spill.flush()
+                os.fsync(spill.fileno())
+        self._count('spilled', len(rows))
+
+    def _replay(self):
+        """Move spilled events into the database now that it is reachable again"""
+        # Every worker process shares the spill file, so claim it under a name only this call uses
+        replaying = f"{self.spill_path}.{os.getpid()}-{secrets.token_hex(4)}.replaying"
+        with self._spill_lock:
+            try:
+                os.replace(self.spill_path, replaying)
+            except FileNotFoundError:
+                # Another process got to it first
+                return
+        rows = []
+        with open(replaying, encoding='utf-8') as spill:
+            for line in spill:
+                if not line.strip():
+                    continue
+                try:
+                    rows.append(tuple(json.loads(line)))
+                except (ValueError, TypeError):
+                    # A torn line from a crash mid-append; skip it rather than lose the rest
+                    logger.warning(f"Skipping unreadable audit spill line: {line.strip()[:200]}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'audit_writer'})
+        for i in range(0, len(rows), self.batch_size):
+            if not self._write(rows[i:i + self.batch_size]):
+                # Put back what is left; the next successful flush tries again
+                self._spill(rows[i:])
+                break
+            self._count('replayed', len(rows[i:i + self.batch_size]))
+        try:
+            os.remove(replaying)
+        except FileNotFoundError:
+            pass
+
+    def stop(self, timeout=10):
+        """Drain the queue to the database (or the spill file) before the process exits"""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+        leftover = []
+        while True:
+            try:
+                leftover.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        if leftover:
+            self._spill(leftover)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, pending=self._queue.qsize())
+
+
+audit_writer = AuditLogWriter(
+    batch_size=app_config.AUDIT_BATCH_SIZE,
+    flush_interval=app_config.AUDIT_FLUSH_INTERVAL,
+    queue_size=app_config.AUDIT_QUEUE_SIZE,
+    spill_path=os.path.join(LOGS_DIR, 'audit_spill.jsonl')
+)
+
 def audit_log(action, user_id=None, details=None):
-    """Log user actions for security audit - saves to DB and security log file"""
+    """Log user actions for security audit - queued for the DB writer and saved to security log file"""
     try:
-        # Get IP and user agent
+        # Get IP and user agent while still inside the request
         ip_address = get_client_ip() if request else 'system'
         user_agent = get_user_agent() if request else 'system'
         
-        # Save to database with IP and user agent
-        conn = get_db_connection()
-        if conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO audit_logs (user_id, action, details, ip_address, user_agent, timestamp) VALUES (?, ?, ?, ?, ?, ?)",
-                (user_id, action, str(details), ip_address, user_agent, datetime.now().isoformat())
-            )
-            conn.commit()
-            conn.close()
-            log_db('INSERT', 'audit_logs', f"action={action}, user={user_id}")
+        audit_writer.submit((user_id, action, str(details), ip_address, user_agent, datetime.now().isoformat()))
         
         # Also write to security log file
         log_security(action, user_id, details)
@@ -419,41 +2247,287 @@ def audit_log(action, user_id=None, details=None):
 
 # ============== EMAIL FUNCTIONS ==============
 
-def send_email(to_email, subject, html_content):
-    """Send email using SMTP - config loaded from database"""
-    try:
+# send_email() only inserts the message into email_outbox and returns; one
+# background thread per process claims due rows and sends them over a single
+# SMTP session that is kept open between messages (re-opened when the SMTP
+# settings change or it has been idle for EMAIL_SMTP_IDLE_TIMEOUT seconds).
+# Failed sends are retried with exponential backoff up to EMAIL_MAX_ATTEMPTS.
+# Rows are claimed with a conditional UPDATE, so several workers can share
+# the table; a claim older than EMAIL_CLAIM_TIMEOUT is assumed to belong to a
+# crashed worker and is put back in the queue. A row's body is blanked once it
+# is Sent, Failed or Skipped - credential emails carry temporary passwords.
+
+class EmailOutbox:
+    """Persistent outbound mail queue drained by a background SMTP sender"""
+
+    def __init__(self, poll_interval, batch_size, max_attempts, retry_base_delay, retry_max_delay,
+                 smtp_timeout, smtp_idle_timeout, claim_timeout, use_tls=True):
+        self.poll_interval = poll_interval
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.smtp_timeout = smtp_timeout
+        self.smtp_idle_timeout = smtp_idle_timeout
+        self.claim_timeout = claim_timeout
+        self.use_tls = use_tls
+        self._smtp = None
+        self._smtp_key = None
+        self._smtp_used = 0.0
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counters = {'queued': 0, 'sent': 0, 'retried': 0, 'failed': 0, 'skipped': 0,
+                         'connects': 0, 'reused': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='email-outbox', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def enqueue(self, to_email, subject, html_body, purpose='general'):
+        """Store one message for delivery and return its outbox id"""
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError('Database unavailable')
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                """INSERT INTO email_outbox (to_email, subject, html_body, purpose, next_attempt_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                (to_email, subject, html_body, purpose, time.time())
+            )
+            outbox_id = cursor.lastrowid
+            conn.commit()
+        finally:
+            conn.close()
+        self._count('queued')
+        self.wake()
+        return outbox_id
+
+    def enqueue_many(self, messages):
+        """Store (to_email, subject, html_body, purpose) messages in one transaction"""
+        if not messages:
+            return 0
+        conn = get_db_connection()
+        if not conn:
+            raise RuntimeError('Database unavailable')
+        try:
+            now = time.time()
+            conn.cursor().executemany(
+                """INSERT INTO email_outbox (to_email, subject, html_body, purpose, next_attempt_at)
+                   VALUES (?, ?, ?, ?, ?)""",
+                [(to_email, subject, html_body, purpose, now) for to_email, subject, html_body, purpose in messages]
+            )
+            conn.commit()
+        finally:
+            conn.close()
+        self._count('queued', len(messages))
+        self.wake()
+        return len(messages)
+
+    def wake(self):
+        """Have the sender look for due messages now instead of at the next poll"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                while not self._stop.is_set():
+                    rows = self._claim()
+                    for row in rows:
+                        self._deliver(row)
+                    if len(rows) < self.batch_size:
+                        break
+            except Exception as e:
+                logger.error(f"Email outbox error: {e}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'email_outbox'})
+            if self._smtp is not None and time.monotonic() - self._smtp_used >= self.smtp_idle_timeout:
+                self._disconnect()
+        self._disconnect()
+
+    def _claim(self):
+        """Mark up to batch_size due messages as ours and return them"""
+        conn = get_db_connection()
+        if not conn:
+            return []
+        try:
+            cursor = conn.cursor()
+            now = time.time()
+            cursor.execute(
+                "UPDATE email_outbox SET status = 'Pending', claimed_at = NULL WHERE status = 'Sending' AND claimed_at < ?",
+                (now - self.claim_timeout,)
+            )
+            cursor.execute(
+                f"""SELECT id, to_email, subject, html_body, attempts FROM email_outbox
+                    WHERE status = 'Pending' AND next_attempt_at <= ?
+                    ORDER BY next_attempt_at, id {db_backend.limit(self.batch_size)}""",
+                (now,)
+            )
+            claimed = []
+            for row in cursor.fetchall():
+                cursor.execute(
+                    "UPDATE email_outbox SET status = 'Sending', claimed_at = ? WHERE id = ? AND status = 'Pending'",
+                    (now, row['id'])
+                )
+                if cursor.rowcount == 1:  # another worker may have taken it first
+                    claimed.append(row)
+            conn.commit()
+            return claimed
+        finally:
+            conn.close()
+
+    def _connection(self, config):
+        """The open SMTP session for these settings, connecting if needed"""
+        key = (config['SMTP_SERVER'], config['SMTP_PORT'], config['SMTP_EMAIL'], config['SMTP_PASSWORD'])
+        if self._smtp is not None and self._smtp_key == key:
+            self._count('reused')
+            return self._smtp
+        self._disconnect()
+        server = smtplib.SMTP(config['SMTP_SERVER'], config['SMTP_PORT'], timeout=self.smtp_timeout)
+        try:
+            server.ehlo()
+            if self.use_tls:
+                server.starttls()
+                server.ehlo()
+                server.login(config['SMTP_EMAIL'], config['SMTP_PASSWORD'])
+            elif server.has_extn('auth'):
+                server.login(config['SMTP_EMAIL'], config['SMTP_PASSWORD'])
+        except Exception:
+            server.close()
+            raise
+        self._smtp, self._smtp_key = server, key
+        self._count('connects')
+        return server
+
+    def _disconnect(self):
+        server, self._smtp, self._smtp_key = self._smtp, None, None
+        if server is None:
+            return
+        try:
+            server.quit()
+        except Exception:
+            server.close()
+
+    def _send(self, config, to_email, message):
+        reused = self._smtp is not None
+        try:
+            self._connection(config).sendmail(config['SMTP_EMAIL'], to_email, message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped a session we were holding open - reconnect once
+            self._disconnect()
+            if not reused:
+                raise
+            self._connection(config).sendmail(config['SMTP_EMAIL'], to_email, message)
+        self._smtp_used = time.monotonic()
+
+    def _deliver(self, row):
         config = get_email_config()
-        
         if not config['SMTP_EMAIL'] or not config['SMTP_PASSWORD']:
-            logger.warning(f"Email not configured. Would send to {to_email}: {subject}")
+            logger.warning(f"Email not configured. Would send to {row['to_email']}: {row['subject']}")
             # For development, just log the email
             print(f"\n📧 EMAIL (not sent - SMTP not configured):")
-            print(f"   To: {to_email}")
-            print(f"   Subject: {subject}")
-            print(f"   Body: {html_content[:200]}...")
-            return True  # Return True for dev testing
-        
+            print(f"   To: {row['to_email']}")
+            print(f"   Subject: {row['subject']}")
+            print(f"   Body: {row['html_body'][:200]}...")
+            self._finish(row['id'], 'Skipped', row['attempts'], 'SMTP not configured')
+            self._count('skipped')
+            return
+
         msg = MIMEMultipart('alternative')
-        msg['Subject'] = subject
+        msg['Subject'] = row['subject']
         msg['From'] = f"{config['COMPANY_NAME']} <{config['SMTP_EMAIL']}>"
-        msg['To'] = to_email
-        
-        html_part = MIMEText(html_content, 'html')
-        msg.attach(html_part)
-        
-        with smtplib.SMTP(config['SMTP_SERVER'], config['SMTP_PORT']) as server:
-            server.starttls()
-            server.login(config['SMTP_EMAIL'], config['SMTP_PASSWORD'])
-            server.sendmail(config['SMTP_EMAIL'], to_email, msg.as_string())
-        
-        logger.info(f"Email sent to {to_email}: {subject}")
-        return True
+        msg['To'] = row['to_email']
+        msg.attach(MIMEText(row['html_body'], 'html'))
+
+        attempts = row['attempts'] + 1
+        try:
+            self._send(config, row['to_email'], msg.as_string())
+        except Exception as e:
+            if not isinstance(e, smtplib.SMTPRecipientsRefused):
+                self._disconnect()  # the session may be unusable after an error
+            if isinstance(e, smtplib.SMTPRecipientsRefused) or attempts >= self.max_attempts:
+                logger.error(f"Email to {row['to_email']} failed after {attempts} attempt(s): {e}")
+                self._finish(row['id'], 'Failed', attempts, str(e))
+                self._count('failed')
+            else:
+                delay = min(self.retry_base_delay * 2 ** (attempts - 1), self.retry_max_delay)
+                logger.warning(f"Email to {row['to_email']} failed ({e}), retrying in {delay}s")
+                self._retry(row['id'], attempts, time.time() + delay, str(e))
+                self._count('retried')
+            return
+
+        self._finish(row['id'], 'Sent', attempts)
+        self._count('sent')
+        logger.info(f"Email sent to {row['to_email']}: {row['subject']}")
+
+    def _update(self, sql, params):
+        conn = get_db_connection()
+        if not conn:
+            return
+        try:
+            conn.cursor().execute(sql, params)
+            conn.commit()
+        finally:
+            conn.close()
+
+    def _finish(self, outbox_id, status, attempts, error=None):
+        """Record the final status and drop the body, which may hold a temporary password"""
+        sent_at = db_backend.now if status == 'Sent' else 'NULL'
+        self._update(
+            f"""UPDATE email_outbox SET status = ?, attempts = ?, last_error = ?, claimed_at = NULL,
+                   html_body = '', sent_at = {sent_at} WHERE id = ?""",
+            (status, attempts, error, outbox_id)
+        )
+
+    def _retry(self, outbox_id, attempts, next_attempt_at, error):
+        self._update(
+            """UPDATE email_outbox SET status = 'Pending', attempts = ?, next_attempt_at = ?,
+                   last_error = ?, claimed_at = NULL WHERE id = ?""",
+            (attempts, next_attempt_at, error, outbox_id)
+        )
+
+    def stop(self, timeout=10):
+        """Finish the message in flight and close the SMTP session; queued rows stay in the table"""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, connected=self._smtp is not None)
+
+
+email_outbox = EmailOutbox(
+    poll_interval=app_config.EMAIL_OUTBOX_POLL_INTERVAL,
+    batch_size=app_config.EMAIL_OUTBOX_BATCH_SIZE,
+    max_attempts=app_config.EMAIL_MAX_ATTEMPTS,
+    retry_base_delay=app_config.EMAIL_RETRY_BASE_DELAY,
+    retry_max_delay=app_config.EMAIL_RETRY_MAX_DELAY,
+    smtp_timeout=app_config.EMAIL_SMTP_TIMEOUT,
+    smtp_idle_timeout=app_config.EMAIL_SMTP_IDLE_TIMEOUT,
+    claim_timeout=app_config.EMAIL_CLAIM_TIMEOUT,
+    use_tls=app_config.SMTP_USE_TLS
+)
+
+def send_email(to_email, subject, html_content, purpose='general'):
+    """Queue an email for the background sender - returns the outbox id, or False if it couldn't be queued"""
+    try:
+        return email_outbox.enqueue(to_email, subject, html_content, purpose)
     except Exception as e:
-        logger.error(f"Email send error: {e}")
+        logger.error(f"Email queue error: {e}")
         return False
 
-def send_welcome_email(employee_email, employee_name, username, temp_password):
-    """Send welcome email with login credentials to new employee"""
+def welcome_email(employee_name, username, temp_password):
+    """Subject and HTML body of the new-employee credentials email"""
     config = get_email_config()
     frontend_url = config['FRONTEND_URL']
     company_name = config['COMPANY_NAME']
@@ -490,7 +2564,12 @@ def send_welcome_email(employee_email, employee_name, username, temp_password):
     </body>
     </html>
     """
-    return send_email(employee_email, subject, html_content)
+    return subject, html_content
+
+def send_welcome_email(employee_email, employee_name, username, temp_password):
+    """Send welcome email with login credentials to new employee"""
+    subject, html_content = welcome_email(employee_name, username, temp_password)
+    return send_email(employee_email, subject, html_content, purpose='welcome')
 
 def send_password_reset_email(employee_email, employee_name, username, new_password):
     """Send password reset email with new credentials"""
@@ -527,7 +2606,7 @@ def send_password_reset_email(employee_email, employee_name, username, new_passw
     </body>
     </html>
     """
-    return send_email(employee_email, subject, html_content)
+    return send_email(employee_email, subject, html_content, purpose='password_reset')
 
 def send_password_reset_link_email(employee_email, employee_name, reset_token):
     """Send password reset link email"""
@@ -572,31 +2651,224 @@ def send_password_reset_link_email(employee_email, employee_name, reset_token):
     </body>
     </html>
     """
-    return send_email(employee_email, subject, html_content)
+    return send_email(employee_email, subject, html_content, purpose='password_reset_link')
 
 def generate_temp_password(length=8):
     """Generate a temporary password"""
     return secrets.token_urlsafe(length)[:length]
 
-def role_required(*allowed_roles):
-    """Decorator to check user role permissions"""
-    def decorator(f):
-        @wraps(f)
-        @jwt_required()
-        def decorated_function(*args, **kwargs):
-            current_user = get_jwt_identity()
-            
-            # Get user role from database
-            conn = get_db_connection()
-            if not conn:
-                return jsonify({'error': 'Database connection failed'}), 500
+# ============== PASSWORD HASHING ==============
+# bcrypt is deliberately slow, so it runs in a small dedicated pool instead of
+# on the request threads. At most PASSWORD_HASH_WORKERS hashes run at once
+# and PASSWORD_HASH_MAX_PENDING more may wait; beyond that requests get an
+# immediate 503 with Retry-After rather than piling up behind the pool.
+# Worker processes are forked, so they never re-import app.py; platforms
+# without fork (Windows) use threads instead - bcrypt releases the GIL.
+# The processes are forked up front, before any thread starts (see
+# BACKGROUND SERVICES at the end of this file). A call that times out or
+# finds the pool broken gets the same 503; a broken pool is replaced with
+# threads, since forking again would copy the running threads' locks.
+
+class PasswordHasherBusy(Exception):
+    """Raised when the hashing pool and its wait queue are both full"""
+    pass
+
+class PasswordHasher:
+    """Bounded bcrypt worker pool with queue-depth and timing counters"""
+
+    def __init__(self, workers, max_pending, rounds, timeout, use_processes=True):
+        self.rounds = rounds
+        self.timeout = timeout
+        self.workers = workers
+        if use_processes and 'fork' in multiprocessing.get_all_start_methods():
+            self.kind = 'process'
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        else:
+            self.kind = 'thread'
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='bcrypt')
+        self._slots = threading.BoundedSemaphore(workers + max_pending)
+        self._lock = threading.Lock()
+        self.counters = {'hashed': 0, 'verified': 0, 'bulk_hashed': 0, 'rejected': 0, 'failed': 0, 'in_flight': 0,
+                         'total_ms': 0.0, 'max_ms': 0.0}
+
+    def start_pool(self):
+        """Fork the worker processes now rather than on the first login"""
+        if self.kind == 'process':
+            # With the fork context the first submit starts every worker at once
+            self._executor.submit(int).result()
+
+    def _pool_failed(self, error):
+        with self._lock:
+            self.counters['failed'] += 1
+            if isinstance(error, BrokenProcessPool) and self.kind == 'process':
+                self._executor.shutdown(wait=False)
+                self.kind = 'thread'
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='bcrypt')
+        logger.error(f"Password hashing pool error: {error!r}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'password_hasher'})
+
+    def _run(self, func, *args):
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise PasswordHasherBusy()
+        started = time.perf_counter()
+        with self._lock:
+            self.counters['in_flight'] += 1
+        try:
+            return self._executor.submit(func, *args).result(timeout=self.timeout)
+        except (FutureTimeoutError, BrokenProcessPool) as e:
+            self._pool_failed(e)
+            raise PasswordHasherBusy() from e
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000
+            with self._lock:
+                self.counters['in_flight'] -= 1
+                self.counters['total_ms'] += elapsed
+                self.counters['max_ms'] = max(self.counters['max_ms'], elapsed)
+            self._slots.release()
+
+    def hash(self, password):
+        """bcrypt hash (str) of a plain-text password at the configured cost"""
+        hashed = self._run(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+        with self._lock:
+            self.counters['hashed'] += 1
+        return hashed.decode('utf-8')
+
+    def hash_many(self, passwords):
+        """
+        bcrypt hashes (str) for a batch of passwords, in order. Counts as one
+        queued job, and keeps at most half the workers busy so logins and
+        password changes still get through while a bulk import runs.
+        """
+        if not self._slots.acquire(blocking=False):
+            with self._lock:
+                self.counters['rejected'] += 1
+            raise PasswordHasherBusy()
+        window = max(1, self.workers // 2)
+        hashes = [None] * len(passwords)
+        pending = {}
+        with self._lock:
+            self.counters['in_flight'] += 1
+        try:
+            for index, password in enumerate(passwords):
+                if len(pending) >= window:
+                    done, _ = wait(pending, timeout=self.timeout, return_when=FIRST_COMPLETED)
+                    if not done:
+                        raise FutureTimeoutError('bcrypt batch timed out')
+                    for future in done:
+                        hashes[pending.pop(future)] = future.result().decode('utf-8')
+                future = self._executor.submit(bcrypt.hashpw, password.encode('utf-8'), bcrypt.gensalt(self.rounds))
+                pending[future] = index
+            for future, index in pending.items():
+                hashes[index] = future.result(timeout=self.timeout).decode('utf-8')
+        except (FutureTimeoutError, BrokenProcessPool) as e:
+            self._pool_failed(e)
+            raise PasswordHasherBusy() from e
+        finally:
+            for future in pending:
+                future.cancel()
+            with self._lock:
+                self.counters['in_flight'] -= 1
+                self.counters['bulk_hashed'] += sum(1 for h in hashes if h is not None)
+            self._slots.release()
+        return hashes
+
+    def verify(self, password, password_hash):
+        matches = self._run(bcrypt.checkpw, password.encode('utf-8'), password_hash.encode('utf-8'))
+        with self._lock:
+            self.counters['verified'] += 1
+        return matches
+
+    def needs_rehash(self, password_hash):
+        """True if the hash was made with a different cost than BCRYPT_ROUNDS ($2b$<cost>$...)"""
+        try:
+            return int(password_hash.split('$')[2]) != self.rounds
+        except (IndexError, ValueError):
+            return False
+
+    def stats(self):
+        with self._lock:
+            done = self.counters['hashed'] + self.counters['verified']
+            return dict(self.counters, kind=self.kind, workers=self.workers, rounds=self.rounds,
+                        total_ms=round(self.counters['total_ms'], 1), max_ms=round(self.counters['max_ms'], 1),
+                        avg_ms=round(self.counters['total_ms'] / done, 1) if done else 0.0)
+
+
+password_hasher = PasswordHasher(
+    workers=app_config.PASSWORD_HASH_WORKERS,
+    max_pending=app_config.PASSWORD_HASH_MAX_PENDING,
+    rounds=app_config.BCRYPT_ROUNDS,
+    timeout=app_config.PASSWORD_HASH_TIMEOUT,
+    use_processes=app_config.PASSWORD_HASH_USE_PROCESSES
+)
+
+def password_hasher_busy():
+    """503 response for when the hashing pool is saturated"""
+    response = jsonify({'error': 'Server is busy, please try again in a few seconds'})
+    response.headers['Retry-After'] = str(app_config.PASSWORD_HASH_RETRY_AFTER)
+    return response, 503
+
+# ============== IDENTITY RESOLUTION ==============
+# login() signs employee_id and role into the JWT, so most requests don't need
+# to look the caller up at all. employee_id can't change for a username, so the
+# claim is trusted unless the account was deleted after the token was issued.
+# role/is_active can change at any time, so they come from IDENTITY_CACHE,
+# which HR's employee update/status/delete routes invalidate.
+
+IDENTITY_FIELDS = ('employee_id', 'username', 'full_name', 'email', 'role',
+                   'employee_category', 'shift', 'department', 'is_active', 'account_status')
+
+IDENTITY_CACHE = TTLCache(max_size=app_config.IDENTITY_CACHE_SIZE, ttl=app_config.IDENTITY_CACHE_TTL)
+
+# Deleted usernames, kept for as long as a token issued before the delete can live
+RETIRED_IDENTITIES = TTLCache(max_size=app_config.IDENTITY_CACHE_SIZE,
+                              ttl=app.config['JWT_ACCESS_TOKEN_EXPIRES'].total_seconds())
+
+def resolve_identity(username):
+    """Cached users row (IDENTITY_FIELDS) for a username, or None if there is no such user"""
+    identity = IDENTITY_CACHE.get(username)
+    if identity is not None:
+        return identity
+    conn = get_db_connection()
+    if not conn:
+        return None
+    cursor = conn.cursor()
+    cursor.execute(f"SELECT {', '.join(IDENTITY_FIELDS)} FROM users WHERE username = ?", (username,))
+    row = cursor.fetchone()
+    conn.close()
+    if not row:
+        return None
+    identity = dict(row)
+    IDENTITY_CACHE.set(username, identity)
+    return identity
+
+def get_current_employee_id():
+    """employee_id of the logged-in user, from the verified JWT claim when it can be trusted"""
+    username = get_jwt_identity()
+    employee_id = get_jwt().get('employee_id')
+    if employee_id and RETIRED_IDENTITIES.get(username) is None:
+        return employee_id
+    identity = resolve_identity(username)
+    return identity['employee_id'] if identity else None
+
+def invalidate_identity(username, deleted=False):
+    """Drop a user's cached identity after HR changes it; deleted users stop being trusted from their JWT"""
+    IDENTITY_CACHE.invalidate(username)
+    if deleted:
+        RETIRED_IDENTITIES.set(username, True)
+
+def role_required(*allowed_roles):
+    """Decorator to check user role permissions"""
+    def decorator(f):
+        @wraps(f)
+        @jwt_required()
+        def decorated_function(*args, **kwargs):
+            current_user = get_jwt_identity()
             
-            cursor = conn.cursor()
-            cursor.execute("SELECT role FROM users WHERE username = ? AND is_active = 1", (current_user,))
-            user = cursor.fetchone()
-            conn.close()
+            # Get user role (cached - see IDENTITY RESOLUTION)
+            user = resolve_identity(current_user)
             
-            if not user or user['role'] not in allowed_roles:
+            if not user or not user['is_active'] or user['role'] not in allowed_roles:
                 audit_log('UNAUTHORIZED_ACCESS_ATTEMPT', current_user, {'endpoint': request.endpoint, 'required_roles': allowed_roles})
                 return jsonify({'error': 'Insufficient permissions'}), 403
             
@@ -604,6 +2876,104 @@ def role_required(*allowed_roles):
         return decorated_function
     return decorator
 
+# ============== PAGINATION ==============
+# HR list endpoints return one page at a time, ordered on their usual sort
+# keys plus a unique tie-breaker. The cursor handed back as next_cursor is the
+# last row's key values as base64 JSON; sending it as ?cursor= returns the
+# rows strictly after it (keyset pagination - no OFFSET scan, and pages don't
+# shift when rows are added). ?limit= is capped at PAGE_SIZE_MAX, and
+# ?include_total=true adds a COUNT(*) of all matching rows.
+
+class InvalidCursor(ValueError):
+    """Raised for a ?cursor= value this endpoint didn't issue"""
+    pass
+
+def _cursor_value(value):
+    if isinstance(value, datetime):
+        return value.isoformat(sep=' ', timespec='milliseconds')  # SQL Server DATETIME precision
+    return str(value)
+
+def encode_cursor(values):
+    data = json.dumps(values, default=_cursor_value).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(token, size):
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)))
+    except (ValueError, TypeError):
+        raise InvalidCursor()
+    if not isinstance(values, list) or len(values) != size:
+        raise InvalidCursor()
+    return values
+
+def keyset_condition(sort_keys, values):
+    """WHERE fragment for rows after `values` in ORDER BY sort_keys ([(expression, 'ASC'|'DESC'), ...])"""
+    clauses, params = [], []
+    for i, (expression, direction) in enumerate(sort_keys):
+        parts = [f"{previous} = ?" for previous, _ in sort_keys[:i]]
+        parts.append(f"{expression} {'>' if direction == 'ASC' else '<'} ?")
+        clauses.append('(' + ' AND '.join(parts) + ')')
+        params.extend(values[:i + 1])
+    return '(' + ' OR '.join(clauses) + ')', params
+
+def paginate(cursor, query, params, sort_keys, key_columns):
+    """
+    Fetch one page of `query` (a SELECT ending in its WHERE clause) for the
+    current request's ?limit=/?cursor=/?include_total=. key_columns name the
+    result columns holding the sort_keys values. Returns (rows, page_info).
+    """
+    limit = request.args.get('limit', app_config.PAGE_SIZE_DEFAULT, type=int)
+    limit = max(1, min(limit, app_config.PAGE_SIZE_MAX))
+    page_info = {'limit': limit}
+    
+    if request.args.get('include_total', 'false').lower() == 'true':
+        cursor.execute(f"SELECT COUNT(*) AS total FROM ({query}) matching", params)
+        page_info['total'] = cursor.fetchone()['total']
+    
+    params = list(params)
+    token = request.args.get('cursor')
+    if token:
+        condition, condition_params = keyset_condition(sort_keys, decode_cursor(token, len(sort_keys)))
+        query += f" AND {condition}"
+        params += condition_params
+    
+    order_by = ', '.join(f"{expression} {direction}" for expression, direction in sort_keys)
+    cursor.execute(f"{query} ORDER BY {order_by} {db_backend.limit(limit + 1)}", params)
+    rows = cursor.fetchall()
+    
+    page_info['has_more'] = len(rows) > limit
+    rows = rows[:limit]
+    page_info['next_cursor'] = encode_cursor([rows[-1][c] for c in key_columns]) if page_info['has_more'] else None
+    return rows, page_info
+
+def invalid_cursor():
+    return jsonify({'error': 'Invalid cursor - restart from the first page'}), 400
+
+# Attendance filter dropdowns (departments, shifts) change rarely - cached
+# apart from the paged data and dropped whenever an employee is added or edited
+FILTER_OPTIONS_CACHE = TTLCache(max_size=4, ttl=app_config.FILTER_OPTIONS_TTL)
+
+def attendance_filter_options():
+    """Departments, shifts and statuses offered as HR attendance filters"""
+    options = FILTER_OPTIONS_CACHE.get('attendance')
+    if options is None:
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            cursor.execute("SELECT DISTINCT department FROM users WHERE department IS NOT NULL AND department != ''")
+            departments = [row['department'] for row in cursor.fetchall()]
+            cursor.execute("SELECT DISTINCT shift FROM users WHERE shift IS NOT NULL AND shift != ''")
+            shifts = [row['shift'] for row in cursor.fetchall()]
+        finally:
+            conn.close()
+        options = {
+            'departments': departments,
+            'shifts': shifts,
+            'statuses': ['Present', 'Absent', 'Late', 'Half-Day', 'On Leave']
+        }
+        FILTER_OPTIONS_CACHE.set('attendance', options)
+    return options
+
 # Authentication Routes
 @app.route('/api/login', methods=['POST'])
 @limiter.limit("5 per minute")
@@ -647,11 +3017,22 @@ def login():
             audit_log('LOGIN_FAILED', username, {'reason': 'Account blocked'})
             return jsonify({'error': 'Account is blocked. Please contact administrator.'}), 401
         
-        if not bcrypt.checkpw(password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+        if not password_hasher.verify(password, user['password_hash']):
             conn.close()
             audit_log('LOGIN_FAILED', username, {'reason': 'Invalid password'})
             return jsonify({'error': 'Invalid credentials'}), 401
         
+        # Upgrade hashes made with an older BCRYPT_ROUNDS while we have the plain password
+        if password_hasher.needs_rehash(user['password_hash']):
+            try:
+                cursor.execute(
+                    "UPDATE users SET password_hash = ? WHERE username = ?",
+                    (password_hasher.hash(password), user['username'])
+                )
+                conn.commit()
+            except PasswordHasherBusy:
+                pass  # try again on a quieter login
+        
         # Check for active session on another device (for HR, Admin, MD roles)
         active_session = user['active_session_id'] if 'active_session_id' in user.keys() else None
         if user['role'] in ('HR', 'Admin', 'MD') and active_session and not force_login:
@@ -667,9 +3048,12 @@ def login():
         import uuid
         session_id = str(uuid.uuid4())
         
-        # If force login, blacklist the old session
+        # If force login, revoke every token issued to the old session
         if active_session and force_login:
-            blacklisted_tokens.add(active_session)
+            token_revocations.revoke(
+                active_session,
+                time.time() + app.config['JWT_REFRESH_TOKEN_EXPIRES'].total_seconds()
+            )
             audit_log('FORCE_LOGOUT', username, {'reason': 'Logged in from new device'})
         
         # Update active session in database for HR/Admin/MD
@@ -719,6 +3103,8 @@ def login():
             }
         }), 200
         
+    except PasswordHasherBusy:
+        return password_hasher_busy()
     except Exception as e:
         logger.error(f"Login error: {e}")
         return jsonify({'error': 'Login failed'}), 500
@@ -726,10 +3112,10 @@ def login():
 @app.route('/api/logout', methods=['POST'])
 @jwt_required()
 def logout():
-    """Logout user and blacklist token"""
+    """Logout user and revoke token"""
     try:
         jti = get_jwt()['jti']
-        blacklisted_tokens.add(jti)
+        token_revocations.revoke(jti, get_jwt()['exp'])
         
         user_id = get_jwt_identity()
         jwt_data = get_jwt()
@@ -944,7 +3330,7 @@ def reset_password():
                 return jsonify({'error': 'Reset token has expired. Please request a new one.'}), 400
         
         # Hash new password and update
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = password_hasher.hash(new_password)
         
         cursor.execute(
             """UPDATE users 
@@ -953,7 +3339,7 @@ def reset_password():
                    reset_token_expiry = NULL,
                    must_change_password = 0
                WHERE id = ?""",
-            (hashed_password.decode('utf-8'), user['id'])
+            (hashed_password, user['id'])
         )
         conn.commit()
         conn.close()
@@ -964,6 +3350,8 @@ def reset_password():
             'message': 'Password has been reset successfully. You can now login with your new password.'
         }), 200
         
+    except PasswordHasherBusy:
+        return password_hasher_busy()
     except Exception as e:
         logger.error(f"Reset password error: {e}")
         return jsonify({'error': 'Failed to reset password'}), 500
@@ -1004,18 +3392,18 @@ def change_password():
             return jsonify({'error': 'User not found'}), 404
         
         # Verify current password
-        if not bcrypt.checkpw(current_password.encode('utf-8'), user['password_hash'].encode('utf-8')):
+        if not password_hasher.verify(current_password, user['password_hash']):
             conn.close()
             return jsonify({'error': 'Current password is incorrect'}), 401
         
         # Hash and update new password
-        hashed_password = bcrypt.hashpw(new_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = password_hasher.hash(new_password)
         
         cursor.execute(
             """UPDATE users 
                SET password_hash = ?, must_change_password = 0 
                WHERE id = ?""",
-            (hashed_password.decode('utf-8'), user['id'])
+            (hashed_password, user['id'])
         )
         conn.commit()
         conn.close()
@@ -1026,6 +3414,8 @@ def change_password():
             'message': 'Password changed successfully'
         }), 200
         
+    except PasswordHasherBusy:
+        return password_hasher_busy()
     except Exception as e:
         logger.error(f"Change password error: {e}")
         return jsonify({'error': 'Failed to change password'}), 500
@@ -1073,39 +3463,42 @@ def resend_credentials():
         
         # Generate new temporary password
         temp_password = generate_temp_password()
-        hashed_password = bcrypt.hashpw(temp_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = password_hasher.hash(temp_password)
         
         # Update password and set must_change_password flag
         cursor.execute(
             """UPDATE users 
                SET password_hash = ?, must_change_password = 1 
                WHERE id = ?""",
-            (hashed_password.decode('utf-8'), employee['id'])
+            (hashed_password, employee['id'])
         )
         conn.commit()
         conn.close()
         
         # Send welcome email with new credentials
         try:
-            send_welcome_email(
+            if not send_welcome_email(
+                employee_email=employee['email'],
                 employee_name=employee['full_name'],
-                email=employee['email'],
                 username=employee['username'],
                 temp_password=temp_password
-            )
+            ):
+                raise RuntimeError('email could not be queued')
             audit_log('CREDENTIALS_RESENT', current_user, {
                 'target_employee': employee_id,
                 'target_username': employee['username']
             })
             
             return jsonify({
-                'message': f"Credentials sent successfully to {employee['email']}"
+                'message': f"Credentials queued for delivery to {employee['email']}"
             }), 200
             
         except Exception as email_error:
             logger.error(f"Failed to send credentials email: {email_error}")
             return jsonify({'error': 'Failed to send email. Please try again.'}), 500
         
+    except PasswordHasherBusy:
+        return password_hasher_busy()
     except Exception as e:
         logger.error(f"Resend credentials error: {e}")
         return jsonify({'error': 'Failed to resend credentials'}), 500
@@ -1117,35 +3510,30 @@ def resend_credentials():
 def get_personal_attendance():
     """Get employee's personal attendance records"""
     try:
-        username = get_jwt_identity()
         days = request.args.get('days', 30, type=int)
         
-        # Get employee_id from username
         conn = get_db_connection()
         if not conn:
             return jsonify({'error': 'Database connection failed'}), 500
         
         cursor = conn.cursor()
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        employee_id = get_current_employee_id()
         
-        if not user:
+        if not employee_id:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
-        employee_id = user['employee_id']
-        
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT date, clock_in, clock_out, status, hours_worked, notes
             FROM attendance 
-            WHERE employee_id = ? AND date >= date('now', '-' || ? || ' days')
+            WHERE employee_id = ? AND date >= {db_backend.days_ago()}
             ORDER BY date DESC
         """, (employee_id, days))
         
         records = cursor.fetchall()
         conn.close()
         
-        # Convert sqlite3.Row objects to dictionaries
+        # Convert row objects to dictionaries
         records = [dict(record) for record in records]
         
         return jsonify({'attendance': records}), 200
@@ -1159,6 +3547,274 @@ OFFICE_START_TIME = "09:00"  # 9:00 AM
 OFFICE_END_TIME = "18:00"    # 6:00 PM
 LATE_THRESHOLD_MINUTES = 15  # Late if check-in after 9:15 AM
 EARLY_THRESHOLD_MINUTES = 30 # Early leave if checkout before 5:30 PM
+HALF_DAY_HOURS = 4           # Fewer hours worked than this is a Half-Day
+MAX_SESSION_HOURS = 20       # An open check-in older than this can't be checked out any more
+SESSION_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+def shift_window(work_date, shift=None):
+    """(start, end) datetimes of the employee's shift on work_date - office hours without a shift"""
+    start, end = app_config.SHIFT_TIMINGS.get(str(shift), (OFFICE_START_TIME, OFFICE_END_TIME)) if shift else (OFFICE_START_TIME, OFFICE_END_TIME)
+    shift_start = datetime.strptime(f"{work_date} {start}", '%Y-%m-%d %H:%M')
+    shift_end = datetime.strptime(f"{work_date} {end}", '%Y-%m-%d %H:%M')
+    if shift_end <= shift_start:
+        shift_end += timedelta(days=1)  # night shift finishes the next morning
+    return shift_start, shift_end
+
+def work_date_for(moment, shift=None):
+    """
+    The work date a check-in/out at `moment` belongs to. A shift's day starts
+    PUNCH_EARLY_HOURS before the shift does, so 00:30 or 06:00 still belongs
+    to the night shift that started at 22:00 the day before.
+    """
+    shift_start, _ = shift_window(moment.strftime('%Y-%m-%d'), shift)
+    day_offset = timedelta(hours=shift_start.hour - app_config.PUNCH_EARLY_HOURS, minutes=shift_start.minute)
+    return (moment - day_offset).strftime('%Y-%m-%d')
+
+def session_times(work_date, clock_in, clock_out=None):
+    """
+    (clock_in_at, clock_out_at) datetimes of a session from its work date and
+    HH:MM[:SS] times - a clock-out earlier than the clock-in is the next day.
+    """
+    def at(clock):
+        if not clock:
+            return None
+        return datetime.strptime(f"{work_date} {clock}", '%Y-%m-%d %H:%M:%S' if str(clock).count(':') == 2 else '%Y-%m-%d %H:%M')
+    clock_in_at, clock_out_at = at(clock_in), at(clock_out)
+    if clock_in_at and clock_out_at and clock_out_at < clock_in_at:
+        clock_out_at += timedelta(days=1)
+    return clock_in_at, clock_out_at
+
+def minutes_late(clock_in, shift_start):
+    """Minutes after the shift start, or 0 when within LATE_THRESHOLD_MINUTES"""
+    if clock_in > shift_start + timedelta(minutes=LATE_THRESHOLD_MINUTES):
+        return int((clock_in - shift_start).total_seconds() / 60)
+    return 0
+
+def minutes_early(clock_out, shift_end):
+    """Minutes before the shift end, or 0 when within EARLY_THRESHOLD_MINUTES"""
+    if clock_out < shift_end - timedelta(minutes=EARLY_THRESHOLD_MINUTES):
+        return int((shift_end - clock_out).total_seconds() / 60)
+    return 0
+
+def session_flags(work_date, shift, clock_in_at, clock_out_at):
+    """(is_late, late_by_minutes, is_early_leave, early_by_minutes) of a session against the employee's shift"""
+    shift_start, shift_end = shift_window(work_date, shift)
+    late_by_minutes = minutes_late(clock_in_at, shift_start) if clock_in_at else 0
+    early_by_minutes = minutes_early(clock_out_at, shift_end) if clock_out_at else 0
+    return int(late_by_minutes > 0), late_by_minutes, int(early_by_minutes > 0), early_by_minutes
+
+# ============== CHECK-IN INGESTION ==============
+# At shift start hundreds of check-ins arrive within minutes and each one is a
+# small write. Requests hand their check-in to one writer thread, which
+# applies everything that arrived within CHECKIN_BATCH_WINDOW_MS - attendance
+# row plus meal token - and commits it as a single transaction, then wakes
+# each request with its own result. If a batch fails it is replayed one
+# check-in per transaction so one bad row can't fail its neighbours.
+
+MEAL_TYPE_BY_SHIFT = {'1': 'Lunch', '2': 'Dinner', '3': 'Breakfast'}
+MEAL_TOKEN_CATEGORIES = ('W001', 'M001')
+
+MEAL_TOKEN_ISSUE_SQL = db_backend.insert_ignore(
+    'meal_tokens', ['employee_id', 'token_date', 'shift', 'meal_type', 'employee_category', 'status'],
+    ['employee_id', 'token_date'])
+
+class CheckIn:
+    """One queued check-in and the slot its request waits on"""
+    __slots__ = ('employee_id', 'date', 'time', 'timestamp', 'notes', 'late_by_minutes', 'meal',
+                 'state', 'result', 'error', 'done')
+
+    def __init__(self, employee_id, date, time, timestamp, notes, late_by_minutes=0, meal=None):
+        self.employee_id = employee_id
+        self.date = date  # work date - the day the shift started
+        self.time = time
+        self.timestamp = timestamp  # full check-in datetime
+        self.notes = notes
+        self.late_by_minutes = late_by_minutes
+        self.meal = meal  # (shift, meal_type, employee_category) for token-eligible employees
+        self.state = None  # 'claimed' once the writer takes it, 'abandoned' if its request gave up first
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class CheckInQueueFull(Exception):
+    """The writer is too far behind to accept another check-in"""
+
+
+class CheckInWriter:
+    """Single writer thread that group-commits check-ins"""
+
+    def __init__(self, enabled, batch_window, batch_size, queue_size, timeout):
+        self.enabled = enabled
+        self.batch_window = batch_window
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counters = {'submitted': 0, 'committed': 0, 'batches': 0, 'largest_batch': 0,
+                         'already_checked_in': 0, 'meal_tokens': 0, 'retried': 0, 'failed': 0, 'rejected': 0,
+                         'abandoned': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def start(self):
+        if not self.enabled:
+            return
+        self._thread = threading.Thread(target=self._run, name='checkin-writer', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def submit(self, item):
+        """Record one check-in and return its result dict (raises on failure)"""
+        self._count('submitted')
+        if self._thread is None:
+            self._write([item])
+        else:
+            try:
+                self._queue.put_nowait(item)
+            except queue.Full:
+                self._count('rejected')
+                raise CheckInQueueFull()
+            if not item.done.wait(self.timeout):
+                # Give up only if the writer hasn't taken it yet, so a check-in
+                # the client is told to retry is never written afterwards
+                with self._lock:
+                    if item.state is None:
+                        item.state = 'abandoned'
+                if item.state == 'abandoned':
+                    self._count('abandoned')
+                    raise TimeoutError('Check-in was not committed in time')
+                item.done.wait()
+        if item.error:
+            raise item.error
+        return item.result
+
+    def _run(self):
+        while not self._stop.is_set() or not self._queue.empty():
+            batch = self._collect()
+            if batch:
+                self._flush(batch)
+
+    def _collect(self):
+        """Block for the first check-in, then take whatever else arrives within the batch window"""
+        try:
+            batch = [self._queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + self.batch_window
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _flush(self, batch):
+        try:
+            self._write(batch)
+        except Exception as e:
+            logger.warning(f"Check-in batch of {len(batch)} failed, retrying individually: {e}")
+            self._count('retried', len(batch))
+            for item in batch:
+                try:
+                    self._write([item])
+                except Exception as item_error:
+                    logger.error(f"Check-in write error for {item.employee_id}: {item_error}",
+                                 extra={'user': item.employee_id, 'ip': '-', 'endpoint': 'checkin_writer'})
+                    self._count('failed')
+                    item.error = item_error
+                    item.done.set()
+
+    def _write(self, batch):
+        """Apply `batch` in one transaction; results are only handed out after the commit"""
+        with self._lock:
+            batch = [item for item in batch if item.state != 'abandoned']
+            for item in batch:
+                item.state = 'claimed'
+        if not batch:
+            return
+        conn = get_db_connection(request_scoped=False)
+        if not conn:
+            raise RuntimeError('Database connection failed')
+        try:
+            cursor = conn.cursor()
+            results = [self._apply(cursor, item) for item in batch]
+            refresh_attendance_rollups(cursor, [(item.employee_id, item.date) for item, result in zip(batch, results)
+                                                if not result.get('already_checked_in')])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        with self._lock:
+            self.counters['committed'] += len(batch)
+            self.counters['batches'] += 1
+            self.counters['largest_batch'] = max(self.counters['largest_batch'], len(batch))
+        for item, result in zip(batch, results):
+            item.result = result
+            item.done.set()
+
+    def _apply(self, cursor, item):
+        cursor.execute(
+            "SELECT id, clock_in FROM attendance WHERE employee_id = ? AND date = ?",
+            (item.employee_id, item.date)
+        )
+        existing = cursor.fetchone()
+        if existing and existing['clock_in']:
+            self._count('already_checked_in')
+            return {'already_checked_in': existing['clock_in']}
+
+        is_late = int(item.late_by_minutes > 0)
+        if existing:
+            cursor.execute("""
+                UPDATE attendance SET clock_in = ?, clock_in_at = ?, status = 'Present', notes = ?,
+                                      is_late = ?, late_by_minutes = ?, updated_at = ?
+                WHERE id = ?
+            """, (item.time, item.timestamp, item.notes, is_late, item.late_by_minutes, item.timestamp, existing['id']))
+        else:
+            cursor.execute("""
+                INSERT INTO attendance (employee_id, date, clock_in, clock_in_at, status, notes, is_late, late_by_minutes)
+                VALUES (?, ?, ?, ?, 'Present', ?, ?, ?)
+            """, (item.employee_id, item.date, item.time, item.timestamp, item.notes, is_late, item.late_by_minutes))
+
+        meal_token = None
+        if item.meal:
+            shift, meal_type, category = item.meal
+            cursor.execute(MEAL_TOKEN_ISSUE_SQL, (item.employee_id, item.date, shift, meal_type, category, 'Issued'))
+            if cursor.rowcount == 1:
+                self._count('meal_tokens')
+                meal_token = {
+                    'token_id': f"MTK-{item.date.replace('-', '')}-{item.employee_id}",
+                    'meal_type': meal_type,
+                    'shift': shift
+                }
+        return {'meal_token': meal_token}
+
+    def stop(self, timeout=10):
+        """Commit what is already queued before the process exits"""
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, enabled=self._thread is not None, pending=self._queue.qsize())
+
+
+checkin_writer = CheckInWriter(
+    enabled=app_config.CHECKIN_GROUP_COMMIT,
+    batch_window=app_config.CHECKIN_BATCH_WINDOW_MS / 1000,
+    batch_size=app_config.CHECKIN_BATCH_SIZE,
+    queue_size=app_config.CHECKIN_QUEUE_SIZE,
+    timeout=app_config.CHECKIN_TIMEOUT
+)
 
 @app.route('/api/attendance/check-in', methods=['POST'])
 @jwt_required()
@@ -1167,119 +3823,56 @@ def check_in():
     try:
         username = get_jwt_identity()
         now = datetime.now()
-        today = now.strftime('%Y-%m-%d')
         current_time = now.strftime('%H:%M:%S')
         
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database connection failed'}), 500
-        
-        cursor = conn.cursor()
-        
-        # Get employee_id
-        cursor.execute("SELECT employee_id, full_name FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
-            conn.close()
             return jsonify({'error': 'User not found'}), 404
         
-        employee_id = user['employee_id']
-        
-        # Check if already checked in today
-        cursor.execute(
-            "SELECT id, clock_in FROM attendance WHERE employee_id = ? AND date = ?",
-            (employee_id, today)
-        )
-        existing = cursor.fetchone()
-        
-        if existing and existing['clock_in']:
-            conn.close()
-            return jsonify({
-                'error': 'Already checked in today',
-                'check_in_time': existing['clock_in']
-            }), 409
-        
-        # Determine if late
-        office_start = datetime.strptime(f"{today} {OFFICE_START_TIME}", '%Y-%m-%d %H:%M')
-        late_threshold = office_start + timedelta(minutes=LATE_THRESHOLD_MINUTES)
-        is_late = now > late_threshold
-        late_by_minutes = int((now - office_start).total_seconds() / 60) if is_late else 0
+        # The record belongs to the day the shift starts, even after midnight
+        work_date = work_date_for(now, user['shift'])
         
-        status = 'Present'
+        # Determine if late against the employee's shift (office hours for staff)
+        shift_start, _ = shift_window(work_date, user['shift'])
+        late_by_minutes = minutes_late(now, shift_start)
+        is_late = late_by_minutes > 0
         notes = f"Late by {late_by_minutes} minutes" if is_late else "On time"
         
-        if existing:
-            # Update existing record
-            cursor.execute("""
-                UPDATE attendance SET clock_in = ?, status = ?, notes = ?, updated_at = ?
-                WHERE employee_id = ? AND date = ?
-            """, (current_time, status, notes, now.isoformat(), employee_id, today))
-        else:
-            # Insert new record
-            cursor.execute("""
-                INSERT INTO attendance (employee_id, date, clock_in, status, notes)
-                VALUES (?, ?, ?, ?, ?)
-            """, (employee_id, today, current_time, status, notes))
-        
-        conn.commit()
-        
-        # Auto-generate meal token for eligible employees
-        meal_token_generated = False
-        meal_token_info = None
+        # Workers and migrant workers get a meal token for their shift with the check-in
+        meal = None
+        if user['employee_category'] in MEAL_TOKEN_CATEGORIES:
+            shift = str(user['shift'] or 1)
+            meal = (shift, MEAL_TYPE_BY_SHIFT.get(shift, 'Lunch'), user['employee_category'])
         
         try:
-            # Check if employee is eligible for meal tokens
-            cursor.execute("""
-                SELECT employee_category, shift, full_name 
-                FROM users WHERE username = ?
-            """, (username,))
-            user_info = cursor.fetchone()
-            
-            if user_info and user_info['employee_category'] in ('W001', 'M001'):
-                shift = user_info['shift'] or 1
-                meal_type_map = {1: 'Lunch', 2: 'Dinner', 3: 'Breakfast'}
-                meal_type = meal_type_map.get(shift, 'Lunch')
-                
-                # Check if token already exists for today
-                cursor.execute("""
-                    SELECT id FROM meal_tokens 
-                    WHERE employee_id = ? AND token_date = ?
-                """, (employee_id, today))
-                existing_token = cursor.fetchone()
-                
-                if not existing_token:
-                    # Generate token automatically
-                    token_id = f"MTK-{today.replace('-', '')}-{employee_id}"
-                    cursor.execute("""
-                        INSERT INTO meal_tokens (employee_id, token_date, shift, meal_type, status, generated_at)
-                        VALUES (?, ?, ?, ?, 'Issued', datetime('now'))
-                    """, (employee_id, today, shift, meal_type))
-                    conn.commit()
-                    meal_token_generated = True
-                    meal_token_info = {
-                        'token_id': token_id,
-                        'meal_type': meal_type,
-                        'shift': shift
-                    }
-                    logger.info(f"Auto-generated meal token for {employee_id}")
-        except Exception as token_error:
-            logger.warning(f"Failed to auto-generate meal token: {token_error}")
-        
-        conn.close()
+            result = checkin_writer.submit(
+                CheckIn(user['employee_id'], work_date, current_time, now.strftime(SESSION_TIME_FORMAT), notes,
+                        late_by_minutes, meal))
+        except (CheckInQueueFull, TimeoutError):
+            response = jsonify({'error': 'Check-in service is busy, please try again'})
+            response.headers['Retry-After'] = '2'
+            return response, 503
+        
+        if result.get('already_checked_in'):
+            return jsonify({
+                'error': 'Already checked in today',
+                'check_in_time': result['already_checked_in']
+            }), 409
         
         audit_log('CHECK_IN', username, {'time': current_time, 'is_late': is_late})
         
         response_data = {
             'message': 'Check-in successful',
+            'date': work_date,
             'check_in_time': current_time,
             'is_late': is_late,
             'late_by_minutes': late_by_minutes,
             'notes': notes
         }
         
-        if meal_token_generated:
-            response_data['meal_token'] = meal_token_info
+        if result['meal_token']:
+            response_data['meal_token'] = result['meal_token']
             response_data['message'] += ' - Meal token generated!'
         
         return jsonify(response_data), 200
@@ -1295,7 +3888,6 @@ def check_out():
     try:
         username = get_jwt_identity()
         now = datetime.now()
-        today = now.strftime('%Y-%m-%d')
         current_time = now.strftime('%H:%M:%S')
         
         conn = get_db_connection()
@@ -1305,8 +3897,7 @@ def check_out():
         cursor = conn.cursor()
         
         # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
@@ -1314,38 +3905,47 @@ def check_out():
         
         employee_id = user['employee_id']
         
-        # Check if checked in today
-        cursor.execute(
-            "SELECT id, clock_in, clock_out FROM attendance WHERE employee_id = ? AND date = ?",
-            (employee_id, today)
-        )
+        # This work date's session, or one from the work date before that is
+        # still open - a night shift checks out the morning after it checked in
+        work_date = work_date_for(now, user['shift'])
+        previous_date = (datetime.strptime(work_date, '%Y-%m-%d') - timedelta(days=1)).strftime('%Y-%m-%d')
+        session_sql = """
+            SELECT id, date, clock_in, clock_in_at, clock_out, notes FROM attendance
+            WHERE employee_id = ? AND date = ? AND clock_in IS NOT NULL
+        """
+        cursor.execute(session_sql, (employee_id, work_date))
         existing = cursor.fetchone()
+        if not existing:
+            cursor.execute(session_sql + " AND clock_out IS NULL", (employee_id, previous_date))
+            existing = cursor.fetchone()
         
-        if not existing or not existing['clock_in']:
-            conn.close()
-            return jsonify({'error': 'No check-in record found for today'}), 400
-        
-        if existing['clock_out']:
+        if existing and existing['clock_out']:
             conn.close()
             return jsonify({
                 'error': 'Already checked out today',
                 'check_out_time': existing['clock_out']
             }), 409
         
-        # Calculate hours worked
-        check_in_time = datetime.strptime(f"{today} {existing['clock_in']}", '%Y-%m-%d %H:%M:%S')
-        hours_worked = round((now - check_in_time).total_seconds() / 3600, 2)
+        clock_in_at = None
+        if existing:
+            clock_in_at = existing['clock_in_at'] or session_times(existing['date'], existing['clock_in'])[0]
+            if isinstance(clock_in_at, str):
+                clock_in_at = datetime.fromisoformat(clock_in_at)
+        
+        if not clock_in_at or now - clock_in_at > timedelta(hours=MAX_SESSION_HOURS):
+            conn.close()
+            return jsonify({'error': 'No check-in record found for today'}), 400
         
-        # Determine if early leave
-        office_end = datetime.strptime(f"{today} {OFFICE_END_TIME}", '%Y-%m-%d %H:%M')
-        early_threshold = office_end - timedelta(minutes=EARLY_THRESHOLD_MINUTES)
-        is_early = now < early_threshold
-        early_by_minutes = int((office_end - now).total_seconds() / 60) if is_early else 0
+        # Calculate hours worked from the full check-in timestamp
+        hours_worked = round((now - clock_in_at).total_seconds() / 3600, 2)
+        
+        # Determine if early leave against the employee's shift (office hours for staff)
+        _, shift_end = shift_window(existing['date'], user['shift'])
+        early_by_minutes = minutes_early(now, shift_end)
+        is_early = early_by_minutes > 0
         
         # Update notes
-        cursor.execute("SELECT notes FROM attendance WHERE id = ?", (existing['id'],))
-        current_record = cursor.fetchone()
-        existing_notes = current_record['notes'] if current_record else ''
+        existing_notes = existing['notes'] or ''
         
         if is_early:
             notes = f"{existing_notes} | Early leave by {early_by_minutes} minutes"
@@ -1353,12 +3953,15 @@ def check_out():
             notes = f"{existing_notes} | Regular checkout"
         
         # Determine final status based on hours
-        status = 'Present' if hours_worked >= 4 else 'Half-Day'
+        status = 'Present' if hours_worked >= HALF_DAY_HOURS else 'Half-Day'
         
         cursor.execute("""
-            UPDATE attendance SET clock_out = ?, hours_worked = ?, status = ?, notes = ?, updated_at = ?
+            UPDATE attendance SET clock_out = ?, clock_out_at = ?, hours_worked = ?, status = ?, notes = ?,
+                                  is_early_leave = ?, early_by_minutes = ?, updated_at = ?
             WHERE id = ?
-        """, (current_time, hours_worked, status, notes, now.isoformat(), existing['id']))
+        """, (current_time, now.strftime(SESSION_TIME_FORMAT), hours_worked, status, notes,
+              int(is_early), early_by_minutes, now.isoformat(), existing['id']))
+        refresh_attendance_rollups(cursor, [(employee_id, existing['date'])])
         
         conn.commit()
         conn.close()
@@ -1367,6 +3970,7 @@ def check_out():
         
         return jsonify({
             'message': 'Check-out successful',
+            'date': existing['date'],
             'check_out_time': current_time,
             'hours_worked': hours_worked,
             'is_early': is_early,
@@ -1384,7 +3988,6 @@ def get_today_attendance():
     """Get today's attendance status for current user"""
     try:
         username = get_jwt_identity()
-        today = datetime.now().strftime('%Y-%m-%d')
         
         conn = get_db_connection()
         if not conn:
@@ -1393,14 +3996,15 @@ def get_today_attendance():
         cursor = conn.cursor()
         
         # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
         employee_id = user['employee_id']
+        # A night shift's "today" is the day its shift started
+        today = work_date_for(datetime.now(), user['shift'])
         
         # Get today's record
         cursor.execute("""
@@ -1450,72 +4054,39 @@ def get_attendance_summary():
         cursor = conn.cursor()
         
         # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        employee_id = get_current_employee_id()
         
-        if not user:
+        if not employee_id:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
-        employee_id = user['employee_id']
-        
-        # Get attendance records for the month
-        cursor.execute("""
-            SELECT status, COUNT(*) as count
-            FROM attendance 
-            WHERE employee_id = ? 
-              AND strftime('%m', date) = ? 
-              AND strftime('%Y', date) = ?
-            GROUP BY status
-        """, (employee_id, str(month).zfill(2), str(year)))
-        
-        status_counts = cursor.fetchall()
-        
-        # Get total hours and late/early stats
-        cursor.execute("""
-            SELECT 
-                SUM(hours_worked) as total_hours,
-                COUNT(CASE WHEN notes LIKE '%Late%' THEN 1 END) as late_days,
-                COUNT(CASE WHEN notes LIKE '%Early leave%' THEN 1 END) as early_leaves
-            FROM attendance 
-            WHERE employee_id = ? 
-              AND strftime('%m', date) = ? 
-              AND strftime('%Y', date) = ?
-        """, (employee_id, str(month).zfill(2), str(year)))
-        
+        # The month's counts, kept up to date by every attendance write
+        cursor.execute(ATTENDANCE_MONTH_ROLLUP_SQL, (employee_id, f"{year}-{month:02d}"))
         stats = cursor.fetchone()
         conn.close()
         
-        # Calculate working days in month (excluding weekends)
-        import calendar
-        cal = calendar.Calendar()
-        working_days = sum(1 for day in cal.itermonthdays2(year, month) 
-                         if day[0] != 0 and day[1] < 5)  # Mon-Fri
+        # Working days for this employee's category/shift, holidays excluded
+        identity = resolve_identity(username) or {}
+        working_days = work_calendar.working_days(f"{year}-{month:02d}", identity.get('employee_category'), identity.get('shift'))
         
         # Build summary
+        stats = dict(stats) if stats else {}
         summary = {
-            'present': 0,
-            'absent': 0,
-            'half_day': 0,
-            'leave': 0,
-            'overtime': 0
+            'present': stats.get('present_days', 0),
+            'absent': stats.get('absent_days', 0),
+            'half_day': stats.get('half_days', 0),
+            'leave': stats.get('leave_days', 0),
+            'overtime': stats.get('ot_days', 0)
         }
         
-        for row in status_counts:
-            status_key = row['status'].lower().replace('-', '_') if row['status'] else 'absent'
-            if status_key == 'ot':
-                status_key = 'overtime'
-            if status_key in summary:
-                summary[status_key] = row['count']
-        
         return jsonify({
             'month': month,
             'year': year,
             'working_days': working_days,
             'summary': summary,
-            'total_hours': round(stats['total_hours'] or 0, 2),
-            'late_days': stats['late_days'] or 0,
-            'early_leaves': stats['early_leaves'] or 0,
+            'total_hours': round(float(stats.get('total_hours') or 0), 2),
+            'late_days': stats.get('late_days', 0),
+            'early_leaves': stats.get('early_days', 0),
             'attendance_rate': round((summary['present'] / working_days * 100) if working_days > 0 else 0, 1)
         }), 200
         
@@ -1532,6 +4103,76 @@ LEAVE_TYPES = {
     'LOP': {'name': 'Loss of Pay', 'max_per_year': 999, 'max_per_month': 30, 'advance_notice_days': 0},
 }
 
+# ---- Leave ledger ----
+# Every change to a leave request's standing appends a row to leave_ledger
+# (SUBMITTED, APPROVED, REJECTED, CANCELLED) and, in the same transaction,
+# rolls its deltas into leave_totals - one row per employee/year/month/type,
+# plus a leave_month = 0 row for the whole year. Limit and balance checks are
+# then primary-key lookups. A request counts against the month of its
+# start_date. leave_balances holds the yearly allowances; days used come from
+# leave_totals.approved_days.
+
+LEAVE_ALLOWANCE_FIELDS = {'CL': 'casual_leave_total', 'SL': 'sick_leave_total', 'EL': 'earned_leave_total'}
+
+LEAVE_TOTALS_SEED_SQL = db_backend.insert_ignore(
+    'leave_totals', ('employee_id', 'leave_year', 'leave_month', 'leave_type'),
+    key_columns=('employee_id', 'leave_year', 'leave_month', 'leave_type')
+)
+
+def post_leave_entry(cursor, leave, event, pending_delta, approved_delta, actor, month_limit=None):
+    """
+    Append a ledger entry for a leave_applications row and apply it to
+    leave_totals. With month_limit, the month's pending + approved days must
+    stay within it - checked and applied in one UPDATE so concurrent requests
+    can't both slip under the limit. Returns False (nothing written) if not.
+    """
+    start_date = str(leave['start_date'])
+    year, month = int(start_date[:4]), int(start_date[5:7])
+    employee_id, leave_type = leave['employee_id'], leave['leave_type']
+    cursor.executemany(LEAVE_TOTALS_SEED_SQL, [(employee_id, year, month, leave_type), (employee_id, year, 0, leave_type)])
+    
+    update = f"""
+        UPDATE leave_totals
+        SET pending_days = pending_days + ?, approved_days = approved_days + ?, updated_at = {db_backend.now}
+        WHERE employee_id = ? AND leave_year = ? AND leave_month = ? AND leave_type = ?
+    """
+    month_update, params = update, [pending_delta, approved_delta, employee_id, year, month, leave_type]
+    if month_limit is not None:
+        month_update += " AND pending_days + approved_days + ? <= ?"
+        params += [pending_delta + approved_delta, month_limit]
+    cursor.execute(month_update, params)
+    if cursor.rowcount != 1:
+        return False
+    cursor.execute(update, [pending_delta, approved_delta, employee_id, year, 0, leave_type])
+    
+    cursor.execute("""
+        INSERT INTO leave_ledger (leave_id, employee_id, leave_year, leave_month, leave_type, event,
+                                  pending_delta, approved_delta, actor)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (leave['id'], employee_id, year, month, leave_type, event, pending_delta, approved_delta, actor))
+    return True
+
+def leave_totals(cursor, employee_id, year, month=0):
+    """{leave_type: {'pending': days, 'approved': days}} for a month (0 = the whole year)"""
+    cursor.execute("""
+        SELECT leave_type, pending_days, approved_days FROM leave_totals
+        WHERE employee_id = ? AND leave_year = ? AND leave_month = ?
+    """, (employee_id, year, month))
+    return {row['leave_type']: {'pending': row['pending_days'], 'approved': row['approved_days']}
+            for row in cursor.fetchall()}
+
+def leave_allowances(cursor, employee_id, employee_category, year):
+    """Yearly CL/SL/EL allowance - the leave_balances row, or the category defaults if there isn't one yet"""
+    cursor.execute(
+        f"SELECT {', '.join(LEAVE_ALLOWANCE_FIELDS.values())} FROM leave_balances WHERE employee_id = ? AND leave_year = ?",
+        (employee_id, year)
+    )
+    row = cursor.fetchone()
+    if row is None:
+        row = dict(zip(('casual_leave_total', 'sick_leave_total', 'earned_leave_total'),
+                       new_leave_balance_row(employee_id, employee_category, year)[2:5]))
+    return {leave_type: row[field] for leave_type, field in LEAVE_ALLOWANCE_FIELDS.items()}
+
 @app.route('/api/leaves', methods=['POST'])
 @jwt_required()
 def submit_leave_request():
@@ -1555,8 +4196,7 @@ def submit_leave_request():
         cursor = conn.cursor()
         
         # Get user details
-        cursor.execute("SELECT employee_id, role, employee_category FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
@@ -1604,65 +4244,14 @@ def submit_leave_request():
         else:
             days_requested = (end_date - start_date).days + 1
         
-        # Rule: Max leaves per month check
-        current_month = start_date.month
         current_year = start_date.year
         leave_config = LEAVE_TYPES[leave_type]
         
-        cursor.execute("""
-            SELECT COALESCE(SUM(days_requested), 0) as month_leaves
-            FROM leave_applications 
-            WHERE employee_id = ? 
-              AND leave_type = ?
-              AND strftime('%m', start_date) = ?
-              AND strftime('%Y', start_date) = ?
-              AND status != 'Rejected'
-              AND status != 'Cancelled'
-        """, (employee_id, leave_type, str(current_month).zfill(2), str(current_year)))
-        
-        month_result = cursor.fetchone()
-        month_leaves = month_result['month_leaves'] if month_result else 0
-        
-        if (month_leaves + days_requested) > leave_config['max_per_month']:
-            conn.close()
-            return jsonify({
-                'error': f'Monthly limit exceeded for {leave_config["name"]}',
-                'max_per_month': leave_config['max_per_month'],
-                'already_used': month_leaves,
-                'requested': days_requested
-            }), 400
-        
-        # Check leave balance
-        cursor.execute("""
-            SELECT * FROM leave_balances 
-            WHERE employee_id = ? AND leave_year = ?
-        """, (employee_id, current_year))
-        
-        balance = cursor.fetchone()
-        
-        # Initialize balance if not exists
-        if not balance:
-            cursor.execute("""
-                INSERT INTO leave_balances (employee_id, leave_year)
-                VALUES (?, ?)
-            """, (employee_id, current_year))
-            conn.commit()
-            cursor.execute("""
-                SELECT * FROM leave_balances 
-                WHERE employee_id = ? AND leave_year = ?
-            """, (employee_id, current_year))
-            balance = cursor.fetchone()
-        
-        # Check available balance based on leave type
-        balance_field = {
-            'CL': ('casual_leave_total', 'casual_leave_used'),
-            'SL': ('sick_leave_total', 'sick_leave_used'),
-            'EL': ('earned_leave_total', 'earned_leave_used'),
-        }
-        
-        if leave_type in balance_field:
-            total_field, used_field = balance_field[leave_type]
-            available = balance[total_field] - balance[used_field]
+        # Check available balance based on leave type (approved days for the year)
+        if leave_type in LEAVE_ALLOWANCE_FIELDS:
+            allowance = leave_allowances(cursor, employee_id, employee_category, current_year)[leave_type]
+            used = leave_totals(cursor, employee_id, current_year).get(leave_type, {}).get('approved', 0)
+            available = allowance - used
             
             if days_requested > available:
                 conn.close()
@@ -1684,6 +4273,21 @@ def submit_leave_request():
         ))
         
         leave_id = cursor.lastrowid
+        
+        # Rule: Max leaves per month (pending + approved) - enforced by the ledger update itself
+        leave = {'id': leave_id, 'employee_id': employee_id, 'leave_type': leave_type, 'start_date': data['start_date']}
+        if not post_leave_entry(cursor, leave, 'SUBMITTED', days_requested, 0, username,
+                                month_limit=leave_config['max_per_month']):
+            conn.rollback()
+            month_leaves = leave_totals(cursor, employee_id, current_year, start_date.month).get(leave_type, {})
+            conn.close()
+            return jsonify({
+                'error': f'Monthly limit exceeded for {leave_config["name"]}',
+                'max_per_month': leave_config['max_per_month'],
+                'already_used': month_leaves.get('pending', 0) + month_leaves.get('approved', 0),
+                'requested': days_requested
+            }), 400
+        
         conn.commit()
         conn.close()
         
@@ -1717,7 +4321,6 @@ def submit_leave_request():
 def get_leave_requests():
     """Get leave requests for current user"""
     try:
-        username = get_jwt_identity()
         status_filter = request.args.get('status', None)
         year = request.args.get('year', datetime.now().year, type=int)
         
@@ -1728,24 +4331,15 @@ def get_leave_requests():
         cursor = conn.cursor()
         
         # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        employee_id = get_current_employee_id()
         
-        if not user:
+        if not employee_id:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
-        employee_id = user['employee_id']
-        
         # Build query
-        query = """
-            SELECT id, leave_type, start_date, end_date, days_requested, is_half_day, 
-                   half_day_session, reason, status, approved_by, approved_on, 
-                   rejection_reason, applied_on
-            FROM leave_applications 
-            WHERE employee_id = ? AND strftime('%Y', start_date) = ?
-        """
-        params = [employee_id, str(year)]
+        query = EMPLOYEE_LEAVES_SQL
+        params = [employee_id, *year_bounds(year)]
         
         if status_filter:
             query += " AND status = ?"
@@ -1798,8 +4392,7 @@ def get_leave_balance():
         cursor = conn.cursor()
         
         # Get employee_id and category
-        cursor.execute("SELECT employee_id, employee_category FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
@@ -1817,54 +4410,26 @@ def get_leave_balance():
                 'message': 'Not eligible for paid leave'
             }), 200
         
-        # Get or create balance
-        cursor.execute("""
-            SELECT * FROM leave_balances 
-            WHERE employee_id = ? AND leave_year = ?
-        """, (employee_id, year))
-        
-        balance = cursor.fetchone()
-        
-        if not balance:
-            cursor.execute("""
-                INSERT INTO leave_balances (employee_id, leave_year)
-                VALUES (?, ?)
-            """, (employee_id, year))
-            conn.commit()
-            cursor.execute("""
-                SELECT * FROM leave_balances 
-                WHERE employee_id = ? AND leave_year = ?
-            """, (employee_id, year))
-            balance = cursor.fetchone()
-        
+        allowances = leave_allowances(cursor, employee_id, category, year)
+        totals = leave_totals(cursor, employee_id, year)
         conn.close()
         
+        balance = {}
+        for key, code in (('casual_leave', 'CL'), ('sick_leave', 'SL'), ('earned_leave', 'EL')):
+            used = totals.get(code, {}).get('approved', 0)
+            balance[key] = {
+                'code': code,
+                'name': LEAVE_TYPES[code]['name'],
+                'total': allowances[code],
+                'used': used,
+                'pending': totals.get(code, {}).get('pending', 0),
+                'available': allowances[code] - used
+            }
+        
         return jsonify({
             'eligible': True,
             'year': year,
-            'balance': {
-                'casual_leave': {
-                    'code': 'CL',
-                    'name': 'Casual Leave',
-                    'total': balance['casual_leave_total'],
-                    'used': balance['casual_leave_used'],
-                    'available': balance['casual_leave_total'] - balance['casual_leave_used']
-                },
-                'sick_leave': {
-                    'code': 'SL',
-                    'name': 'Sick Leave',
-                    'total': balance['sick_leave_total'],
-                    'used': balance['sick_leave_used'],
-                    'available': balance['sick_leave_total'] - balance['sick_leave_used']
-                },
-                'earned_leave': {
-                    'code': 'EL',
-                    'name': 'Earned Leave',
-                    'total': balance['earned_leave_total'],
-                    'used': balance['earned_leave_used'],
-                    'available': balance['earned_leave_total'] - balance['earned_leave_used']
-                }
-            }
+            'balance': balance
         }), 200
         
     except Exception as e:
@@ -1885,15 +4450,12 @@ def cancel_leave_request(leave_id):
         cursor = conn.cursor()
         
         # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        employee_id = get_current_employee_id()
         
-        if not user:
+        if not employee_id:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
-        employee_id = user['employee_id']
-        
         # Get leave request
         cursor.execute("""
             SELECT * FROM leave_applications WHERE id = ? AND employee_id = ?
@@ -1912,8 +4474,14 @@ def cancel_leave_request(leave_id):
         # Cancel the request
         cursor.execute("""
             UPDATE leave_applications SET status = 'Cancelled', updated_at = ?
-            WHERE id = ?
+            WHERE id = ? AND status = 'Pending'
         """, (datetime.now().isoformat(), leave_id))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Leave request was already processed'}), 409
+        
+        post_leave_entry(cursor, leave, 'CANCELLED', -leave['days_requested'], 0, username)
         
         conn.commit()
         conn.close()
@@ -1944,15 +4512,17 @@ def get_all_leave_requests():
             SELECT la.*, u.full_name, u.department, u.employee_category
             FROM leave_applications la
             JOIN users u ON la.employee_id = u.employee_id
+            WHERE 1=1
         """
+        params = []
         
         if status_filter:
-            query += " WHERE la.status = ?"
-            cursor.execute(query + " ORDER BY la.applied_on DESC", (status_filter,))
-        else:
-            cursor.execute(query + " ORDER BY la.applied_on DESC")
+            query += " AND la.status = ?"
+            params.append(status_filter)
         
-        leaves = cursor.fetchall()
+        # Newest first, one page at a time (see PAGINATION)
+        leaves, page_info = paginate(cursor, query, params,
+                                     [('la.applied_on', 'DESC'), ('la.id', 'DESC')], ['applied_on', 'id'])
         conn.close()
         
         leave_list = []
@@ -1974,8 +4544,10 @@ def get_all_leave_requests():
                 'applied_on': leave['applied_on']
             })
         
-        return jsonify({'leaves': leave_list}), 200
+        return jsonify({'leaves': leave_list, **page_info}), 200
         
+    except InvalidCursor:
+        return invalid_cursor()
     except Exception as e:
         logger.error(f"HR get leaves error: {e}")
         return jsonify({'error': 'Failed to fetch leave requests'}), 500
@@ -1995,8 +4567,7 @@ def approve_leave_request(leave_id):
         cursor = conn.cursor()
         
         # Get approver's employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        approver = cursor.fetchone()
+        approver = resolve_identity(username)
         
         if not approver:
             conn.close()
@@ -2018,27 +4589,18 @@ def approve_leave_request(leave_id):
         cursor.execute("""
             UPDATE leave_applications 
             SET status = 'Approved', approved_by = ?, approved_on = ?, updated_at = ?
-            WHERE id = ?
+            WHERE id = ? AND status = 'Pending'
         """, (approver['employee_id'], datetime.now().isoformat(), datetime.now().isoformat(), leave_id))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Leave request was already processed'}), 409
         
-        # Update leave balance
-        leave_type = leave['leave_type']
+        # Pending days become used days
         days = leave['days_requested']
-        year = datetime.strptime(leave['start_date'], '%Y-%m-%d').year
-        
-        balance_field = {
-            'CL': 'casual_leave_used',
-            'SL': 'sick_leave_used',
-            'EL': 'earned_leave_used',
-        }
+        post_leave_entry(cursor, leave, 'APPROVED', -days, days, username)
         
-        if leave_type in balance_field:
-            field = balance_field[leave_type]
-            cursor.execute(f"""
-                UPDATE leave_balances 
-                SET {field} = {field} + ?, updated_at = ?
-                WHERE employee_id = ? AND leave_year = ?
-            """, (days, datetime.now().isoformat(), leave['employee_id'], year))
+        mark_payroll_stale(cursor, leave['employee_id'], leave['start_date'], leave['end_date'], 'LEAVE_APPROVED')
         
         conn.commit()
         conn.close()
@@ -2070,8 +4632,7 @@ def reject_leave_request(leave_id):
         cursor = conn.cursor()
         
         # Get approver's employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        approver = cursor.fetchone()
+        approver = resolve_identity(username)
         
         if not approver:
             conn.close()
@@ -2093,8 +4654,14 @@ def reject_leave_request(leave_id):
         cursor.execute("""
             UPDATE leave_applications 
             SET status = 'Rejected', approved_by = ?, approved_on = ?, rejection_reason = ?, updated_at = ?
-            WHERE id = ?
+            WHERE id = ? AND status = 'Pending'
         """, (approver['employee_id'], datetime.now().isoformat(), rejection_reason, datetime.now().isoformat(), leave_id))
+        if cursor.rowcount != 1:
+            conn.rollback()
+            conn.close()
+            return jsonify({'error': 'Leave request was already processed'}), 409
+        
+        post_leave_entry(cursor, leave, 'REJECTED', -leave['days_requested'], 0, username)
         
         conn.commit()
         conn.close()
@@ -2110,6 +4677,42 @@ def reject_leave_request(leave_id):
         return jsonify({'error': 'Failed to reject leave request'}), 500
 
 
+# New-employee rows shared by single and bulk onboarding
+EMPLOYEE_ROLES = ('Employee', 'HR', 'Admin', 'MD')
+EMPLOYEE_CATEGORIES = ('S001', 'W001', 'M001', 'T001')
+
+NEW_EMPLOYEE_SQL = """
+    INSERT INTO users (
+        employee_id, username, full_name, email, password_hash, role,
+        department, designation, employee_category, shift, hire_date,
+        is_active, account_status, leave_balance, must_change_password,
+        created_at, updated_at
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 'Active', ?, 1, ?, ?)
+"""
+
+NEW_LEAVE_BALANCE_SQL = db_backend.insert_ignore(
+    'leave_balances',
+    ('employee_id', 'leave_year', 'casual_leave_total', 'sick_leave_total', 'earned_leave_total',
+     'casual_leave_used', 'sick_leave_used', 'earned_leave_used'),
+    key_columns=('employee_id', 'leave_year')
+)
+
+def initial_leave_balance(employee_category):
+    """users.leave_balance for a new employee of this category"""
+    if employee_category == 'W001':  # Workers
+        return 6
+    if employee_category in ('M001', 'T001'):  # Migrants, Trainees
+        return 0
+    return 12  # Default for Staff
+
+def new_leave_balance_row(employee_id, employee_category, year):
+    """Parameters for NEW_LEAVE_BALANCE_SQL"""
+    return (employee_id, year,
+            6 if employee_category == 'S001' else 3,  # CL total
+            6 if employee_category == 'S001' else 3,  # SL total
+            12 if employee_category == 'S001' else 0,  # EL total
+            0, 0, 0)
+
 @app.route('/api/hr/employees', methods=['POST'])
 @jwt_required()
 def create_employee():
@@ -2148,7 +4751,7 @@ def create_employee():
         
         # Generate temporary password
         temp_password = generate_temp_password()
-        hashed_password = bcrypt.hashpw(temp_password.encode('utf-8'), bcrypt.gensalt())
+        hashed_password = password_hasher.hash(temp_password)
         
         conn = get_db_connection()
         if not conn:
@@ -2172,55 +4775,31 @@ def create_employee():
         if cursor.fetchone():
             username = f"{username}_{employee_id}"
         
-        # Set leave balance based on category
-        leave_balance = 12  # Default for Staff
-        if employee_category == 'W001':  # Workers
-            leave_balance = 6
-        elif employee_category in ('M001', 'T001'):  # Migrants, Trainees
-            leave_balance = 0
-        
         # Insert new employee
-        cursor.execute("""
-            INSERT INTO users (
-                employee_id, username, full_name, email, password_hash, role,
-                department, designation, employee_category, shift, hire_date,
-                is_active, account_status, leave_balance, must_change_password,
-                created_at, updated_at
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, 1, 'Active', ?, 1, ?, ?)
-        """, (
-            employee_id, username, full_name, email, hashed_password.decode('utf-8'),
+        cursor.execute(NEW_EMPLOYEE_SQL, (
+            employee_id, username, full_name, email, hashed_password,
             role, department, designation, employee_category, shift, hire_date,
-            leave_balance, datetime.now().isoformat(), datetime.now().isoformat()
+            initial_leave_balance(employee_category), datetime.now().isoformat(), datetime.now().isoformat()
         ))
         
         new_user_id = cursor.lastrowid
         
         # Create leave balance record for new employee
-        current_year = datetime.now().year
-        cursor.execute("""
-            INSERT OR IGNORE INTO leave_balances (
-                employee_id, year, cl_total, sl_total, el_total,
-                cl_used, sl_used, el_used
-            ) VALUES (?, ?, ?, ?, ?, 0, 0, 0)
-        """, (employee_id, current_year, 
-              6 if employee_category == 'S001' else 3,  # CL total
-              6 if employee_category == 'S001' else 3,  # SL total
-              12 if employee_category == 'S001' else 0  # EL total
-        ))
+        cursor.execute(NEW_LEAVE_BALANCE_SQL, new_leave_balance_row(employee_id, employee_category, datetime.now().year))
         
         conn.commit()
         conn.close()
+        FILTER_OPTIONS_CACHE.clear()
         
         # Send welcome email with credentials
         email_sent = False
         try:
-            send_welcome_email(
+            email_sent = bool(send_welcome_email(
+                employee_email=email,
                 employee_name=full_name,
-                email=email,
                 username=username,
                 temp_password=temp_password
-            )
-            email_sent = True
+            ))
         except Exception as email_error:
             logger.error(f"Failed to send welcome email: {email_error}")
         
@@ -2244,31 +4823,254 @@ def create_employee():
             'note': 'Credentials sent to employee email' if email_sent else 'Failed to send email - credentials: ' + f'Username: {username}'
         }), 201
         
+    except PasswordHasherBusy:
+        return password_hasher_busy()
     except Exception as e:
         logger.error(f"Create employee error: {e}")
         return jsonify({'error': 'Failed to create employee'}), 500
 
 
-@app.route('/api/hr/employees/<employee_id>', methods=['GET'])
-@jwt_required()
-def get_employee_details(employee_id):
-    """Get employee details for HR"""
-    try:
-        jwt_claims = get_jwt()
-        user_role = jwt_claims.get('role', '')
-        
-        # Only HR, Admin, MD can view employee details
-        if user_role not in ('HR', 'Admin', 'MD'):
-            return jsonify({'error': 'Unauthorized'}), 403
-        
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database connection failed'}), 500
-        
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT employee_id, username, full_name, email, role, department,
-                   designation, employee_category, shift, hire_date, is_active,
+
+# Bulk onboarding: column names accepted in uploaded sheets besides the API field names
+BULK_EMPLOYEE_COLUMN_ALIASES = {
+    'name': 'full_name',
+    'employee_name': 'full_name',
+    'emp_id': 'employee_id',
+    'email_id': 'email',
+    'category': 'employee_category',
+    'position': 'designation',
+    'date_of_joining': 'hire_date',
+    'joining_date': 'hire_date',
+}
+
+EMAIL_PATTERN = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+def read_bulk_employee_records():
+    """Employee dicts from an uploaded CSV/XLSX file or a JSON list - raises ValueError on bad input"""
+    upload = request.files.get('file')
+    if upload:
+        filename = secure_filename(upload.filename or '').lower()
+        if filename.endswith('.csv'):
+            frame = pd.read_csv(upload, dtype=str, keep_default_na=False)
+        elif filename.endswith(('.xlsx', '.xls')):
+            frame = pd.read_excel(upload, dtype=str).fillna('')
+        else:
+            raise ValueError('Upload a .csv or .xlsx file')
+        columns = [str(c).strip().lower().replace(' ', '_') for c in frame.columns]
+        frame.columns = [BULK_EMPLOYEE_COLUMN_ALIASES.get(c, c) for c in columns]
+        return frame.to_dict('records')
+    
+    data = request.get_json(silent=True)
+    if isinstance(data, dict):
+        data = data.get('employees')
+    if not isinstance(data, list) or not all(isinstance(r, dict) for r in data):
+        raise ValueError('Send a CSV/XLSX file or a JSON list of employees')
+    return data
+
+def validate_bulk_employees(records, taken_ids, taken_emails, taken_usernames):
+    """
+    Check every row before anything is written. Returns the per-row report
+    and the rows that can be inserted (with username and temp password).
+    """
+    results, valid = [], []
+    seen_ids, seen_emails = {}, {}
+    today = datetime.now().strftime('%Y-%m-%d')
+    
+    for row_number, record in enumerate(records, start=1):
+        fields = {k: ('' if v is None else str(v).strip()) for k, v in record.items()}
+        employee_id = fields.get('employee_id', '')
+        full_name = fields.get('full_name', '')
+        email = fields.get('email', '').lower()
+        role = fields.get('role') or 'Employee'
+        employee_category = (fields.get('employee_category') or 'S001').upper()
+        shift = fields.get('shift') or None
+        hire_date = (fields.get('hire_date') or today)[:10]
+        errors = []
+        
+        for field, value in (('employee_id', employee_id), ('full_name', full_name), ('email', email)):
+            if not value:
+                errors.append(f'{field} is required')
+        if email and not EMAIL_PATTERN.match(email):
+            errors.append('email is not valid')
+        if role not in EMPLOYEE_ROLES:
+            errors.append(f"role must be one of {', '.join(EMPLOYEE_ROLES)}")
+        if employee_category not in EMPLOYEE_CATEGORIES:
+            errors.append(f"employee_category must be one of {', '.join(EMPLOYEE_CATEGORIES)}")
+        if shift not in (None, '1', '2', '3'):
+            errors.append('shift must be 1, 2 or 3')
+        try:
+            datetime.strptime(hire_date, '%Y-%m-%d')
+        except ValueError:
+            errors.append('hire_date must be YYYY-MM-DD')
+        
+        if employee_id in taken_ids:
+            errors.append('employee_id already exists')
+        elif employee_id in seen_ids:
+            errors.append(f'employee_id duplicates row {seen_ids[employee_id]}')
+        if email in taken_emails:
+            errors.append('email already exists')
+        elif email in seen_emails:
+            errors.append(f'email duplicates row {seen_emails[email]}')
+        if employee_id:
+            seen_ids.setdefault(employee_id, row_number)
+        if email:
+            seen_emails.setdefault(email, row_number)
+        
+        result = {'row': row_number, 'employee_id': employee_id, 'email': email}
+        if not errors:
+            # Same rule as create_employee: email local part, else suffixed with the employee_id
+            username = email.split('@')[0]
+            if username in taken_usernames:
+                username = f"{username}_{employee_id}"
+            if username in taken_usernames:
+                errors.append(f'username {username} already exists')
+        
+        if errors:
+            result.update(status='invalid', errors=errors)
+        else:
+            taken_usernames.add(username)
+            result.update(status='valid', username=username)
+            valid.append({
+                'result': result,
+                'employee_id': employee_id,
+                'username': username,
+                'full_name': full_name,
+                'email': email,
+                'role': role,
+                'department': fields.get('department', ''),
+                'designation': fields.get('designation', ''),
+                'employee_category': employee_category,
+                'shift': shift,
+                'hire_date': hire_date,
+                'temp_password': generate_temp_password()
+            })
+        results.append(result)
+    
+    return results, valid
+
+
+@app.route('/api/hr/employees/bulk', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def bulk_create_employees():
+    """
+    HR onboards many employees at once from a CSV/XLSX upload (field 'file')
+    or a JSON list. All rows are validated first; nothing is written unless
+    every row is valid (or ?skip_invalid=true). ?dry_run=true only validates.
+    """
+    try:
+        current_user = get_jwt_identity()
+        dry_run = request.args.get('dry_run', 'false').lower() == 'true'
+        skip_invalid = request.args.get('skip_invalid', 'false').lower() == 'true'
+        
+        try:
+            records = read_bulk_employee_records()
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if not records:
+            return jsonify({'error': 'No employee rows found'}), 400
+        if len(records) > app_config.BULK_ONBOARD_MAX_ROWS:
+            return jsonify({'error': f'At most {app_config.BULK_ONBOARD_MAX_ROWS} employees per upload'}), 400
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        
+        # Every key a new row could collide with, in one query
+        cursor.execute("SELECT employee_id, LOWER(email) AS email, username FROM users")
+        taken_ids, taken_emails, taken_usernames = set(), set(), set()
+        for user in cursor.fetchall():
+            taken_ids.add(str(user['employee_id']))
+            taken_emails.add(user['email'])
+            taken_usernames.add(user['username'])
+        
+        results, valid = validate_bulk_employees(records, taken_ids, taken_emails, taken_usernames)
+        invalid_count = len(results) - len(valid)
+        summary = {'total': len(results), 'valid': len(valid), 'invalid': invalid_count}
+        
+        if dry_run or not valid or (invalid_count and not skip_invalid):
+            conn.close()
+            if dry_run:
+                return jsonify({'message': 'Validation only - nothing was created', **summary, 'results': results}), 200
+            return jsonify({'error': 'Some rows are invalid - nothing was created', **summary, 'results': results}), 400
+        
+        hashes = password_hasher.hash_many([row['temp_password'] for row in valid])
+        
+        now = datetime.now().isoformat()
+        year = datetime.now().year
+        try:
+            cursor.executemany(NEW_EMPLOYEE_SQL, [(
+                row['employee_id'], row['username'], row['full_name'], row['email'], password_hash,
+                row['role'], row['department'], row['designation'], row['employee_category'], row['shift'],
+                row['hire_date'], initial_leave_balance(row['employee_category']), now, now
+            ) for row, password_hash in zip(valid, hashes)])
+            cursor.executemany(NEW_LEAVE_BALANCE_SQL, [
+                new_leave_balance_row(row['employee_id'], row['employee_category'], year) for row in valid
+            ])
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.close()
+        
+        FILTER_OPTIONS_CACHE.clear()
+        for row in valid:
+            row['result']['status'] = 'created'
+        
+        # Welcome emails go out through the outbox
+        emails_queued = False
+        try:
+            emails_queued = email_outbox.enqueue_many([
+                (row['email'], *welcome_email(row['full_name'], row['username'], row['temp_password']), 'welcome')
+                for row in valid
+            ]) > 0
+        except Exception as email_error:
+            logger.error(f"Failed to queue welcome emails: {email_error}")
+        
+        audit_log('EMPLOYEES_BULK_CREATED', current_user, {
+            'created': len(valid),
+            'skipped_invalid': invalid_count,
+            'emails_queued': emails_queued
+        })
+        
+        return jsonify({
+            'message': f'{len(valid)} employees created successfully',
+            **summary,
+            'created': len(valid),
+            'emails_queued': emails_queued,
+            'note': 'Credentials emails queued' if emails_queued else 'Failed to queue emails - use Resend Credentials',
+            'results': results
+        }), 201
+        
+    except PasswordHasherBusy:
+        return password_hasher_busy()
+    except Exception as e:
+        logger.error(f"Bulk create employees error: {e}")
+        return jsonify({'error': 'Failed to create employees'}), 500
+
+@app.route('/api/hr/employees/<employee_id>', methods=['GET'])
+@jwt_required()
+def get_employee_details(employee_id):
+    """Get employee details for HR"""
+    try:
+        jwt_claims = get_jwt()
+        user_role = jwt_claims.get('role', '')
+        
+        # Only HR, Admin, MD can view employee details
+        if user_role not in ('HR', 'Admin', 'MD'):
+            return jsonify({'error': 'Unauthorized'}), 403
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT employee_id, username, full_name, email, role, department,
+                   designation, employee_category, shift, hire_date, is_active,
                    account_status, leave_balance, created_at
             FROM users 
             WHERE employee_id = ?
@@ -2325,17 +5127,17 @@ def list_employees():
             query += " AND employee_category = ?"
             params.append(category)
         
-        query += " ORDER BY full_name"
-        
-        cursor.execute(query, params)
-        employees = cursor.fetchall()
+        employees, page_info = paginate(cursor, query, params,
+                                        [('full_name', 'ASC'), ('employee_id', 'ASC')], ['full_name', 'employee_id'])
         conn.close()
         
         return jsonify({
             'employees': [dict(emp) for emp in employees],
-            'total': len(employees)
+            **page_info
         }), 200
         
+    except InvalidCursor:
+        return invalid_cursor()
     except Exception as e:
         logger.error(f"List employees error: {e}")
         return jsonify({'error': 'Failed to list employees'}), 500
@@ -2366,7 +5168,7 @@ def update_employee_status(employee_id):
         cursor = conn.cursor()
         
         # Check if employee exists
-        cursor.execute("SELECT id, full_name FROM users WHERE employee_id = ?", (employee_id,))
+        cursor.execute("SELECT id, username, full_name FROM users WHERE employee_id = ?", (employee_id,))
         employee = cursor.fetchone()
         
         if not employee:
@@ -2375,14 +5177,15 @@ def update_employee_status(employee_id):
         
         # Update status
         is_active = 1 if new_status == 'Active' else 0
-        cursor.execute("""
+        cursor.execute(f"""
             UPDATE users 
-            SET account_status = ?, is_active = ?, updated_at = datetime('now')
+            SET account_status = ?, is_active = ?, updated_at = {db_backend.now}
             WHERE employee_id = ?
         """, (new_status, is_active, employee_id))
         
         conn.commit()
         conn.close()
+        invalidate_identity(employee['username'])
         
         audit_log('EMPLOYEE_STATUS_UPDATED', username, {
             'employee_id': employee_id,
@@ -2418,7 +5221,7 @@ def delete_employee(employee_id):
         cursor = conn.cursor()
         
         # Check if employee exists
-        cursor.execute("SELECT id, full_name, role FROM users WHERE employee_id = ?", (employee_id,))
+        cursor.execute("SELECT id, username, full_name, role, department FROM users WHERE employee_id = ?", (employee_id,))
         employee = cursor.fetchone()
         
         if not employee:
@@ -2430,10 +5233,16 @@ def delete_employee(employee_id):
             conn.close()
             return jsonify({'error': 'Cannot delete Admin/MD accounts'}), 403
         
+        cursor.execute("SELECT date FROM attendance WHERE employee_id = ?", (employee_id,))
+        attendance_keys = [(employee_id, row['date']) for row in cursor.fetchall()]
+        
         # Delete employee (cascade will handle related records)
         cursor.execute("DELETE FROM users WHERE employee_id = ?", (employee_id,))
+        refresh_attendance_rollups(cursor, attendance_keys, departments=[employee['department']])
         conn.commit()
         conn.close()
+        invalidate_identity(employee['username'], deleted=True)
+        FILTER_OPTIONS_CACHE.clear()
         
         audit_log('EMPLOYEE_DELETED', username, {
             'employee_id': employee_id,
@@ -2470,8 +5279,9 @@ def update_employee(employee_id):
         cursor = conn.cursor()
         
         # Check if employee exists
-        cursor.execute("SELECT id FROM users WHERE employee_id = ?", (employee_id,))
-        if not cursor.fetchone():
+        cursor.execute("SELECT id, username, department FROM users WHERE employee_id = ?", (employee_id,))
+        employee = cursor.fetchone()
+        if not employee:
             conn.close()
             return jsonify({'error': 'Employee not found'}), 404
         
@@ -2491,13 +5301,20 @@ def update_employee(employee_id):
             conn.close()
             return jsonify({'error': 'No fields to update'}), 400
         
-        updates.append("updated_at = datetime('now')")
+        updates.append(f"updated_at = {db_backend.now}")
         params.append(employee_id)
         
         query = f"UPDATE users SET {', '.join(updates)} WHERE employee_id = ?"
         cursor.execute(query, params)
+        if 'department' in data and (data['department'] or '') != (employee['department'] or ''):
+            # Their attendance now counts towards the new department's daily rollups
+            cursor.execute("SELECT date FROM attendance WHERE employee_id = ?", (employee_id,))
+            refresh_attendance_rollups(cursor, [(employee_id, row['date']) for row in cursor.fetchall()],
+                                       departments=[employee['department']])
         conn.commit()
         conn.close()
+        invalidate_identity(employee['username'])
+        FILTER_OPTIONS_CACHE.clear()
         
         audit_log('EMPLOYEE_UPDATED', username, {'employee_id': employee_id, 'fields': list(data.keys())})
         
@@ -2538,7 +5355,7 @@ def get_all_attendance():
         query = """
             SELECT a.id, a.employee_id, u.full_name, u.department, u.shift,
                    a.date, a.clock_in, a.clock_out, a.status, a.hours_worked,
-                   a.notes, a.is_late, a.is_early_leave
+                   a.notes, a.is_late, a.late_by_minutes, a.is_early_leave, a.early_by_minutes
             FROM attendance a
             JOIN users u ON a.employee_id = u.employee_id
             WHERE 1=1
@@ -2561,7 +5378,9 @@ def get_all_attendance():
             query += " AND u.shift = ?"
             params.append(shift)
         
-        if status and status != 'all':
+        if status == 'Late':
+            query += " AND a.is_late = 1"
+        elif status and status != 'all':
             query += " AND a.status = ?"
             params.append(status)
         
@@ -2569,35 +5388,35 @@ def get_all_attendance():
             query += " AND a.employee_id = ?"
             params.append(employee_id)
         
-        query += " ORDER BY a.date DESC, u.full_name"
-        
-        cursor.execute(query, params)
-        records = cursor.fetchall()
-        
-        # Get departments and shifts for filter options
-        cursor.execute("SELECT DISTINCT department FROM users WHERE department IS NOT NULL AND department != ''")
-        departments = [row['department'] for row in cursor.fetchall()]
-        
-        cursor.execute("SELECT DISTINCT shift FROM users WHERE shift IS NOT NULL AND shift != ''")
-        shifts = [row['shift'] for row in cursor.fetchall()]
-        
+        records, page_info = paginate(cursor, query, params,
+                                      [('a.date', 'DESC'), ('u.full_name', 'ASC'), ('a.id', 'ASC')],
+                                      ['date', 'full_name', 'id'])
         conn.close()
         
-        return jsonify({
-            'attendance': [dict(r) for r in records],
-            'total': len(records),
-            'filters': {
-                'departments': departments,
-                'shifts': shifts,
-                'statuses': ['Present', 'Absent', 'Late', 'Half-Day', 'On Leave']
-            }
-        }), 200
+        response = {'attendance': [dict(r) for r in records], **page_info}
+        if not request.args.get('cursor'):
+            # Filter options only matter for the first page
+            response['filters'] = attendance_filter_options()
+        return jsonify(response), 200
         
+    except InvalidCursor:
+        return invalid_cursor()
     except Exception as e:
         logger.error(f"Get all attendance error: {e}")
         return jsonify({'error': 'Failed to fetch attendance'}), 500
 
 
+@app.route('/api/hr/attendance/filters', methods=['GET'])
+@role_required('HR', 'Admin', 'MD')
+def get_attendance_filters():
+    """Filter options for the HR attendance view (cached)"""
+    try:
+        return jsonify(attendance_filter_options()), 200
+    except Exception as e:
+        logger.error(f"Get attendance filters error: {e}")
+        return jsonify({'error': 'Failed to fetch filter options'}), 500
+
+
 @app.route('/api/hr/attendance/<int:attendance_id>', methods=['PUT'])
 @jwt_required()
 def modify_attendance(attendance_id):
@@ -2619,7 +5438,11 @@ def modify_attendance(attendance_id):
         cursor = conn.cursor()
         
         # Check if record exists
-        cursor.execute("SELECT id, employee_id FROM attendance WHERE id = ?", (attendance_id,))
+        cursor.execute("""
+            SELECT a.id, a.employee_id, a.date, a.clock_in, a.clock_out, u.shift
+            FROM attendance a LEFT JOIN users u ON u.employee_id = a.employee_id
+            WHERE a.id = ?
+        """, (attendance_id,))
         record = cursor.fetchone()
         
         if not record:
@@ -2632,50 +5455,45 @@ def modify_attendance(attendance_id):
         status = data.get('status')
         notes = data.get('notes', '')
         
-        # Calculate hours worked if both times provided
+        # Full timestamps (a clock-out before the clock-in is the next morning)
+        # and hours from the edited times, falling back to the stored ones
         hours_worked = None
-        if clock_in and clock_out:
-            try:
-                from datetime import datetime as dt
-                t1 = dt.strptime(clock_in, '%H:%M')
-                t2 = dt.strptime(clock_out, '%H:%M')
-                diff = (t2 - t1).seconds / 3600
-                hours_worked = round(diff, 2)
-            except:
-                pass
-        
-        # Determine late/early flags
-        is_late = 0
-        is_early_leave = 0
-        if clock_in:
-            try:
-                check_in_time = datetime.strptime(clock_in, '%H:%M').time()
-                late_threshold = datetime.strptime('09:15', '%H:%M').time()
-                is_late = 1 if check_in_time > late_threshold else 0
-            except:
-                pass
+        try:
+            clock_in_at, clock_out_at = session_times(str(record['date']), clock_in or record['clock_in'],
+                                                      clock_out or record['clock_out'])
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'clock_in and clock_out must be HH:MM'}), 400
+        if clock_in_at and clock_out_at:
+            hours_worked = round((clock_out_at - clock_in_at).total_seconds() / 3600, 2)
         
-        if clock_out:
-            try:
-                check_out_time = datetime.strptime(clock_out, '%H:%M').time()
-                early_threshold = datetime.strptime('17:30', '%H:%M').time()
-                is_early_leave = 1 if check_out_time < early_threshold else 0
-            except:
-                pass
+        # Late/early flags of the edited session against the employee's shift
+        is_late, late_by_minutes, is_early_leave, early_by_minutes = session_flags(
+            str(record['date']), record['shift'], clock_in_at, clock_out_at)
         
-        cursor.execute("""
+        cursor.execute(f"""
             UPDATE attendance 
             SET clock_in = COALESCE(?, clock_in),
                 clock_out = COALESCE(?, clock_out),
+                clock_in_at = ?,
+                clock_out_at = ?,
                 status = COALESCE(?, status),
                 hours_worked = COALESCE(?, hours_worked),
                 notes = ?,
                 is_late = ?,
+                late_by_minutes = ?,
                 is_early_leave = ?,
-                updated_at = datetime('now')
+                early_by_minutes = ?,
+                updated_at = {db_backend.now}
             WHERE id = ?
-        """, (clock_in, clock_out, status, hours_worked, 
-              notes + f" [Modified by {username}]", is_late, is_early_leave, attendance_id))
+        """, (clock_in, clock_out,
+              clock_in_at and clock_in_at.strftime(SESSION_TIME_FORMAT),
+              clock_out_at and clock_out_at.strftime(SESSION_TIME_FORMAT),
+              status, hours_worked, notes + f" [Modified by {username}]",
+              is_late, late_by_minutes, is_early_leave, early_by_minutes, attendance_id))
+        
+        refresh_attendance_rollups(cursor, [(record['employee_id'], record['date'])])
+        mark_payroll_stale(cursor, record['employee_id'], record['date'], reason='ATTENDANCE_MODIFIED')
         
         conn.commit()
         conn.close()
@@ -2731,23 +5549,32 @@ def add_attendance_record():
             conn.close()
             return jsonify({'error': 'Attendance record already exists for this date'}), 400
         
-        # Calculate hours worked
+        cursor.execute("SELECT shift FROM users WHERE employee_id = ?", (employee_id,))
+        employee = cursor.fetchone()
+        
+        # Calculate hours worked - a clock-out before the clock-in is the next morning
         hours_worked = None
-        if clock_in and clock_out:
-            try:
-                from datetime import datetime as dt
-                t1 = dt.strptime(clock_in, '%H:%M')
-                t2 = dt.strptime(clock_out, '%H:%M')
-                diff = (t2 - t1).seconds / 3600
-                hours_worked = round(diff, 2)
-            except:
-                pass
+        try:
+            clock_in_at, clock_out_at = session_times(date, clock_in, clock_out)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'date must be YYYY-MM-DD and times HH:MM'}), 400
+        if clock_in_at and clock_out_at:
+            hours_worked = round((clock_out_at - clock_in_at).total_seconds() / 3600, 2)
+        flags = session_flags(date, employee['shift'] if employee else None, clock_in_at, clock_out_at)
         
         cursor.execute("""
-            INSERT INTO attendance (employee_id, date, clock_in, clock_out, status, hours_worked, notes)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (employee_id, date, clock_in, clock_out, status, hours_worked, 
-              notes + f" [Added by {username}]"))
+            INSERT INTO attendance (employee_id, date, clock_in, clock_out, clock_in_at, clock_out_at,
+                                    status, hours_worked, notes,
+                                    is_late, late_by_minutes, is_early_leave, early_by_minutes)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (employee_id, date, clock_in, clock_out,
+              clock_in_at and clock_in_at.strftime(SESSION_TIME_FORMAT),
+              clock_out_at and clock_out_at.strftime(SESSION_TIME_FORMAT),
+              status, hours_worked, notes + f" [Added by {username}]", *flags))
+        
+        refresh_attendance_rollups(cursor, [(employee_id, date)])
+        mark_payroll_stale(cursor, employee_id, date, reason='ATTENDANCE_ADDED')
         
         conn.commit()
         conn.close()
@@ -2765,12 +5592,469 @@ def add_attendance_record():
         return jsonify({'error': 'Failed to add attendance'}), 500
 
 
+@app.route('/api/hr/attendance/rollups/rebuild', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def rebuild_attendance_rollup_tables():
+    """Recompute the attendance rollups from attendance (same as repair_attendance_rollups.py)"""
+    try:
+        username = get_jwt_identity()
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        counts = rebuild_attendance_rollups(conn.cursor())
+        conn.commit()
+        conn.close()
+        
+        audit_log('ATTENDANCE_ROLLUPS_REBUILT', username, counts)
+        return jsonify({'message': 'Attendance rollups rebuilt', **counts}), 200
+        
+    except Exception as e:
+        logger.error(f"Rebuild attendance rollups error: {e}")
+        return jsonify({'error': 'Failed to rebuild attendance rollups'}), 500
+
+
+# ============== PUNCH IMPORT ==============
+# Biometric/turnstile logs (CSV or JSON lines) come in through the import
+# endpoint or the PUNCH_DROP_FOLDER watcher. Raw punches are kept in
+# attendance_punches (duplicates ignored), then every employee-day the log
+# touches is re-paired from all of its punches - first IN to last OUT, with
+# the work date taken from the employee's shift so night shifts pair across
+# midnight - and upserted into attendance in batches. Importing the same log
+# twice, or overlapping logs, gives the same attendance rows.
+
+PUNCH_COLUMN_ALIASES = {
+    'emp_id': 'employee_id',
+    'empid': 'employee_id',
+    'emp_no': 'employee_id',
+    'userid': 'employee_id',
+    'employee': 'employee_id',
+    'employee_code': 'employee_id',
+    'badge': 'employee_id',
+    'badge_id': 'employee_id',
+    'user_id': 'employee_id',
+    'timestamp': 'punched_at',
+    'punch_time': 'punched_at',
+    'datetime': 'punched_at',
+    'checktime': 'punched_at',
+    'log_time': 'punched_at',
+    'type': 'direction',
+    'checktype': 'direction',
+    'punch_type': 'direction',
+    'in_out': 'direction',
+    'state': 'direction',
+    'device': 'device_id',
+    'terminal': 'device_id',
+    'terminal_id': 'device_id',
+    'sensorid': 'device_id',
+}
+
+# ZKTeco-style devices report 0 for check-in and 1 for check-out
+PUNCH_DIRECTIONS = {
+    'in': 'IN', 'i': 'IN', '0': 'IN', 'checkin': 'IN', 'check-in': 'IN', 'check_in': 'IN', 'entry': 'IN',
+    'out': 'OUT', 'o': 'OUT', '1': 'OUT', 'checkout': 'OUT', 'check-out': 'OUT', 'check_out': 'OUT', 'exit': 'OUT',
+}
+
+PUNCH_INSERT_SQL = db_backend.insert_ignore(
+    'attendance_punches', ['employee_id', 'punched_at', 'direction', 'device_id', 'source'],
+    ['employee_id', 'punched_at'])
+
+PUNCH_ATTENDANCE_UPSERT_SQL = db_backend.upsert(
+    'attendance', ['employee_id', 'date', 'clock_in', 'clock_out', 'clock_in_at', 'clock_out_at',
+                   'status', 'hours_worked', 'notes', 'is_late', 'late_by_minutes', 'is_early_leave', 'early_by_minutes'],
+    ['employee_id', 'date'], {'updated_at': db_backend.now})
+
+def read_punch_log(source, fmt):
+    """Punch DataFrame (employee_id, punched_at, direction, device_id) from a CSV or JSON-lines log"""
+    if fmt == 'csv':
+        frame = pd.read_csv(source, dtype=str, keep_default_na=False)
+    elif fmt == 'jsonl':
+        frame = pd.read_json(source, lines=True, dtype=False)
+    elif fmt == 'records':
+        frame = pd.DataFrame.from_records(source)
+    else:
+        raise ValueError('Punch logs must be CSV or JSON lines')
+    columns = [str(c).strip().lower().replace(' ', '_') for c in frame.columns]
+    frame.columns = [PUNCH_COLUMN_ALIASES.get(c, c) for c in columns]
+    if 'punched_at' not in frame and {'date', 'time'} <= set(frame.columns):
+        frame['punched_at'] = frame['date'].astype(str) + ' ' + frame['time'].astype(str)
+    if 'employee_id' not in frame or 'punched_at' not in frame:
+        raise ValueError('Punch log needs employee_id and punched_at (or date and time) columns')
+    
+    direction = frame['direction'] if 'direction' in frame else pd.Series('', index=frame.index)
+    device_id = frame['device_id'] if 'device_id' in frame else pd.Series('', index=frame.index)
+    device_id = device_id.astype(str).str.strip()
+    return pd.DataFrame({
+        'employee_id': frame['employee_id'].astype(str).str.strip(),
+        'punched_at': pd.to_datetime(frame['punched_at'], errors='coerce').dt.floor('s'),
+        'direction': direction.astype(str).str.strip().str.lower().map(PUNCH_DIRECTIONS),
+        'device_id': device_id.where(~device_id.isin(['', 'nan', 'None']), None),
+    })
+
+def shift_minutes(shift):
+    """(start, end) of the shift in minutes after midnight of its work date"""
+    shift_start, shift_end = shift_window('2000-01-01', shift)
+    start = shift_start.hour * 60 + shift_start.minute
+    return start, start + int((shift_end - shift_start).total_seconds() // 60)
+
+def punch_work_dates(punched_at, starts):
+    """
+    The work date each punch belongs to. `starts` is each punch's shift start
+    as minutes after midnight; a day runs from PUNCH_EARLY_HOURS before the
+    start, so a 06:10 punch closes the previous night's 22:00 shift.
+    """
+    offsets = pd.to_timedelta(starts - app_config.PUNCH_EARLY_HOURS * 60, unit='m')
+    return (punched_at - offsets).dt.normalize()
+
+def pair_punches(punches, schedules):
+    """
+    One attendance row per employee-day from its punches: first non-OUT punch
+    is the check-in, last non-IN punch the check-out. Late/early/hours follow
+    the check_in/check_out rules against the employee's shift. Also returns
+    the (employee_id, date) days that only had OUT punches.
+    """
+    windows = {shift: shift_minutes(shift) for shift in schedules['shift'].unique()}
+    start_minutes = {shift: start for shift, (start, _) in windows.items()}
+    end_minutes = {shift: end for shift, (_, end) in windows.items()}
+    shifts = punches['employee_id'].map(schedules['shift'])
+    punches = punches.assign(
+        work_date=punch_work_dates(punches['punched_at'], shifts.map(start_minutes)),
+        in_at=punches['punched_at'].where(punches['direction'] != 'OUT'),
+        out_at=punches['punched_at'].where(punches['direction'] != 'IN'),
+    )
+    days = punches.groupby(['employee_id', 'work_date'], sort=False).agg(
+        clock_in=('in_at', 'min'), clock_out=('out_at', 'max')).reset_index()
+    
+    missing_in = days['clock_in'].isna()
+    days_missing_in = days[missing_in]
+    days = days[~missing_in].copy()
+    # A second punch within the debounce window is a double badge, not a check-out
+    bounced = days['clock_out'] < days['clock_in'] + pd.Timedelta(seconds=app_config.PUNCH_DEBOUNCE_SECONDS)
+    days.loc[bounced, 'clock_out'] = pd.NaT
+    
+    day_shifts = days['employee_id'].map(schedules['shift'])
+    shift_start = days['work_date'] + pd.to_timedelta(day_shifts.map(start_minutes), unit='m')
+    shift_end = days['work_date'] + pd.to_timedelta(day_shifts.map(end_minutes), unit='m')
+    late = ((days['clock_in'] - shift_start).dt.total_seconds() // 60).astype(int)
+    late = late.where(days['clock_in'] > shift_start + pd.Timedelta(minutes=LATE_THRESHOLD_MINUTES), 0)
+    early = ((shift_end - days['clock_out']).dt.total_seconds() // 60).fillna(0).astype(int)
+    early = early.where(days['clock_out'] < shift_end - pd.Timedelta(minutes=EARLY_THRESHOLD_MINUTES), 0)
+    hours = ((days['clock_out'] - days['clock_in']).dt.total_seconds() / 3600).round(2)
+    
+    checked_out = days['clock_out'].notna()
+    notes = np.where(late > 0, 'Late by ' + late.astype(str) + ' minutes', 'On time')
+    notes = np.where(checked_out & (early > 0), notes + ' | Early leave by ' + early.astype(str) + ' minutes',
+                     np.where(checked_out, notes + ' | Regular checkout', notes))
+    return pd.DataFrame({
+        'employee_id': days['employee_id'],
+        'date': days['work_date'].dt.strftime('%Y-%m-%d'),
+        'clock_in': days['clock_in'].dt.strftime('%H:%M:%S'),
+        'clock_out': days['clock_out'].dt.strftime('%H:%M:%S').where(checked_out, None),
+        'clock_in_at': days['clock_in'].dt.strftime(SESSION_TIME_FORMAT),
+        'clock_out_at': days['clock_out'].dt.strftime(SESSION_TIME_FORMAT).where(checked_out, None),
+        'status': np.where(~checked_out | (hours >= HALF_DAY_HOURS), 'Present', 'Half-Day'),
+        'hours_worked': hours.astype(object).where(checked_out, None),
+        'notes': notes,
+        'is_late': (late > 0).astype(int),
+        'late_by_minutes': late,
+        'is_early_leave': (early > 0).astype(int),
+        'early_by_minutes': early,
+    }), pd.DataFrame({
+        'employee_id': days_missing_in['employee_id'],
+        'date': days_missing_in['work_date'].dt.strftime('%Y-%m-%d'),
+    })
+
+def import_punches(conn, punches, source, imported_by):
+    """
+    Store a punch log and rebuild the attendance of every employee-day it
+    touches. Returns a summary of what was read, skipped and written.
+    """
+    started = time.perf_counter()
+    summary = {'source': source, 'punches': len(punches)}
+    cursor = conn.cursor()
+    
+    invalid = punches['employee_id'].isin(['', 'nan', 'None']) | punches['punched_at'].isna()
+    punches = punches[~invalid]
+    deduplicated = punches.drop_duplicates(['employee_id', 'punched_at'])
+    summary.update(invalid=int(invalid.sum()), duplicates=len(punches) - len(deduplicated))
+    
+    schedules = frame_from_query(cursor, "SELECT employee_id, shift FROM users").set_index('employee_id')
+    schedules['shift'] = schedules['shift'].fillna('').astype(str)
+    known = deduplicated['employee_id'].isin(schedules.index)
+    unknown = deduplicated.loc[~known, 'employee_id'].unique()
+    punches = deduplicated[known]
+    summary.update(unknown_employees=len(unknown), unknown_sample=sorted(unknown)[:20])
+    if punches.empty:
+        summary.update(stored=0, days=0, missing_in=0, seconds=round(time.perf_counter() - started, 2))
+        return summary
+    
+    cursor.executemany(PUNCH_INSERT_SQL, list(zip(
+        punches['employee_id'], punches['punched_at'].dt.strftime('%Y-%m-%d %H:%M:%S'),
+        punches['direction'].where(punches['direction'].notna(), None), punches['device_id'],
+        [source] * len(punches))))
+    summary['stored'] = max(cursor.rowcount, 0)
+    conn.commit()
+    
+    # Re-pair every employee-day in the log from all of its stored punches,
+    # including ones from earlier logs or a shift that started the day before
+    shifts = punches['employee_id'].map(schedules['shift'])
+    start_minutes = {shift: shift_minutes(shift)[0] for shift in shifts.unique()}
+    touched = pd.DataFrame({
+        'employee_id': punches['employee_id'],
+        'work_date': punch_work_dates(punches['punched_at'], shifts.map(start_minutes)),
+    }).drop_duplicates()
+    first_day = touched['work_date'].min() - pd.Timedelta(days=1)
+    last_day = touched['work_date'].max() + pd.Timedelta(days=2)
+    stored = frame_from_query(cursor, """
+        SELECT employee_id, punched_at, direction FROM attendance_punches
+        WHERE punched_at >= ? AND punched_at < ?
+    """, (first_day.strftime('%Y-%m-%d'), last_day.strftime('%Y-%m-%d')))
+    stored = stored[stored['employee_id'].isin(touched['employee_id'].unique())]
+    stored['punched_at'] = pd.to_datetime(stored['punched_at'])
+    days, missing_in = pair_punches(stored, schedules)
+    touched = touched.assign(date=touched['work_date'].dt.strftime('%Y-%m-%d'))[['employee_id', 'date']]
+    days = days.merge(touched)
+    missing_in = missing_in.merge(touched)
+    
+    rows = list(days.itertuples(index=False, name=None))
+    batch_size = app_config.PUNCH_IMPORT_BATCH_SIZE
+    for i in range(0, len(rows), batch_size):
+        batch = rows[i:i + batch_size]
+        cursor.executemany(PUNCH_ATTENDANCE_UPSERT_SQL, batch)
+        refresh_attendance_rollups(cursor, [(row[0], row[1]) for row in batch])
+        conn.commit()
+    
+    # Payroll already run for these months no longer matches attendance
+    stale = []
+    if rows:
+        months = days.assign(month=days['date'].str[:7])[['employee_id', 'month']].drop_duplicates()
+        placeholders = ', '.join('?' * months['month'].nunique())
+        processed = frame_from_query(cursor, f"SELECT employee_id, month FROM payroll WHERE month IN ({placeholders})",
+                                     list(months['month'].unique()))
+        stale = list(months.merge(processed).itertuples(index=False, name=None))
+    if stale:
+        now, mark_id = time.time(), new_stale_mark_id()
+        cursor.executemany(PAYROLL_STALE_UPSERT_SQL, [
+            (employee_id, month, f"Punch import {source}"[:100], now, mark_id) for employee_id, month in stale])
+        conn.commit()
+    
+    summary.update(days=len(rows), missing_in=len(missing_in), payroll_marked_stale=len(stale),
+                   seconds=round(time.perf_counter() - started, 2))
+    log_db('UPSERT', 'attendance', f"{len(rows)} days from {summary['stored']} new punches ({source})")
+    audit_log('PUNCHES_IMPORTED', imported_by, {k: v for k, v in summary.items() if k != 'unknown_sample'})
+    return summary
+
+def punch_log_format(filename):
+    if filename.endswith(('.jsonl', '.ndjson')):
+        return 'jsonl'
+    if filename.endswith(('.csv', '.txt')):
+        return 'csv'
+    return None
+
+
+class PunchDropWatcher:
+    """Imports punch logs dropped into a folder, then moves them to processed/ or failed/"""
+
+    def __init__(self, folder, poll_interval):
+        self.folder = folder
+        self.poll_interval = poll_interval
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.counters = {'files': 0, 'failed': 0, 'punches': 0, 'days': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def start(self):
+        if not self.folder:
+            return
+        for sub in ('processed', 'failed'):
+            os.makedirs(os.path.join(self.folder, sub), exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='punch-drop-watcher', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stop.wait(self.poll_interval):
+            for name in sorted(os.listdir(self.folder)):
+                if self._stop.is_set():
+                    break
+                if punch_log_format(name.lower()):
+                    self._import(name)
+
+    def _import(self, name):
+        path = os.path.join(self.folder, name)
+        claimed = path + '.importing'
+        try:
+            # Renaming claims the file, so only one worker process imports it
+            os.replace(path, claimed)
+        except OSError:
+            return
+        conn = get_db_connection()
+        try:
+            if not conn:
+                raise RuntimeError('Database connection failed')
+            with open(claimed, 'rb') as log:
+                summary = import_punches(conn, read_punch_log(log, punch_log_format(name.lower())), name, 'SYSTEM')
+            self._count('files')
+            self._count('punches', summary['punches'])
+            self._count('days', summary['days'])
+            os.replace(claimed, os.path.join(self.folder, 'processed', name))
+            logger.info(f"Imported punch log {name}: {summary}")
+        except Exception as e:
+            self._count('failed')
+            os.replace(claimed, os.path.join(self.folder, 'failed', name))
+            logger.error(f"Punch log {name} import failed: {e}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'punch_watcher'})
+        finally:
+            if conn:
+                conn.close()
+
+    def stop(self, timeout=10):
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._thread.join(timeout)
+
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, folder=self.folder or None)
+
+
+punch_watcher = PunchDropWatcher(app_config.PUNCH_DROP_FOLDER, app_config.PUNCH_DROP_POLL_INTERVAL)
+
+@app.route('/api/hr/attendance/punches/import', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def import_punch_log():
+    """
+    Import a device punch log: a CSV/JSON-lines upload (field 'file'), a raw
+    text/csv or application/x-ndjson body, or a JSON list of punches.
+    """
+    try:
+        current_user = get_jwt_identity()
+        upload = request.files.get('file')
+        try:
+            if upload:
+                source = secure_filename(upload.filename or '') or 'upload'
+                fmt = punch_log_format(source.lower())
+                if not fmt:
+                    return jsonify({'error': 'Upload a .csv or .jsonl punch log'}), 400
+                punches = read_punch_log(upload, fmt)
+            elif request.is_json:
+                data = request.get_json(silent=True)
+                if isinstance(data, dict):
+                    data = data.get('punches')
+                if not isinstance(data, list) or not all(isinstance(r, dict) for r in data):
+                    return jsonify({'error': 'Send a punch log file or a JSON list of punches'}), 400
+                source, punches = 'api', read_punch_log(data, 'records')
+            else:
+                fmt = 'jsonl' if 'ndjson' in request.mimetype or 'jsonl' in request.mimetype else 'csv'
+                source, punches = 'api', read_punch_log(io.BytesIO(request.get_data()), fmt)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        if punches.empty:
+            return jsonify({'error': 'No punches found'}), 400
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        summary = import_punches(conn, punches, source, current_user)
+        conn.close()
+        return jsonify({'message': f"Imported {summary['days']} attendance days", **summary}), 200
+        
+    except Exception as e:
+        logger.error(f"Punch import error: {e}")
+        return jsonify({'error': 'Failed to import punch log'}), 500
+
 # ============== REPORTS APIs ==============
+# CSV/XLSX exports are streamed: the query runs on a connection owned by the
+# response and rows are read EXPORT_FETCH_SIZE at a time, so memory stays flat
+# however long the date range. CSV goes out in EXPORT_CHUNK_SIZE pieces
+# (gzip-compressed when the client accepts it); XLSX is built with openpyxl's
+# write-only workbook in a temp file and then streamed from disk.
+
+EXPORT_FORMATS = ('csv', 'xlsx')
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+def csv_chunks(header, rows):
+    """CSV text of header + rows, yielded in pieces of about EXPORT_CHUNK_SIZE"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    for values in rows:
+        writer.writerow(values)
+        if buffer.tell() >= app_config.EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+def gzip_chunks(chunks):
+    """gzip-compress a stream of text chunks"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 = gzip container
+    for chunk in chunks:
+        data = compressor.compress(chunk.encode('utf-8'))
+        if data:
+            yield data
+    yield compressor.flush()
+
+def xlsx_chunks(header, rows, sheet_title):
+    """XLSX workbook of header + rows, written in constant memory and streamed from a temp file"""
+    from openpyxl import Workbook  # only needed for XLSX exports
+    
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet(title=sheet_title)
+    sheet.append(header)
+    for values in rows:
+        sheet.append(values)
+    with tempfile.TemporaryFile() as spool:
+        workbook.save(spool)
+        spool.seek(0)
+        while True:
+            data = spool.read(app_config.EXPORT_CHUNK_SIZE)
+            if not data:
+                break
+            yield data
+
+def export_report(query, params, header, row_values, filename, export_format):
+    """Streamed CSV/XLSX download of a report query; row_values maps a row to its cells"""
+    conn = get_db_connection(request_scoped=False)
+    if not conn:
+        return jsonify({'error': 'Database connection failed'}), 500
+    try:
+        cursor = conn.cursor()
+        cursor.execute(query, params)
+    except Exception:
+        conn.close()
+        raise
+    
+    def rows():
+        while True:
+            chunk = cursor.fetchmany(app_config.EXPORT_FETCH_SIZE)
+            if not chunk:
+                break
+            for row in chunk:
+                yield row_values(row)
+    
+    headers = {'Content-Disposition': f'attachment; filename={filename}.{export_format}'}
+    if export_format == 'xlsx':
+        response = Response(xlsx_chunks(header, rows(), filename[:31]), mimetype=XLSX_MIMETYPE, headers=headers)
+    elif 'gzip' in request.headers.get('Accept-Encoding', ''):
+        headers.update({'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'})
+        response = Response(gzip_chunks(csv_chunks(header, rows())), mimetype='text/csv', headers=headers)
+    else:
+        response = Response(csv_chunks(header, rows()), mimetype='text/csv', headers=headers)
+    # Runs when the server closes the body - after the last chunk, or on client disconnect
+    response.call_on_close(conn.close)
+    return response
 
 @app.route('/api/hr/reports/attendance', methods=['GET'])
 @jwt_required()
 def get_attendance_report():
-    """Generate attendance report with optional CSV export"""
+    """Generate attendance report with optional CSV/XLSX export"""
     try:
         jwt_claims = get_jwt()
         user_role = jwt_claims.get('role', '')
@@ -2782,7 +6066,7 @@ def get_attendance_report():
         date_from = request.args.get('date_from', (datetime.now() - timedelta(days=30)).strftime('%Y-%m-%d'))
         date_to = request.args.get('date_to', datetime.now().strftime('%Y-%m-%d'))
         department = request.args.get('department')
-        export_format = request.args.get('format', 'json')  # json or csv
+        export_format = request.args.get('format', 'json')  # json, csv or xlsx
         
         conn = get_db_connection()
         if not conn:
@@ -2790,20 +6074,26 @@ def get_attendance_report():
         
         cursor = conn.cursor()
         
-        query = """
+        # Whole months come from the monthly rollup, partial ones from attendance
+        try:
+            source, params = attendance_range_source(date_from, date_to)
+        except ValueError:
+            conn.close()
+            return jsonify({'error': 'date_from and date_to must be YYYY-MM-DD'}), 400
+        source_params = list(params)
+        
+        query = f"""
             SELECT u.employee_id, u.full_name, u.department, u.shift,
-                   COUNT(CASE WHEN a.status = 'Present' THEN 1 END) as present_days,
-                   COUNT(CASE WHEN a.status = 'Absent' THEN 1 END) as absent_days,
-                   COUNT(CASE WHEN a.is_late = 1 THEN 1 END) as late_days,
-                   COUNT(CASE WHEN a.is_early_leave = 1 THEN 1 END) as early_leave_days,
-                   ROUND(AVG(a.hours_worked), 2) as avg_hours,
-                   SUM(a.hours_worked) as total_hours
+                   COALESCE(SUM(t.present_days), 0) as present_days,
+                   COALESCE(SUM(t.absent_days), 0) as absent_days,
+                   COALESCE(SUM(t.late_days), 0) as late_days,
+                   COALESCE(SUM(t.early_days), 0) as early_leave_days,
+                   ROUND(SUM(t.total_hours) / NULLIF(SUM(t.hours_days), 0), 2) as avg_hours,
+                   SUM(t.total_hours) as total_hours
             FROM users u
-            LEFT JOIN attendance a ON u.employee_id = a.employee_id 
-                AND a.date BETWEEN ? AND ?
+            LEFT JOIN ({source}) t ON u.employee_id = t.employee_id
             WHERE u.is_active = 1
         """
-        params = [date_from, date_to]
         
         if department and department != 'all':
             query += " AND u.department = ?"
@@ -2811,58 +6101,59 @@ def get_attendance_report():
         
         query += " GROUP BY u.employee_id, u.full_name, u.department, u.shift ORDER BY u.department, u.full_name"
         
+        if export_format in EXPORT_FORMATS:
+            conn.close()
+            return export_report(
+                query, params,
+                ['Employee ID', 'Name', 'Department', 'Shift',
+                 'Present Days', 'Absent Days', 'Late Days',
+                 'Early Leave Days', 'Avg Hours', 'Total Hours'],
+                lambda row: [
+                    row['employee_id'], row['full_name'], row['department'],
+                    row['shift'], row['present_days'] or 0, row['absent_days'] or 0,
+                    row['late_days'] or 0, row['early_leave_days'] or 0,
+                    row['avg_hours'] or 0, row['total_hours'] or 0
+                ],
+                f'attendance_report_{date_from}_to_{date_to}', export_format
+            )
+        
         cursor.execute(query, params)
         report_data = cursor.fetchall()
         
         # Get summary stats
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT 
-                COUNT(DISTINCT a.employee_id) as total_employees,
-                COUNT(CASE WHEN a.status = 'Present' THEN 1 END) as total_present,
-                COUNT(CASE WHEN a.status = 'Absent' THEN 1 END) as total_absent,
-                ROUND(AVG(a.hours_worked), 2) as avg_hours_all
-            FROM attendance a
-            JOIN users u ON a.employee_id = u.employee_id
-            WHERE a.date BETWEEN ? AND ? AND u.is_active = 1
-        """, [date_from, date_to])
+                COUNT(DISTINCT t.employee_id) as total_employees,
+                COALESCE(SUM(t.present_days), 0) as total_present,
+                COALESCE(SUM(t.absent_days), 0) as total_absent,
+                ROUND(SUM(t.total_hours) / NULLIF(SUM(t.hours_days), 0), 2) as avg_hours_all
+            FROM ({source}) t
+            JOIN users u ON t.employee_id = u.employee_id
+            WHERE u.is_active = 1
+        """, source_params)
         summary = cursor.fetchone()
         
-        conn.close()
+        # Day-by-day totals from the department rollup
+        daily_query = """
+            SELECT date, SUM(recorded_days) as recorded, SUM(present_days) as present,
+                   SUM(absent_days) as absent, SUM(late_days) as late,
+                   SUM(early_days) as early_leave, SUM(total_hours) as total_hours
+            FROM attendance_rollup_daily
+            WHERE date BETWEEN ? AND ?
+        """
+        daily_params = [date_from, date_to]
+        if department and department != 'all':
+            daily_query += " AND department = ?"
+            daily_params.append(department)
+        cursor.execute(daily_query + " GROUP BY date ORDER BY date", daily_params)
+        daily = cursor.fetchall()
         
-        if export_format == 'csv':
-            # Generate CSV
-            import io
-            import csv
-            
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            # Header
-            writer.writerow(['Employee ID', 'Name', 'Department', 'Shift', 
-                           'Present Days', 'Absent Days', 'Late Days', 
-                           'Early Leave Days', 'Avg Hours', 'Total Hours'])
-            
-            # Data
-            for row in report_data:
-                writer.writerow([
-                    row['employee_id'], row['full_name'], row['department'],
-                    row['shift'], row['present_days'] or 0, row['absent_days'] or 0,
-                    row['late_days'] or 0, row['early_leave_days'] or 0,
-                    row['avg_hours'] or 0, row['total_hours'] or 0
-                ])
-            
-            csv_content = output.getvalue()
-            
-            from flask import Response
-            return Response(
-                csv_content,
-                mimetype='text/csv',
-                headers={'Content-Disposition': f'attachment; filename=attendance_report_{date_from}_to_{date_to}.csv'}
-            )
+        conn.close()
         
         return jsonify({
             'report': [dict(r) for r in report_data],
             'summary': dict(summary) if summary else {},
+            'daily': [dict(r) for r in daily],
             'period': {'from': date_from, 'to': date_to}
         }), 200
         
@@ -2874,7 +6165,7 @@ def get_attendance_report():
 @app.route('/api/hr/reports/leaves', methods=['GET'])
 @jwt_required()
 def get_leave_report():
-    """Generate leave report with optional CSV export"""
+    """Generate leave report with optional CSV/XLSX export"""
     try:
         jwt_claims = get_jwt()
         user_role = jwt_claims.get('role', '')
@@ -2898,7 +6189,7 @@ def get_leave_report():
         
         query = """
             SELECT l.id, l.employee_id, u.full_name, u.department,
-                   l.leave_type, l.start_date, l.end_date, l.total_days,
+                   l.leave_type, l.start_date, l.end_date, l.days_requested AS total_days,
                    l.reason, l.status, l.approved_by, l.approved_on,
                    l.rejection_reason, l.applied_on
             FROM leave_applications l
@@ -2921,6 +6212,22 @@ def get_leave_report():
         
         query += " ORDER BY l.applied_on DESC"
         
+        if export_format in EXPORT_FORMATS:
+            conn.close()
+            return export_report(
+                query, params,
+                ['Employee ID', 'Name', 'Department', 'Leave Type',
+                 'Start Date', 'End Date', 'Days', 'Status',
+                 'Reason', 'Applied On'],
+                lambda row: [
+                    row['employee_id'], row['full_name'], row['department'],
+                    row['leave_type'], row['start_date'], row['end_date'],
+                    row['total_days'], row['status'], row['reason'],
+                    row['applied_on']
+                ],
+                f'leave_report_{date_from}_to_{date_to}', export_format
+            )
+        
         cursor.execute(query, params)
         leaves = cursor.fetchall()
         
@@ -2928,7 +6235,7 @@ def get_leave_report():
         cursor.execute("""
             SELECT leave_type, 
                    COUNT(*) as count,
-                   SUM(total_days) as total_days,
+                   SUM(days_requested) as total_days,
                    COUNT(CASE WHEN status = 'Approved' THEN 1 END) as approved,
                    COUNT(CASE WHEN status = 'Rejected' THEN 1 END) as rejected,
                    COUNT(CASE WHEN status = 'Pending' THEN 1 END) as pending
@@ -2940,76 +6247,647 @@ def get_leave_report():
         
         conn.close()
         
-        if export_format == 'csv':
-            import io
-            import csv
-            
-            output = io.StringIO()
-            writer = csv.writer(output)
-            
-            writer.writerow(['Employee ID', 'Name', 'Department', 'Leave Type',
-                           'Start Date', 'End Date', 'Days', 'Status', 
-                           'Reason', 'Applied On'])
-            
-            for row in leaves:
-                writer.writerow([
-                    row['employee_id'], row['full_name'], row['department'],
-                    row['leave_type'], row['start_date'], row['end_date'],
-                    row['total_days'], row['status'], row['reason'],
-                    row['applied_on']
-                ])
+        return jsonify({
+            'leaves': [dict(l) for l in leaves],
+            'summary_by_type': [dict(s) for s in summary_by_type],
+            'total': len(leaves),
+            'period': {'from': date_from, 'to': date_to}
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Leave report error: {e}")
+        return jsonify({'error': 'Failed to generate report'}), 500
+
+
+@app.route('/api/hr/departments', methods=['GET'])
+@jwt_required()
+def get_departments():
+    """Get list of departments"""
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT DISTINCT department, COUNT(*) as employee_count
+            FROM users 
+            WHERE department IS NOT NULL AND department != '' AND is_active = 1
+            GROUP BY department
+            ORDER BY department
+        """)
+        departments = cursor.fetchall()
+        conn.close()
+        
+        return jsonify({
+            'departments': [{'name': d['department'], 'count': d['employee_count']} for d in departments]
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Get departments error: {e}")
+        return jsonify({'error': 'Failed to fetch departments'}), 500
+
+
+# ============== HOLIDAY CALENDAR APIs ==============
+# Every holiday change clears work_calendar and marks already-processed
+# payroll for that month stale, since everyone's working days may have moved.
+
+@app.route('/api/holidays', methods=['GET'])
+@jwt_required()
+def get_holidays():
+    """Holidays for a year, with the caller's working days per month"""
+    try:
+        year = request.args.get('year', datetime.now().year, type=int)
+        identity = resolve_identity(get_jwt_identity()) or {}
+        category, shift = identity.get('employee_category'), identity.get('shift')
+        
+        holidays, working_days = [], {}
+        for number in range(1, 13):
+            month = f"{year}-{number:02d}"
+            holidays.extend(work_calendar.holidays(month))
+            working_days[month] = work_calendar.working_days(month, category, shift)
+        
+        return jsonify({
+            'year': year,
+            'holidays': [{
+                'id': h['id'],
+                'date': h['date'],
+                'description': h['description'],
+                'is_optional': bool(h['is_optional']),
+                'employee_category': h['employee_category'],
+                'shift': h['shift']
+            } for h in holidays],
+            'working_days': working_days
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Get holidays error: {e}")
+        return jsonify({'error': 'Failed to fetch holidays'}), 500
+
+
+@app.route('/api/hr/holidays', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def add_holiday():
+    """Add a holiday - company-wide, or only for one employee category/shift"""
+    try:
+        username = get_jwt_identity()
+        data = request.get_json() or {}
+        date = data.get('date')
+        description = (data.get('description') or '').strip()
+        employee_category = data.get('employee_category') or None
+        shift = data.get('shift') or None
+        
+        try:
+            datetime.strptime(date or '', '%Y-%m-%d')
+        except ValueError:
+            return jsonify({'error': 'Date is required (YYYY-MM-DD format)'}), 400
+        if not description:
+            return jsonify({'error': 'Description is required'}), 400
+        if employee_category not in (None,) + EMPLOYEE_CATEGORIES:
+            return jsonify({'error': f"employee_category must be one of {', '.join(EMPLOYEE_CATEGORIES)}"}), 400
+        if shift not in (None, '1', '2', '3'):
+            return jsonify({'error': 'shift must be 1, 2 or 3'}), 400
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        cursor.execute("""
+            SELECT id FROM holidays
+            WHERE date = ? AND COALESCE(employee_category, '') = ? AND COALESCE(shift, '') = ?
+        """, (date, employee_category or '', shift or ''))
+        if cursor.fetchone():
+            conn.close()
+            return jsonify({'error': f'A holiday for this category and shift already exists on {date}'}), 409
+        
+        cursor.execute("""
+            INSERT INTO holidays (date, description, is_optional, employee_category, shift)
+            VALUES (?, ?, ?, ?, ?)
+        """, (date, description, 1 if data.get('is_optional') else 0, employee_category, shift))
+        holiday_id = cursor.lastrowid
+        mark_month_payroll_stale(cursor, date[:7], 'HOLIDAY_ADDED')
+        # Tell every worker's work calendar to recount
+        cursor.execute("UPDATE calendar_version SET version = version + 1 WHERE id = 1")
+        conn.commit()
+        conn.close()
+        work_calendar.invalidate()
+        
+        audit_log('HOLIDAY_ADDED', username, {'holiday_id': holiday_id, 'date': date, 'description': description})
+        
+        return jsonify({'message': 'Holiday added successfully', 'id': holiday_id}), 201
+        
+    except Exception as e:
+        logger.error(f"Add holiday error: {e}")
+        return jsonify({'error': 'Failed to add holiday'}), 500
+
+
+@app.route('/api/hr/holidays/<int:holiday_id>', methods=['DELETE'])
+@role_required('HR', 'Admin', 'MD')
+def delete_holiday(holiday_id):
+    """Remove a holiday"""
+    try:
+        username = get_jwt_identity()
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        cursor.execute("SELECT date FROM holidays WHERE id = ?", (holiday_id,))
+        holiday = cursor.fetchone()
+        
+        if not holiday:
+            conn.close()
+            return jsonify({'error': 'Holiday not found'}), 404
+        
+        cursor.execute("DELETE FROM holidays WHERE id = ?", (holiday_id,))
+        mark_month_payroll_stale(cursor, str(holiday['date'])[:7], 'HOLIDAY_REMOVED')
+        cursor.execute("UPDATE calendar_version SET version = version + 1 WHERE id = 1")
+        conn.commit()
+        conn.close()
+        work_calendar.invalidate()
+        
+        audit_log('HOLIDAY_REMOVED', username, {'holiday_id': holiday_id, 'date': str(holiday['date'])[:10]})
+        
+        return jsonify({'message': 'Holiday removed successfully'}), 200
+        
+    except Exception as e:
+        logger.error(f"Delete holiday error: {e}")
+        return jsonify({'error': 'Failed to remove holiday'}), 500
+
+
+# ============== PAYROLL MANAGEMENT APIs ==============
+
+# One payroll row per employee per month - recalculating overwrites it in place
+PAYROLL_UPSERT_SQL = db_backend.upsert(
+    'payroll',
+    ('employee_id', 'month', 'basic_salary', 'allowances', 'overtime_pay', 'deductions', 'net_pay',
+     'worked_days', 'leave_days', 'processed_by'),
+    key_columns=('employee_id', 'month'),
+    expressions={'processed_at': db_backend.now}
+)
+
+# ---- Stale payroll tracking ----
+# Attendance corrections and leave approvals that land in a month whose
+# payroll is already processed mark that (employee_id, month) row in
+# payroll_stale. /api/hr/payroll/recalculate recomputes just those rows.
+# Every mark gets a fresh mark_id; a payroll run reads the marks before its
+# inputs and on save drops only marks whose mark_id is unchanged, so a change
+# committed after the inputs were read keeps its mark for the next
+# recalculation whatever its marked_at says.
+
+PAYROLL_STALE_UPSERT_SQL = db_backend.upsert(
+    'payroll_stale', ('employee_id', 'month', 'reason', 'marked_at', 'mark_id'), key_columns=('employee_id', 'month')
+)
+
+def new_stale_mark_id():
+    """Identifies one marking; a re-mark replaces it"""
+    return secrets.token_hex(16)
+
+def months_between(start_date, end_date=None):
+    """YYYY-MM months touched by a YYYY-MM-DD date or date range"""
+    start = np.datetime64(str(start_date)[:7], 'M')
+    end = np.datetime64(str(end_date or start_date)[:7], 'M')
+    return [str(month) for month in np.arange(start, end + 1)]
+
+def mark_payroll_stale(cursor, employee_id, start_date, end_date=None, reason=None):
+    """Flag already-processed payroll rows affected by a change on these dates; returns the months flagged"""
+    months = months_between(start_date, end_date)
+    placeholders = ', '.join('?' * len(months))
+    cursor.execute(
+        f"SELECT month FROM payroll WHERE employee_id = ? AND month IN ({placeholders})",
+        [employee_id] + months
+    )
+    processed = [row['month'] for row in cursor.fetchall()]
+    if processed:
+        now, mark_id = time.time(), new_stale_mark_id()
+        cursor.executemany(PAYROLL_STALE_UPSERT_SQL, [(employee_id, month, reason, now, mark_id) for month in processed])
+    return processed
+
+def mark_month_payroll_stale(cursor, month, reason):
+    """Flag every processed payroll row of a month, e.g. after its holidays change"""
+    cursor.execute("DELETE FROM payroll_stale WHERE month = ?", (month,))
+    cursor.execute(
+        "INSERT INTO payroll_stale (employee_id, month, reason, marked_at, mark_id) "
+        "SELECT employee_id, month, ?, ?, ? FROM payroll WHERE month = ?",
+        (reason, time.time(), new_stale_mark_id(), month)
+    )
+
+def payroll_stale_marks(cursor, month):
+    """{employee_id: mark_id} of the month's stale marks - read before loading payroll inputs"""
+    cursor.execute("SELECT employee_id, mark_id FROM payroll_stale WHERE month = ?", (month,))
+    return {row['employee_id']: row['mark_id'] for row in cursor.fetchall()}
+
+def clear_payroll_stale(cursor, month, employee_ids, marks):
+    """Drop these employees' stale marks unless they were re-marked since `marks` was read"""
+    cursor.executemany(
+        "DELETE FROM payroll_stale WHERE employee_id = ? AND month = ? AND mark_id = ?",
+        [(employee_id, month, marks[employee_id]) for employee_id in employee_ids if employee_id in marks]
+    )
+
+# ---- Payroll engine ----
+# Set-based: one query each for the employees, their attendance totals (from
+# attendance_rollup_monthly) and their approved leave totals for the month, then every salary component is
+# computed column-wise over the whole frame and written with one executemany.
+# Each employee's working days come from work_calendar for their category/shift.
+
+HRA_RATE = 0.10                 # 10% of basic
+CONVEYANCE_ALLOWANCE = 1600     # fixed, per month
+MEDICAL_ALLOWANCE = 1250        # fixed, per month
+PF_RATE = 0.12
+PF_WAGE_CEILING = 15000         # PF is 12% of basic, capped at this basic
+PROFESSIONAL_TAX = 200
+PT_THRESHOLD = 10000            # PT applies above this basic
+STANDARD_HOURS_PER_DAY = 8
+OVERTIME_MULTIPLIER = 1.5
+
+def frame_from_query(cursor, query, params=()):
+    """Run a query and return its rows as a DataFrame"""
+    cursor.execute(query, params)
+    columns = [column[0] for column in cursor.description]
+    return pd.DataFrame.from_records([tuple(row) for row in cursor.fetchall()], columns=columns)
+
+def load_payroll_inputs(cursor, month, employee_ids=None):
+    """
+    One row per employee to be paid for `month` with their working days,
+    attendance and leave totals. employee_ids limits the run (any role);
+    otherwise every active employee with role Employee is included.
+    """
+    start_date, end_date, _ = work_calendar.period(month)
+    
+    if employee_ids:
+        placeholders = ', '.join('?' * len(employee_ids))
+        employee_filter = f"employee_id IN ({placeholders})"
+        employees = frame_from_query(cursor, f"""
+            SELECT employee_id, full_name, department, salary, employee_category, shift
+            FROM users WHERE {employee_filter} AND is_active = 1
+            ORDER BY employee_id
+        """, list(employee_ids))
+        scope, scope_params = f" AND {employee_filter}", list(employee_ids)
+    else:
+        employees = frame_from_query(cursor, """
+            SELECT employee_id, full_name, department, salary, employee_category, shift
+            FROM users WHERE is_active = 1 AND role = 'Employee'
+            ORDER BY employee_id
+        """)
+        scope, scope_params = '', []
+    
+    schedules = list(zip(employees['employee_category'], employees['shift']))
+    working_days = {schedule: work_calendar.working_days(month, *schedule) for schedule in set(schedules)}
+    employees['working_days'] = [working_days[schedule] for schedule in schedules]
+    
+    # One rollup row per employee instead of re-aggregating the month's attendance
+    attendance = frame_from_query(cursor, f"""
+        SELECT employee_id, present_days, present_hours AS total_hours
+        FROM attendance_rollup_monthly
+        WHERE month = ?{scope}
+    """, [month] + scope_params)
+    
+    leaves = frame_from_query(cursor, f"""
+        SELECT employee_id,
+               SUM(CASE WHEN leave_type = 'LOP' THEN 0 ELSE days_requested END) AS paid_leave_days,
+               SUM(CASE WHEN leave_type = 'LOP' THEN days_requested ELSE 0 END) AS lop_days
+        FROM leave_applications
+        WHERE status = 'Approved'
+        AND ((start_date BETWEEN ? AND ?) OR (end_date BETWEEN ? AND ?)){scope}
+        GROUP BY employee_id
+    """, [start_date, end_date, start_date, end_date] + scope_params)
+    
+    frame = employees.merge(attendance, on='employee_id', how='left').merge(leaves, on='employee_id', how='left')
+    totals = ['salary', 'working_days', 'present_days', 'total_hours', 'paid_leave_days', 'lop_days']
+    frame[totals] = frame[totals].apply(pd.to_numeric, errors='coerce').fillna(0).astype(float)
+    return frame
+
+def compute_payroll(frame):
+    """Add earnings, deductions and net pay columns to a load_payroll_inputs() frame"""
+    basic = frame['salary']
+    present = frame['present_days']
+    working_days = frame['working_days']
+    per_day = (basic / working_days.where(working_days > 0)).fillna(0)
+    per_hour = per_day / STANDARD_HOURS_PER_DAY
+    
+    frame['overtime_hours'] = np.maximum(0, frame['total_hours'] - present * STANDARD_HOURS_PER_DAY)
+    frame['absent_days'] = np.maximum(0, working_days - present - frame['paid_leave_days'] - frame['lop_days'])
+    
+    # Earnings
+    frame['basic_earned'] = per_day * present
+    frame['leave_pay'] = per_day * frame['paid_leave_days']
+    frame['overtime_pay'] = per_hour * OVERTIME_MULTIPLIER * frame['overtime_hours']
+    frame['hra'] = basic * HRA_RATE
+    frame['allowances'] = frame['hra'] + CONVEYANCE_ALLOWANCE + MEDICAL_ALLOWANCE
+    
+    # Deductions
+    frame['lop_deduction'] = per_day * frame['lop_days']
+    frame['absent_deduction'] = per_day * frame['absent_days']
+    frame['pf'] = np.minimum(basic, PF_WAGE_CEILING) * PF_RATE
+    frame['professional_tax'] = np.where(basic > PT_THRESHOLD, PROFESSIONAL_TAX, 0)
+    frame['deductions'] = frame['lop_deduction'] + frame['absent_deduction'] + frame['pf'] + frame['professional_tax']
+    
+    frame['gross_salary'] = frame['basic_earned'] + frame['leave_pay'] + frame['overtime_pay'] + frame['allowances']
+    frame['net_pay'] = np.maximum(0, frame['gross_salary'] - frame['deductions'])
+    return frame
+
+def save_payroll(cursor, frame, month, processed_by, marks):
+    """Upsert every computed row into payroll in one executemany; marks are the stale marks read before the inputs"""
+    cursor.executemany(PAYROLL_UPSERT_SQL, list(zip(
+        frame['employee_id'], [month] * len(frame),
+        frame['salary'].tolist(), frame['allowances'].tolist(), frame['overtime_pay'].tolist(),
+        frame['deductions'].tolist(), frame['net_pay'].tolist(),
+        frame['present_days'].astype(int).tolist(),
+        (frame['paid_leave_days'] + frame['lop_days']).tolist(),
+        [processed_by] * len(frame)
+    )))
+    clear_payroll_stale(cursor, month, frame['employee_id'].tolist(), marks)
+
+def payroll_results(frame, month):
+    """calculate_payroll response rows"""
+    results = []
+    for row in frame.itertuples(index=False):
+        results.append({
+            'employee_id': row.employee_id,
+            'employee_name': row.full_name,
+            'department': row.department,
+            'month': month,
+            'basic_salary': round(row.salary, 2),
+            'working_days': int(row.working_days),
+            'present_days': int(row.present_days),
+            'paid_leave_days': row.paid_leave_days,
+            'lop_days': row.lop_days,
+            'absent_days': row.absent_days,
+            'overtime_hours': round(row.overtime_hours, 2),
+            'earnings': {
+                'basic': round(row.basic_earned, 2),
+                'leave_pay': round(row.leave_pay, 2),
+                'overtime': round(row.overtime_pay, 2),
+                'hra': round(row.hra, 2),
+                'conveyance': CONVEYANCE_ALLOWANCE,
+                'medical': MEDICAL_ALLOWANCE
+            },
+            'deductions': {
+                'lop': round(row.lop_deduction, 2),
+                'absent': round(row.absent_deduction, 2),
+                'pf': round(row.pf, 2),
+                'professional_tax': int(row.professional_tax)
+            },
+            'gross_salary': round(row.gross_salary, 2),
+            'total_deductions': round(row.deductions, 2),
+            'net_pay': round(row.net_pay, 2)
+        })
+    return results
+
+# ---- Payroll runs ----
+# A payroll run is a row in payroll_runs worked by a background thread in
+# each app process. Runs are claimed with a conditional UPDATE, so exactly one
+# process works a run. Employees are processed in employee_id order,
+# PAYROLL_CHUNK_SIZE at a time: the chunk is loaded in the runner thread,
+# computed on the PAYROLL_WORKERS pool (several chunks in flight), then saved
+# together with the run's checkpoint (last_employee_id, processed count) in
+# one transaction. A run whose heartbeat goes stale - its process died - is
+# picked up again by any runner and resumes after the checkpoint. Like the
+# bcrypt pool, the worker processes are forked before any thread starts.
+
+PAYROLL_RUN_ACTIVE = ('Queued', 'Running')
+
+class PayrollRunner:
+    """Background worker for payroll_runs with chunked, checkpointed processing"""
+
+    def __init__(self, chunk_size, workers, poll_interval, stale_after, max_attempts, use_processes=True):
+        self.chunk_size = chunk_size
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.stale_after = stale_after
+        self.max_attempts = max_attempts
+        if workers <= 0:
+            self.kind = 'inline'
+            self._executor = None
+        elif use_processes and 'fork' in multiprocessing.get_all_start_methods():
+            self.kind = 'process'
+            self._executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('fork'))
+        else:
+            self.kind = 'thread'
+            self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='payroll')
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self.current_run = None
+        self.counters = {'completed': 0, 'failed': 0, 'resumed': 0, 'chunks': 0, 'employees': 0}
+
+    def _count(self, key, delta=1):
+        with self._lock:
+            self.counters[key] += delta
+
+    def start_pool(self):
+        """Fork the worker processes now rather than on the first chunk"""
+        if self.kind == 'process':
+            # With the fork context the first submit starts every worker at once
+            self._executor.submit(int).result()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='payroll-runner', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def wake(self):
+        """Look for queued runs now instead of at the next poll"""
+        self._wake.set()
+
+    def _run(self):
+        while not self._stop.is_set():
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            try:
+                while not self._stop.is_set():
+                    run = self._claim()
+                    if run is None:
+                        break
+                    self._process(run)
+            except Exception as e:
+                logger.error(f"Payroll runner error: {e}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'payroll_runner'})
+
+    def _claim(self):
+        """Take the oldest queued run, or a running one whose process stopped heartbeating"""
+        conn = get_db_connection()
+        if not conn:
+            return None
+        try:
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""SELECT * FROM payroll_runs
+                    WHERE status = 'Queued' OR (status = 'Running' AND heartbeat_at < ?)
+                    ORDER BY id {db_backend.limit(5)}""",
+                (time.time() - self.stale_after,)
+            )
+            for run in cursor.fetchall():
+                if run['attempts'] >= self.max_attempts:
+                    cursor.execute(
+                        f"""UPDATE payroll_runs SET status = 'Failed', error = ?, finished_at = {db_backend.now}
+                            WHERE id = ? AND status = ? AND attempts = ?""",
+                        (f"Gave up after {run['attempts']} attempts", run['id'], run['status'], run['attempts'])
+                    )
+                    conn.commit()
+                    continue
+                token = secrets.token_hex(16)
+                cursor.execute(
+                    f"""UPDATE payroll_runs
+                        SET status = 'Running', claim_token = ?, heartbeat_at = ?, attempts = attempts + 1,
+                            error = NULL, started_at = COALESCE(started_at, {db_backend.now})
+                        WHERE id = ? AND status = ? AND attempts = ?""",
+                    (token, time.time(), run['id'], run['status'], run['attempts'])
+                )
+                if cursor.rowcount == 1:  # nobody else got there first
+                    conn.commit()
+                    if run['status'] == 'Running' or run['last_employee_id']:
+                        self._count('resumed')
+                    return dict(run, claim_token=token)
+            conn.commit()
+            return None
+        finally:
+            conn.close()
+
+    def _next_chunk(self, cursor, run, after):
+        if run['employee_id']:
+            return [run['employee_id']] if after is None else []
+        cursor.execute(
+            f"""SELECT employee_id FROM users
+                WHERE is_active = 1 AND role = 'Employee' AND employee_id > ?
+                ORDER BY employee_id {db_backend.limit(self.chunk_size)}""",
+            (after or '',)
+        )
+        return [row['employee_id'] for row in cursor.fetchall()]
+
+    def _compute(self, frame):
+        if self._executor is None:
+            return _ImmediateResult(compute_payroll(frame))
+        return self._executor.submit(compute_payroll, frame)
+
+    def _process(self, run):
+        run_id, token, month = run['id'], run['claim_token'], run['month']
+        self.current_run = run_id
+        conn = get_db_connection()
+        try:
+            cursor = conn.cursor()
+            if run['total_employees'] is None:
+                if run['employee_id']:
+                    total = 1
+                else:
+                    cursor.execute("SELECT COUNT(*) AS total FROM users WHERE is_active = 1 AND role = 'Employee'")
+                    total = cursor.fetchone()['total']
+                cursor.execute("UPDATE payroll_runs SET total_employees = ? WHERE id = ?", (total, run_id))
+                conn.commit()
             
-            csv_content = output.getvalue()
+            in_flight = deque()  # (future, stale marks, last employee_id in chunk, chunk size), oldest first
+            after = run['last_employee_id']
+            while True:
+                ids = self._next_chunk(cursor, run, after)
+                if ids:
+                    marks = payroll_stale_marks(cursor, month)
+                    frame = load_payroll_inputs(cursor, month, ids)
+                    in_flight.append((self._compute(frame), marks, ids[-1], len(ids)))
+                    after = ids[-1]
+                if in_flight and (not ids or len(in_flight) >= max(1, self.workers)):
+                    # Save strictly in order so the checkpoint only ever moves past saved rows
+                    future, marks, chunk_last, chunk_size = in_flight.popleft()
+                    save_payroll(cursor, future.result(), month, run['requested_by'], marks)
+                    cursor.execute(
+                        """UPDATE payroll_runs
+                           SET processed_employees = processed_employees + ?, last_employee_id = ?, heartbeat_at = ?
+                           WHERE id = ? AND claim_token = ? AND status = 'Running'""",
+                        (chunk_size, chunk_last, time.time(), run_id, token)
+                    )
+                    if cursor.rowcount != 1:
+                        # Cancelled, or another process took the run over - drop this chunk
+                        conn.rollback()
+                        logger.warning(f"Payroll run {run_id} stopped: no longer owned by this worker")
+                        return
+                    conn.commit()
+                    self._count('chunks')
+                    self._count('employees', chunk_size)
+                if not ids and not in_flight:
+                    break
+                if self._stop.is_set():
+                    return  # the heartbeat goes stale and the run resumes elsewhere / after restart
             
-            from flask import Response
-            return Response(
-                csv_content,
-                mimetype='text/csv',
-                headers={'Content-Disposition': f'attachment; filename=leave_report_{date_from}_to_{date_to}.csv'}
+            cursor.execute(
+                f"""UPDATE payroll_runs SET status = 'Completed', finished_at = {db_backend.now}
+                    WHERE id = ? AND claim_token = ? AND status = 'Running'""",
+                (run_id, token)
             )
-        
-        return jsonify({
-            'leaves': [dict(l) for l in leaves],
-            'summary_by_type': [dict(s) for s in summary_by_type],
-            'total': len(leaves),
-            'period': {'from': date_from, 'to': date_to}
-        }), 200
-        
-    except Exception as e:
-        logger.error(f"Leave report error: {e}")
-        return jsonify({'error': 'Failed to generate report'}), 500
+            conn.commit()
+            self._count('completed')
+            audit_log('PAYROLL_CALCULATED', run['requested_by'], {'month': month, 'run_id': run_id})
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Payroll run {run_id} failed: {e}", extra={'user': 'SYSTEM', 'ip': '-', 'endpoint': 'payroll_runner'})
+            if isinstance(e, BrokenProcessPool):
+                # Forking a new pool now would copy the running threads' locks; later runs use threads
+                self._executor.shutdown(wait=False)
+                self.kind = 'thread'
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='payroll')
+            cursor = conn.cursor()
+            cursor.execute(
+                f"""UPDATE payroll_runs SET status = 'Failed', error = ?, finished_at = {db_backend.now}
+                    WHERE id = ? AND claim_token = ?""",
+                (str(e), run_id, token)
+            )
+            conn.commit()
+            self._count('failed')
+        finally:
+            self.current_run = None
+            conn.close()
 
+    def stop(self, timeout=10):
+        if self._thread is None or self._stop.is_set():
+            return
+        self._stop.set()
+        self._wake.set()
+        self._thread.join(timeout)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
 
-@app.route('/api/hr/departments', methods=['GET'])
-@jwt_required()
-def get_departments():
-    """Get list of departments"""
-    try:
-        conn = get_db_connection()
-        if not conn:
-            return jsonify({'error': 'Database connection failed'}), 500
-        
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT DISTINCT department, COUNT(*) as employee_count
-            FROM users 
-            WHERE department IS NOT NULL AND department != '' AND is_active = 1
-            GROUP BY department
-            ORDER BY department
-        """)
-        departments = cursor.fetchall()
-        conn.close()
-        
-        return jsonify({
-            'departments': [{'name': d['department'], 'count': d['employee_count']} for d in departments]
-        }), 200
-        
-    except Exception as e:
-        logger.error(f"Get departments error: {e}")
-        return jsonify({'error': 'Failed to fetch departments'}), 500
+    def stats(self):
+        with self._lock:
+            return dict(self.counters, kind=self.kind, workers=self.workers, current_run=self.current_run)
 
 
-# ============== PAYROLL MANAGEMENT APIs ==============
+class _ImmediateResult:
+    """Future-like wrapper for chunks computed inline (PAYROLL_WORKERS=0)"""
+
+    def __init__(self, value):
+        self._value = value
+
+    def result(self):
+        return self._value
+
+
+payroll_runner = PayrollRunner(
+    chunk_size=app_config.PAYROLL_CHUNK_SIZE,
+    workers=app_config.PAYROLL_WORKERS,
+    poll_interval=app_config.PAYROLL_POLL_INTERVAL,
+    stale_after=app_config.PAYROLL_RUN_STALE_AFTER,
+    max_attempts=app_config.PAYROLL_RUN_MAX_ATTEMPTS,
+    use_processes=app_config.PAYROLL_USE_PROCESSES
+)
+
+def payroll_run_status(run):
+    """API view of a payroll_runs row"""
+    total = run['total_employees']
+    return {
+        'run_id': run['id'],
+        'month': run['month'],
+        'employee_id': run['employee_id'],
+        'status': run['status'],
+        'total_employees': total,
+        'processed_employees': run['processed_employees'],
+        'percent': round(100.0 * run['processed_employees'] / total, 1) if total else (100.0 if run['status'] == 'Completed' else 0.0),
+        'attempts': run['attempts'],
+        'error': run['error'],
+        'requested_by': run['requested_by'],
+        'created_at': str(run['created_at']) if run['created_at'] else None,
+        'started_at': str(run['started_at']) if run['started_at'] else None,
+        'finished_at': str(run['finished_at']) if run['finished_at'] else None
+    }
 
 @app.route('/api/hr/payroll/salary-config', methods=['GET'])
 @jwt_required()
@@ -3097,6 +6975,10 @@ def calculate_payroll():
         
         if not month:
             return jsonify({'error': 'Month is required (YYYY-MM format)'}), 400
+        try:
+            datetime.strptime(month, '%Y-%m')
+        except ValueError:
+            return jsonify({'error': 'Month is required (YYYY-MM format)'}), 400
         
         conn = get_db_connection()
         if not conn:
@@ -3104,158 +6986,16 @@ def calculate_payroll():
         
         cursor = conn.cursor()
         
-        # Get employees to process
-        if employee_id:
-            cursor.execute("""
-                SELECT employee_id, full_name, department, salary, employee_category
-                FROM users WHERE employee_id = ? AND is_active = 1
-            """, (employee_id,))
-        else:
-            cursor.execute("""
-                SELECT employee_id, full_name, department, salary, employee_category
-                FROM users WHERE is_active = 1 AND role = 'Employee'
-            """)
-        
-        employees = cursor.fetchall()
-        
-        # Get month date range
-        year, mon = month.split('-')
-        start_date = f"{month}-01"
-        # Get last day of month
-        import calendar
-        last_day = calendar.monthrange(int(year), int(mon))[1]
-        end_date = f"{month}-{last_day:02d}"
-        
-        # Calculate working days (excluding Sundays)
-        from datetime import date, timedelta
-        total_working_days = 0
-        current = date(int(year), int(mon), 1)
-        end = date(int(year), int(mon), last_day)
-        while current <= end:
-            if current.weekday() != 6:  # Not Sunday
-                total_working_days += 1
-            current += timedelta(days=1)
-        
-        results = []
-        
-        for emp in employees:
-            emp_id = emp['employee_id']
-            basic_salary = emp['salary'] or 0
-            
-            # Get attendance data for the month
-            cursor.execute("""
-                SELECT COUNT(*) as present_days,
-                       SUM(CASE WHEN is_late = 1 THEN 1 ELSE 0 END) as late_days,
-                       SUM(COALESCE(hours_worked, 0)) as total_hours
-                FROM attendance
-                WHERE employee_id = ? AND date BETWEEN ? AND ? AND status = 'Present'
-            """, (emp_id, start_date, end_date))
-            attendance = cursor.fetchone()
-            
-            present_days = attendance['present_days'] or 0
-            total_hours = attendance['total_hours'] or 0
-            
-            # Get approved leaves for the month
-            cursor.execute("""
-                SELECT leave_type, SUM(total_days) as days
-                FROM leave_applications
-                WHERE employee_id = ? 
-                AND status = 'Approved'
-                AND ((start_date BETWEEN ? AND ?) OR (end_date BETWEEN ? AND ?))
-                GROUP BY leave_type
-            """, (emp_id, start_date, end_date, start_date, end_date))
-            leaves = cursor.fetchall()
-            
-            paid_leave_days = 0
-            lop_days = 0
-            
-            for leave in leaves:
-                if leave['leave_type'] == 'LOP':
-                    lop_days += leave['days'] or 0
-                else:
-                    paid_leave_days += leave['days'] or 0
-            
-            # Calculate overtime (hours beyond 8 per day)
-            expected_hours = present_days * 8
-            overtime_hours = max(0, total_hours - expected_hours)
-            
-            # Calculate per day salary
-            per_day_salary = basic_salary / total_working_days if total_working_days > 0 else 0
-            per_hour_salary = per_day_salary / 8 if per_day_salary > 0 else 0
-            
-            # Calculate components
-            absent_days = total_working_days - present_days - paid_leave_days - lop_days
-            absent_days = max(0, absent_days)  # Can't be negative
-            
-            # Earnings
-            basic_earned = per_day_salary * present_days
-            leave_pay = per_day_salary * paid_leave_days
-            overtime_pay = per_hour_salary * 1.5 * overtime_hours  # 1.5x for overtime
-            
-            # Standard allowances (can be customized)
-            hra = basic_salary * 0.1  # 10% HRA
-            conveyance = 1600  # Fixed conveyance
-            medical = 1250  # Fixed medical
-            total_allowances = hra + conveyance + medical
-            
-            # Deductions
-            lop_deduction = per_day_salary * lop_days
-            absent_deduction = per_day_salary * absent_days
-            
-            # Standard deductions
-            pf = basic_salary * 0.12 if basic_salary <= 15000 else 15000 * 0.12  # PF
-            professional_tax = 200 if basic_salary > 10000 else 0  # PT
-            
-            total_deductions = lop_deduction + absent_deduction + pf + professional_tax
-            
-            # Calculate gross and net
-            gross_salary = basic_earned + leave_pay + overtime_pay + total_allowances
-            net_pay = gross_salary - total_deductions
-            net_pay = max(0, net_pay)  # Can't be negative
-            
-            # Save to payroll table
-            cursor.execute("""
-                INSERT OR REPLACE INTO payroll 
-                (employee_id, month, basic_salary, allowances, overtime_pay, deductions, net_pay, 
-                 worked_days, leave_days, processed_by, processed_at)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, datetime('now'))
-            """, (emp_id, month, basic_salary, total_allowances, overtime_pay, total_deductions, 
-                  net_pay, present_days, paid_leave_days + lop_days, username))
-            
-            results.append({
-                'employee_id': emp_id,
-                'employee_name': emp['full_name'],
-                'department': emp['department'],
-                'month': month,
-                'basic_salary': round(basic_salary, 2),
-                'working_days': total_working_days,
-                'present_days': present_days,
-                'paid_leave_days': paid_leave_days,
-                'lop_days': lop_days,
-                'absent_days': absent_days,
-                'overtime_hours': round(overtime_hours, 2),
-                'earnings': {
-                    'basic': round(basic_earned, 2),
-                    'leave_pay': round(leave_pay, 2),
-                    'overtime': round(overtime_pay, 2),
-                    'hra': round(hra, 2),
-                    'conveyance': conveyance,
-                    'medical': medical
-                },
-                'deductions': {
-                    'lop': round(lop_deduction, 2),
-                    'absent': round(absent_deduction, 2),
-                    'pf': round(pf, 2),
-                    'professional_tax': professional_tax
-                },
-                'gross_salary': round(gross_salary, 2),
-                'total_deductions': round(total_deductions, 2),
-                'net_pay': round(net_pay, 2)
-            })
+        marks = payroll_stale_marks(cursor, month)
+        frame = load_payroll_inputs(cursor, month, [employee_id] if employee_id else None)
+        compute_payroll(frame)
+        save_payroll(cursor, frame, month, username, marks)
         
         conn.commit()
         conn.close()
         
+        results = payroll_results(frame, month)
+        
         audit_log('PAYROLL_CALCULATED', username, {'month': month, 'employees_processed': len(results)})
         
         return jsonify({
@@ -3269,6 +7009,219 @@ def calculate_payroll():
         return jsonify({'error': f'Failed to calculate payroll: {str(e)}'}), 500
 
 
+@app.route('/api/hr/payroll/recalculate', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def recalculate_stale_payroll():
+    """Recompute only the payroll rows marked stale by attendance/leave changes"""
+    try:
+        username = get_jwt_identity()
+        data = request.get_json(silent=True) or {}
+        month = data.get('month')  # Optional - if not provided, every month with stale rows
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        query = "SELECT employee_id, month FROM payroll_stale"
+        params = []
+        if month:
+            query += " WHERE month = ?"
+            params.append(month)
+        cursor.execute(query + " ORDER BY month, employee_id", params)
+        
+        stale = {}
+        for row in cursor.fetchall():
+            stale.setdefault(row['month'], []).append(row['employee_id'])
+        
+        recalculated = {}
+        chunk = app_config.PAYROLL_CHUNK_SIZE
+        for stale_month, employee_ids in stale.items():
+            count = 0
+            for i in range(0, len(employee_ids), chunk):
+                ids = employee_ids[i:i + chunk]
+                marks = payroll_stale_marks(cursor, stale_month)
+                frame = load_payroll_inputs(cursor, stale_month, ids)
+                compute_payroll(frame)
+                save_payroll(cursor, frame, stale_month, username, marks)
+                # Deactivated employees can't be recomputed - their marks go too
+                clear_payroll_stale(cursor, stale_month, ids, marks)
+                count += len(frame)
+            conn.commit()
+            recalculated[stale_month] = count
+        
+        conn.close()
+        
+        total = sum(recalculated.values())
+        audit_log('PAYROLL_RECALCULATED', username, {'months': recalculated})
+        
+        return jsonify({
+            'message': f'Recalculated {total} stale payroll rows',
+            'recalculated': total,
+            'months': recalculated
+        }), 200
+        
+    except Exception as e:
+        logger.error(f"Recalculate payroll error: {e}")
+        return jsonify({'error': 'Failed to recalculate payroll'}), 500
+
+
+@app.route('/api/hr/payroll/runs', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def start_payroll_run():
+    """Queue a payroll run for a month; poll GET /api/hr/payroll/runs/<id> for progress"""
+    try:
+        username = get_jwt_identity()
+        data = request.get_json() or {}
+        month = data.get('month')  # Format: YYYY-MM
+        employee_id = data.get('employee_id')  # Optional - if not provided, run for all
+        
+        try:
+            datetime.strptime(month or '', '%Y-%m')
+        except ValueError:
+            return jsonify({'error': 'Month is required (YYYY-MM format)'}), 400
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        
+        # One active run per month - hand back the one already going
+        cursor.execute(
+            f"SELECT * FROM payroll_runs WHERE month = ? AND status IN (?, ?) ORDER BY id {db_backend.limit(1)}",
+            (month, *PAYROLL_RUN_ACTIVE)
+        )
+        active = cursor.fetchone()
+        if active:
+            conn.close()
+            return jsonify({'error': f'Payroll for {month} is already being processed', **payroll_run_status(active)}), 409
+        
+        cursor.execute(
+            "INSERT INTO payroll_runs (month, employee_id, requested_by) VALUES (?, ?, ?)",
+            (month, employee_id, username)
+        )
+        run_id = cursor.lastrowid
+        conn.commit()
+        conn.close()
+        payroll_runner.wake()
+        
+        audit_log('PAYROLL_RUN_QUEUED', username, {'month': month, 'run_id': run_id, 'employee_id': employee_id})
+        
+        return jsonify({
+            'message': f'Payroll run queued for {month}',
+            'run_id': run_id,
+            'status': 'Queued',
+            'status_url': f'/api/hr/payroll/runs/{run_id}'
+        }), 202
+        
+    except Exception as e:
+        logger.error(f"Start payroll run error: {e}")
+        return jsonify({'error': 'Failed to start payroll run'}), 500
+
+
+@app.route('/api/hr/payroll/runs', methods=['GET'])
+@role_required('HR', 'Admin', 'MD')
+def list_payroll_runs():
+    """Recent payroll runs, optionally for one month"""
+    try:
+        month = request.args.get('month')
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        query = "SELECT * FROM payroll_runs"
+        params = []
+        if month:
+            query += " WHERE month = ?"
+            params.append(month)
+        cursor.execute(query + f" ORDER BY id DESC {db_backend.limit(50)}", params)
+        runs = cursor.fetchall()
+        conn.close()
+        
+        return jsonify({'runs': [payroll_run_status(run) for run in runs]}), 200
+        
+    except Exception as e:
+        logger.error(f"List payroll runs error: {e}")
+        return jsonify({'error': 'Failed to fetch payroll runs'}), 500
+
+
+@app.route('/api/hr/payroll/runs/<int:run_id>', methods=['GET'])
+@role_required('HR', 'Admin', 'MD')
+def get_payroll_run(run_id):
+    """Progress of one payroll run"""
+    try:
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM payroll_runs WHERE id = ?", (run_id,))
+        run = cursor.fetchone()
+        conn.close()
+        
+        if not run:
+            return jsonify({'error': 'Payroll run not found'}), 404
+        
+        return jsonify(payroll_run_status(run)), 200
+        
+    except Exception as e:
+        logger.error(f"Get payroll run error: {e}")
+        return jsonify({'error': 'Failed to fetch payroll run'}), 500
+
+
+@app.route('/api/hr/payroll/runs/<int:run_id>/<action>', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def control_payroll_run(run_id, action):
+    """Cancel an active run, or resume a failed/cancelled one from its checkpoint"""
+    try:
+        username = get_jwt_identity()
+        
+        if action == 'cancel':
+            from_statuses, to_status, done = PAYROLL_RUN_ACTIVE, 'Cancelled', 'cancelled'
+        elif action == 'resume':
+            from_statuses, to_status, done = ('Failed', 'Cancelled'), 'Queued', 'resumed'
+        else:
+            return jsonify({'error': 'Unknown action. Use: cancel or resume'}), 404
+        
+        conn = get_db_connection()
+        if not conn:
+            return jsonify({'error': 'Database connection failed'}), 500
+        
+        cursor = conn.cursor()
+        if to_status == 'Cancelled':
+            cursor.execute(
+                f"""UPDATE payroll_runs SET status = 'Cancelled', finished_at = {db_backend.now}
+                    WHERE id = ? AND status IN (?, ?)""",
+                (run_id, *from_statuses)
+            )
+        else:
+            cursor.execute(
+                """UPDATE payroll_runs SET status = 'Queued', attempts = 0, error = NULL, finished_at = NULL
+                   WHERE id = ? AND status IN (?, ?)
+                   AND NOT EXISTS (SELECT 1 FROM payroll_runs other
+                                   WHERE other.month = payroll_runs.month AND other.status IN ('Queued', 'Running'))""",
+                (run_id, *from_statuses)
+            )
+        changed = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        
+        if not changed:
+            return jsonify({'error': f'Payroll run cannot be {done} in its current state'}), 409
+        
+        if to_status == 'Queued':
+            payroll_runner.wake()
+        audit_log(f'PAYROLL_RUN_{action.upper()}', username, {'run_id': run_id})
+        return jsonify({'message': f'Payroll run {done}', 'run_id': run_id, 'status': to_status}), 200
+        
+    except Exception as e:
+        logger.error(f"Payroll run {action} error: {e}")
+        return jsonify({'error': f'Failed to {action} payroll run'}), 500
+
+
 @app.route('/api/hr/payroll', methods=['GET'])
 @jwt_required()
 def get_payroll_list():
@@ -3292,14 +7245,20 @@ def get_payroll_list():
         
         cursor = conn.cursor()
         cursor.execute("""
-            SELECT p.*, u.full_name, u.department, u.designation
+            SELECT p.*, u.full_name, u.department, u.designation,
+                   CASE WHEN s.employee_id IS NULL THEN 0 ELSE 1 END AS is_stale,
+                   s.reason AS stale_reason
             FROM payroll p
             JOIN users u ON p.employee_id = u.employee_id
+            LEFT JOIN payroll_stale s ON s.employee_id = p.employee_id AND s.month = p.month
             WHERE p.month = ?
             ORDER BY u.department, u.full_name
         """, (month,))
         payroll = cursor.fetchall()
         
+        cursor.execute("SELECT COUNT(*) AS stale FROM payroll_stale WHERE month = ?", (month,))
+        stale_count = cursor.fetchone()['stale']
+        
         # Get summary
         cursor.execute("""
             SELECT 
@@ -3324,7 +7283,8 @@ def get_payroll_list():
                 'total_allowances': round(summary['total_allowances'] or 0, 2),
                 'total_overtime': round(summary['total_overtime'] or 0, 2),
                 'total_deductions': round(summary['total_deductions'] or 0, 2),
-                'total_net_pay': round(summary['total_net_pay'] or 0, 2)
+                'total_net_pay': round(summary['total_net_pay'] or 0, 2),
+                'stale_employees': stale_count
             }
         }), 200
         
@@ -3359,7 +7319,7 @@ def get_payslip(employee_id):
         # Get employee details
         cursor.execute("""
             SELECT u.employee_id, u.full_name, u.email, u.department, u.designation, 
-                   u.employee_category, u.hire_date, u.salary
+                   u.employee_category, u.shift, u.hire_date, u.salary
             FROM users u WHERE u.employee_id = ?
         """, (employee_id,))
         employee = cursor.fetchone()
@@ -3379,13 +7339,11 @@ def get_payslip(employee_id):
             return jsonify({'error': 'Payroll not found for this month. Please process payroll first.'}), 404
         
         # Get company name
-        cursor.execute("SELECT setting_value FROM system_settings WHERE setting_key = 'company_name'")
-        company_row = cursor.fetchone()
-        company_name = company_row['setting_value'] if company_row else 'VES Engineering Services'
+        company_name = get_system_setting('company_name', 'VES Engineering Services')
         
         # Calculate breakdown
         basic_salary = payroll['basic_salary']
-        total_working_days = 26  # Approximate
+        total_working_days = work_calendar.working_days(month, employee['employee_category'], employee['shift'])
         per_day = basic_salary / total_working_days if total_working_days > 0 else 0
         
         # Standard breakdown
@@ -3482,9 +7440,7 @@ def get_my_payslip():
             return jsonify({'error': 'Payslip not available for this month'}), 404
         
         # Get company name
-        cursor.execute("SELECT setting_value FROM system_settings WHERE setting_key = 'company_name'")
-        company_row = cursor.fetchone()
-        company_name = company_row['setting_value'] if company_row else 'VES Engineering Services'
+        company_name = get_system_setting('company_name', 'VES Engineering Services')
         
         basic_salary = payroll['basic_salary']
         hra = basic_salary * 0.1
@@ -3554,12 +7510,12 @@ def get_payslip_history():
             conn.close()
             return jsonify({'error': 'Employee not found'}), 404
         
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT month, basic_salary, net_pay, processed_at
             FROM payroll 
             WHERE employee_id = ?
             ORDER BY month DESC
-            LIMIT 12
+            {db_backend.limit(12)}
         """, (emp['employee_id'],))
         history = cursor.fetchall()
         conn.close()
@@ -3614,23 +7570,23 @@ def get_today_meal_token():
     """Get today's meal token status"""
     try:
         username = get_jwt_identity()
-        today = datetime.now().date().isoformat()
         
         conn = get_db_connection()
         if not conn:
             return jsonify({'error': 'Database connection failed'}), 500
         
         cursor = conn.cursor()
-        # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
-        
         employee_id = user['employee_id']
         
+        # Tokens are issued under the work date, so a night shift's breakfast
+        # after midnight is still the token from the evening's check-in
+        today = work_date_for(datetime.now(), user['shift'])
+        
         # Get today's meal token
         cursor.execute("""
             SELECT id, token_date, shift, meal_type, status, generated_at, used_at 
@@ -3660,7 +7616,6 @@ def get_today_meal_token():
 def get_meal_token_history():
     """Get meal token history for current month"""
     try:
-        username = get_jwt_identity()
         days = request.args.get('days', 30, type=int)
         
         conn = get_db_connection()
@@ -3669,20 +7624,17 @@ def get_meal_token_history():
         
         cursor = conn.cursor()
         # Get employee_id
-        cursor.execute("SELECT employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        employee_id = get_current_employee_id()
         
-        if not user:
+        if not employee_id:
             conn.close()
             return jsonify({'error': 'User not found'}), 404
         
-        employee_id = user['employee_id']
-        
         # Get token history
-        cursor.execute("""
+        cursor.execute(f"""
             SELECT id, token_date, shift, meal_type, status, generated_at, used_at 
             FROM meal_tokens 
-            WHERE employee_id = ? AND token_date >= date('now', '-' || ? || ' days')
+            WHERE employee_id = ? AND token_date >= {db_backend.days_ago()}
             ORDER BY token_date DESC
         """, (employee_id, days))
         
@@ -3724,8 +7676,7 @@ def get_hr_meal_report():
         cursor = conn.cursor()
         
         # Check if user is HR
-        cursor.execute("SELECT role FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         if not user or user['role'] not in ['HR', 'Admin', 'MD']:
             conn.close()
             return jsonify({'error': 'Unauthorized access'}), 403
@@ -3812,11 +7763,7 @@ def generate_meal_token():
         cursor = conn.cursor()
         
         # Get user details
-        cursor.execute("""
-            SELECT employee_id, employee_category, shift, name 
-            FROM users WHERE username = ?
-        """, (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
@@ -3834,7 +7781,8 @@ def generate_meal_token():
         meal_type_map = {1: 'Lunch', 2: 'Dinner', 3: 'Breakfast'}
         meal_type = meal_type_map.get(shift, 'Lunch')
         
-        today = datetime.now().strftime('%Y-%m-%d')
+        # The work date check-in issues its token under
+        today = work_date_for(datetime.now(), user['shift'])
         
         # Check if token already exists for today
         cursor.execute("""
@@ -3854,9 +7802,9 @@ def generate_meal_token():
         # Generate token
         token_id = f"MTK-{today.replace('-', '')}-{employee_id}"
         
-        cursor.execute("""
+        cursor.execute(f"""
             INSERT INTO meal_tokens (employee_id, token_date, shift, meal_type, status, generated_at)
-            VALUES (?, ?, ?, ?, 'Issued', datetime('now'))
+            VALUES (?, ?, ?, ?, 'Issued', {db_backend.now})
         """, (employee_id, today, shift, meal_type))
         
         conn.commit()
@@ -3892,8 +7840,7 @@ def mark_token_used(token_id):
         cursor = conn.cursor()
         
         # Get user role
-        cursor.execute("SELECT role, employee_id FROM users WHERE username = ?", (username,))
-        user = cursor.fetchone()
+        user = resolve_identity(username)
         
         if not user:
             conn.close()
@@ -3921,9 +7868,9 @@ def mark_token_used(token_id):
             return jsonify({'error': 'Cannot use a cancelled token'}), 409
         
         # Mark as used
-        cursor.execute("""
+        cursor.execute(f"""
             UPDATE meal_tokens 
-            SET status = 'Used', used_at = datetime('now')
+            SET status = 'Used', used_at = {db_backend.now}
             WHERE id = ?
         """, (token_id,))
         
@@ -4007,14 +7954,17 @@ def update_settings():
             if 'password' in key.lower() and value == '••••••••':
                 continue
             
-            cursor.execute("""
+            cursor.execute(f"""
                 UPDATE system_settings 
-                SET setting_value = ?, updated_by = ?, updated_at = datetime('now')
+                SET setting_value = ?, updated_by = ?, updated_at = {db_backend.now}
                 WHERE setting_key = ?
             """, (value, username, key))
         
+        # Tell every worker's settings cache to reload
+        cursor.execute("UPDATE settings_version SET version = version + 1 WHERE id = 1")
         conn.commit()
         conn.close()
+        settings_cache.invalidate()
         
         audit_log('SETTINGS_UPDATED', username, {'keys': list(settings_to_update.keys())})
         
@@ -4081,17 +8031,18 @@ def test_email_settings():
         </html>
         """
         
-        success = send_email(test_email, subject, html_content)
+        outbox_id = send_email(test_email, subject, html_content, purpose='test')
         
-        if success:
+        if outbox_id:
             audit_log('EMAIL_TEST_SENT', username, {'to': test_email})
             return jsonify({
-                'message': f'Test email sent successfully to {test_email}',
+                'message': f'Test email queued for {test_email} - check the email outbox for delivery status',
+                'outbox_id': outbox_id,
                 'success': True
             }), 200
         else:
             return jsonify({
-                'error': 'Failed to send test email. Check SMTP settings.',
+                'error': 'Failed to queue test email.',
                 'success': False
             }), 400
         
@@ -4100,6 +8051,115 @@ def test_email_settings():
         return jsonify({'error': f'Email test failed: {str(e)}'}), 500
 
 
+@app.route('/api/hr/email-outbox', methods=['GET'])
+@role_required('HR', 'Admin', 'MD')
+def get_email_outbox():
+    """Recent outbound emails with their delivery status"""
+    try:
+        status = request.args.get('status')
+        limit = min(request.args.get('limit', 100, type=int), 500)
+        
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        
+        query = """SELECT id, to_email, subject, purpose, status, attempts, next_attempt_at,
+                          last_error, created_at, sent_at
+                   FROM email_outbox"""
+        params = []
+        if status:
+            query += " WHERE status = ?"
+            params.append(status)
+        query += f" ORDER BY id DESC {db_backend.limit(limit)}"
+        cursor.execute(query, params)
+        emails = []
+        for row in cursor.fetchall():
+            email = dict(row)
+            if email['status'] == 'Pending':
+                email['next_attempt_at'] = datetime.fromtimestamp(email['next_attempt_at']).isoformat()
+            else:
+                email['next_attempt_at'] = None
+            emails.append(email)
+        
+        cursor.execute("SELECT status, COUNT(*) AS count FROM email_outbox GROUP BY status")
+        counts = {row['status']: row['count'] for row in cursor.fetchall()}
+        conn.close()
+        
+        return jsonify({'emails': emails, 'counts': counts}), 200
+    except Exception as e:
+        logger.error(f"Get email outbox error: {e}")
+        return jsonify({'error': 'Failed to fetch email outbox'}), 500
+
+
+@app.route('/api/hr/email-outbox/<int:outbox_id>/retry', methods=['POST'])
+@role_required('HR', 'Admin', 'MD')
+def retry_outbox_email(outbox_id):
+    """Put a failed or skipped email back in the queue"""
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        cursor.execute(
+            """UPDATE email_outbox SET status = 'Pending', attempts = 0, next_attempt_at = ?, last_error = NULL
+               WHERE id = ? AND status IN ('Failed', 'Skipped')""",
+            (time.time(), outbox_id)
+        )
+        requeued = cursor.rowcount == 1
+        conn.commit()
+        conn.close()
+        
+        if not requeued:
+            return jsonify({'error': 'Email not found or not in a failed state'}), 404
+        
+        email_outbox.wake()
+        audit_log('EMAIL_RETRY', get_jwt_identity(), {'outbox_id': outbox_id})
+        return jsonify({'message': 'Email queued for retry'}), 200
+    except Exception as e:
+        logger.error(f"Retry email error: {e}")
+        return jsonify({'error': 'Failed to retry email'}), 500
+
+
+@app.route('/api/admin/metrics', methods=['GET'])
+@role_required('HR', 'Admin', 'MD')
+def get_runtime_metrics():
+    """Counters for the in-process pools, caches and background writers"""
+    try:
+        return jsonify({
+            'database': dict(db_pool.stats(), backend=db_backend.name, query_plan_problems=QUERY_PLAN_PROBLEMS),
+            'identity_cache': IDENTITY_CACHE.stats(),
+            'filter_options_cache': FILTER_OPTIONS_CACHE.stats(),
+            'audit_writer': audit_writer.stats(),
+            'token_revocations': token_revocations.stats(),
+            'password_hasher': password_hasher.stats(),
+            'payroll_runner': payroll_runner.stats(),
+            'checkin_writer': checkin_writer.stats(),
+            'punch_watcher': punch_watcher.stats(),
+            'settings_cache': settings_cache.stats(),
+            'work_calendar': work_calendar.stats(),
+            'email_outbox': email_outbox.stats(),
+            'logging': log_pipeline.stats()
+        }), 200
+    except Exception as e:
+        logger.error(f"Get metrics error: {e}")
+        return jsonify({'error': 'Failed to fetch metrics'}), 500
+
+
+# ============== BACKGROUND SERVICES ==============
+# Everything above only builds the services; they all start here. The process
+# pools come first: their workers are forked, and a fork taken while the log
+# listener or a writer thread is running copies whatever lock that thread held
+# at that instant into every child. They also have to come after
+# compute_payroll is defined, because a forked worker only sees the module as
+# far as it had run. Log records from the import itself wait in the queue
+# until the listener starts.
+password_hasher.start_pool()
+payroll_runner.start_pool()
+log_pipeline.start()
+audit_writer.start()
+email_outbox.start()
+checkin_writer.start()
+punch_watcher.start()
+payroll_runner.start()
+
+
 if __name__ == '__main__':
     print("🚀 VES HRMS Backend Starting...")
     print("📍 Backend URL: http://localhost:5000")
@@ -53,6 +53,8 @@ const HRDashboard = () => {
   // Attendance Management States
   const [hrAttendance, setHrAttendance] = useState([]);
   const [hrAttendanceLoading, setHrAttendanceLoading] = useState(false);
+  const [hrAttendanceCursor, setHrAttendanceCursor] = useState(null);
+  const [hrAttendanceTotal, setHrAttendanceTotal] = useState(0);
   const [attendanceFilters, setAttendanceFilters] = useState({
     date_from: new Date().toISOString().split('T')[0],
     date_to: new Date().toISOString().split('T')[0],
@@ -88,6 +90,7 @@ const HRDashboard = () => {
   const [payrollSummary, setPayrollSummary] = useState(null);
   const [payrollLoading, setPayrollLoading] = useState(false);
   const [processingPayroll, setProcessingPayroll] = useState(false);
+  const [payrollProgress, setPayrollProgress] = useState(null);
   const [salaryConfigs, setSalaryConfigs] = useState([]);
   const [editSalaryModal, setEditSalaryModal] = useState({ show: false, employee: null });
   const [payslipModal, setPayslipModal] = useState({ show: false, data: null });
@@ -136,7 +139,7 @@ const HRDashboard = () => {
   const fetchPendingLeaves = async (status = 'Pending') => {
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch(`http://localhost:5000/api/hr/leaves?status=${status}`, {
+      const response = await fetch(`http://localhost:5000/api/hr/leaves?status=${status}&include_total=true`, {
         headers: { 'Authorization': `Bearer ${token}` }
       });
       
@@ -145,7 +148,7 @@ const HRDashboard = () => {
         setPendingLeaves(data.leaves || []);
         // Update stats
         if (status === 'Pending') {
-          setStats(prev => ({ ...prev, pendingApprovals: data.leaves?.length || 0 }));
+          setStats(prev => ({ ...prev, pendingApprovals: data.total ?? (data.leaves?.length || 0) }));
         }
       }
     } catch (error) {
@@ -390,15 +393,21 @@ const HRDashboard = () => {
     setEmployeeListLoading(true);
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch('http://localhost:5000/api/hr/employees', {
-        headers: { 'Authorization': `Bearer ${token}` }
-      });
-      
-      if (response.ok) {
+      // The directory is searched client-side, so collect every page
+      let employees = [];
+      let cursor = null;
+      do {
+        const response = await fetch(`http://localhost:5000/api/hr/employees?limit=500${cursor ? `&cursor=${cursor}` : ''}`, {
+          headers: { 'Authorization': `Bearer ${token}` }
+        });
+        if (!response.ok) break;
         const data = await response.json();
-        setEmployeeList(data.employees || []);
-        setStats(prev => ({ ...prev, totalEmployees: data.employees?.length || 0 }));
-      }
+        employees = employees.concat(data.employees || []);
+        cursor = data.next_cursor;
+      } while (cursor);
+      
+      setEmployeeList(employees);
+      setStats(prev => ({ ...prev, totalEmployees: employees.length }));
     } catch (error) {
       console.error('Fetch employees error:', error);
     } finally {
@@ -508,12 +517,14 @@ const HRDashboard = () => {
   
   // ============== ATTENDANCE MANAGEMENT FUNCTIONS ==============
   
-  // Fetch HR Attendance Records
-  const fetchHrAttendance = async () => {
+  // Fetch HR Attendance Records - first page, or the next one when loadMore is set
+  const fetchHrAttendance = async (loadMore = false) => {
     setHrAttendanceLoading(true);
     try {
       const token = localStorage.getItem('token');
       const params = new URLSearchParams();
+      if (loadMore && hrAttendanceCursor) params.append('cursor', hrAttendanceCursor);
+      else params.append('include_total', 'true');
       if (attendanceFilters.date_from) params.append('date_from', attendanceFilters.date_from);
       if (attendanceFilters.date_to) params.append('date_to', attendanceFilters.date_to);
       if (attendanceFilters.department !== 'all') params.append('department', attendanceFilters.department);
@@ -526,8 +537,14 @@ const HRDashboard = () => {
       
       if (response.ok) {
         const data = await response.json();
-        setHrAttendance(data.attendance || []);
-        setFilterOptions(data.filters || { departments: [], shifts: [], statuses: [] });
+        setHrAttendanceCursor(data.next_cursor || null);
+        if (loadMore) {
+          setHrAttendance(prev => prev.concat(data.attendance || []));
+        } else {
+          setHrAttendance(data.attendance || []);
+          setHrAttendanceTotal(data.total ?? (data.attendance?.length || 0));
+          setFilterOptions(data.filters || { departments: [], shifts: [], statuses: [] });
+        }
       }
     } catch (error) {
       console.error('Fetch HR attendance error:', error);
@@ -750,9 +767,59 @@ const HRDashboard = () => {
     if (!window.confirm(`Are you sure you want to process payroll for ${payrollMonth}? This will calculate salaries based on attendance and leaves.`)) return;
     
     setProcessingPayroll(true);
+    setPayrollProgress(null);
     try {
       const token = localStorage.getItem('token');
-      const response = await fetch('http://localhost:5000/api/hr/payroll/calculate', {
+      const response = await fetch('http://localhost:5000/api/hr/payroll/runs', {
+        method: 'POST',
+        headers: { 
+          'Authorization': `Bearer ${token}`,
+          'Content-Type': 'application/json'
+        },
+        body: JSON.stringify({ month: payrollMonth })
+      });
+      
+      const data = await response.json();
+      
+      // 409 means a run for this month is already going - follow that one
+      if (!response.ok && response.status !== 409) {
+        alert(data.error || 'Failed to process payroll');
+        return;
+      }
+      
+      // The run is processed in the background; poll until it finishes
+      let run = data;
+      while (['Queued', 'Running'].includes(run.status)) {
+        await new Promise(resolve => setTimeout(resolve, 2000));
+        const progressResponse = await fetch(`http://localhost:5000/api/hr/payroll/runs/${data.run_id}`, {
+          headers: { 'Authorization': `Bearer ${token}` }
+        });
+        if (!progressResponse.ok) break;
+        run = await progressResponse.json();
+        setPayrollProgress(run);
+      }
+      
+      if (run.status === 'Completed') {
+        alert(`Payroll processed for ${run.processed_employees} employees`);
+      } else {
+        alert(run.error || `Payroll run ${(run.status || 'stopped').toLowerCase()}`);
+      }
+      fetchPayrollData(payrollMonth);
+    } catch (error) {
+      console.error('Process payroll error:', error);
+      alert('Failed to process payroll');
+    } finally {
+      setProcessingPayroll(false);
+      setPayrollProgress(null);
+    }
+  };
+  
+  // Recalculate only the rows changed since payroll was processed
+  const handleRecalculatePayroll = async () => {
+    setProcessingPayroll(true);
+    try {
+      const token = localStorage.getItem('token');
+      const response = await fetch('http://localhost:5000/api/hr/payroll/recalculate', {
         method: 'POST',
         headers: { 
           'Authorization': `Bearer ${token}`,
@@ -767,11 +834,11 @@ const HRDashboard = () => {
         alert(data.message);
         fetchPayrollData(payrollMonth);
       } else {
-        alert(data.error || 'Failed to process payroll');
+        alert(data.error || 'Failed to recalculate payroll');
       }
     } catch (error) {
-      console.error('Process payroll error:', error);
-      alert('Failed to process payroll');
+      console.error('Recalculate payroll error:', error);
+      alert('Failed to recalculate payroll');
     } finally {
       setProcessingPayroll(false);
     }
@@ -1572,7 +1639,7 @@ This is a computer-generated payslip and does not require a signature.
                   </select>
                 </div>
                 <button
-                  onClick={fetchHrAttendance}
+                  onClick={() => fetchHrAttendance()}
                   className="px-4 py-2 bg-blue-600 text-white rounded-md hover:bg-blue-700"
                   style={{backgroundColor: '#4169E1'}}
                 >
@@ -1639,7 +1706,7 @@ This is a computer-generated payslip and does not require a signature.
             <div className="bg-white rounded-lg shadow-md">
               <div className="px-6 py-4 border-b border-gray-200 flex justify-between items-center">
                 <h3 className="text-lg font-medium text-gray-900">Attendance Records</h3>
-                <span className="text-sm text-gray-500">{hrAttendance.length} records</span>
+                <span className="text-sm text-gray-500">{hrAttendance.length} of {hrAttendanceTotal} records</span>
               </div>
               
               {hrAttendanceLoading ? (
@@ -1714,6 +1781,16 @@ This is a computer-generated payslip and does not require a signature.
                       )}
                     </tbody>
                   </table>
+                  {hrAttendanceCursor && (
+                    <div className="px-6 py-4 border-t border-gray-200 text-center">
+                      <button
+                        onClick={() => fetchHrAttendance(true)}
+                        className="px-4 py-2 text-sm text-blue-600 border border-blue-600 rounded-lg hover:bg-blue-50"
+                      >
+                        Load more
+                      </button>
+                    </div>
+                  )}
                 </div>
               )}
             </div>
@@ -1926,7 +2003,7 @@ This is a computer-generated payslip and does not require a signature.
                   className="px-4 py-2 bg-green-600 text-white rounded-md hover:bg-green-700 disabled:opacity-50 mt-6"
                 >
                   {processingPayroll ? (
-                    <><i className="fas fa-spinner fa-spin mr-2"></i>Processing...</>
+                    <><i className="fas fa-spinner fa-spin mr-2"></i>Processing{payrollProgress ? ` ${payrollProgress.percent}%` : '...'}</>
                   ) : (
                     <><i className="fas fa-calculator mr-2"></i>Process Payroll</>
                   )}
@@ -1968,10 +2045,22 @@ This is a computer-generated payslip and does not require a signature.
               {/* Payroll Table */}
               <div className="lg:col-span-2 bg-white rounded-lg shadow-md">
                 <div className="px-6 py-4 border-b border-gray-200">
-                  <h3 className="text-lg font-medium text-gray-900">
-                    <i className="fas fa-file-invoice-dollar mr-2 text-blue-600"></i>
-                    Payroll for {payrollMonth}
-                  </h3>
+                  <div className="flex justify-between items-center">
+                    <h3 className="text-lg font-medium text-gray-900">
+                      <i className="fas fa-file-invoice-dollar mr-2 text-blue-600"></i>
+                      Payroll for {payrollMonth}
+                    </h3>
+                    {payrollSummary?.stale_employees > 0 && (
+                      <button
+                        onClick={handleRecalculatePayroll}
+                        disabled={processingPayroll}
+                        className="px-3 py-1 bg-yellow-100 text-yellow-800 rounded-md hover:bg-yellow-200 text-sm disabled:opacity-50"
+                        title="Attendance or leave changed after payroll was processed"
+                      >
+                        <i className="fas fa-redo mr-1"></i>Recalculate {payrollSummary.stale_employees} changed
+                      </button>
+                    )}
+                  </div>
                 </div>
                 
                 {payrollLoading ? (
@@ -1999,7 +2088,14 @@ This is a computer-generated payslip and does not require a signature.
                           <tr key={record.id} className="hover:bg-gray-50">
                             <td className="px-4 py-3 whitespace-nowrap">
                               <div className="text-sm font-medium text-gray-900">{record.full_name}</div>
-                              <div className="text-xs text-gray-500">{record.employee_id}</div>
+                              <div className="text-xs text-gray-500">
+                                {record.employee_id}
+                                {record.is_stale === 1 && (
+                                  <span className="ml-2 px-1.5 py-0.5 bg-yellow-100 text-yellow-800 rounded" title={record.stale_reason}>
+                                    Stale
+                                  </span>
+                                )}
+                              </div>
                             </td>
                             <td className="px-4 py-3 whitespace-nowrap text-sm text-gray-500">{record.department || '-'}</td>
                             <td className="px-4 py-3 whitespace-nowrap text-sm text-right text-gray-900">₹{record.basic_salary?.toLocaleString()}</td>
@@ -17,6 +17,7 @@ CREATE TABLE IF NOT EXISTS users (
     shift TEXT CHECK (shift IN ('1', '2', '3') OR shift IS NULL),
     department TEXT,
     position TEXT,
+    designation TEXT,
     hire_date DATE NOT NULL,
     salary DECIMAL(10,2),
     phone TEXT,
@@ -42,8 +43,14 @@ CREATE TABLE IF NOT EXISTS attendance (
     date DATE NOT NULL,
     clock_in TIME,
     clock_out TIME,
+    clock_in_at DATETIME,                 -- full timestamps; a night shift's clock-out is on the next day
+    clock_out_at DATETIME,
     status TEXT DEFAULT 'Absent' CHECK (status IN ('Present', 'Absent', 'Half-Day', 'Leave', 'OT')),
     hours_worked REAL,
+    is_late INTEGER NOT NULL DEFAULT 0,
+    late_by_minutes INTEGER NOT NULL DEFAULT 0,
+    is_early_leave INTEGER NOT NULL DEFAULT 0,
+    early_by_minutes INTEGER NOT NULL DEFAULT 0,
     notes TEXT,
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
     updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
@@ -52,9 +59,69 @@ CREATE TABLE IF NOT EXISTS attendance (
 );
 
 -- Create indexes for attendance table
-CREATE INDEX IF NOT EXISTS idx_attendance_emp_date ON attendance(employee_id, date);
+-- Covers the per-employee month queries (status, late/early counts, hours) without touching the table
+CREATE INDEX IF NOT EXISTS idx_attendance_emp_date_status ON attendance(employee_id, date, status, hours_worked, is_late, is_early_leave);
 CREATE INDEX IF NOT EXISTS idx_attendance_date ON attendance(date);
 CREATE INDEX IF NOT EXISTS idx_attendance_status ON attendance(status);
+-- Late / early-leave days by date for reports
+CREATE INDEX IF NOT EXISTS idx_attendance_late ON attendance(date, employee_id) WHERE is_late = 1;
+CREATE INDEX IF NOT EXISTS idx_attendance_early_leave ON attendance(date, employee_id) WHERE is_early_leave = 1;
+
+-- Attendance punches: raw biometric/turnstile punches that attendance rows are paired from
+CREATE TABLE IF NOT EXISTS attendance_punches (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    employee_id TEXT NOT NULL,
+    punched_at DATETIME NOT NULL,
+    direction TEXT CHECK (direction IN ('IN', 'OUT')),
+    device_id TEXT,
+    source TEXT,
+    imported_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(employee_id, punched_at)
+);
+
+CREATE INDEX IF NOT EXISTS idx_attendance_punches_time ON attendance_punches(punched_at);
+
+-- Attendance rollups: per employee-month and per department-day counts, kept
+-- up to date by every attendance write (see ATTENDANCE ROLLUPS in app.py)
+CREATE TABLE IF NOT EXISTS attendance_rollup_monthly (
+    employee_id TEXT NOT NULL,
+    month TEXT NOT NULL,                  -- YYYY-MM
+    recorded_days INTEGER NOT NULL DEFAULT 0,
+    present_days INTEGER NOT NULL DEFAULT 0,
+    absent_days INTEGER NOT NULL DEFAULT 0,
+    half_days INTEGER NOT NULL DEFAULT 0,
+    leave_days INTEGER NOT NULL DEFAULT 0,
+    ot_days INTEGER NOT NULL DEFAULT 0,
+    late_days INTEGER NOT NULL DEFAULT 0,
+    early_days INTEGER NOT NULL DEFAULT 0,
+    total_hours REAL NOT NULL DEFAULT 0,
+    present_hours REAL NOT NULL DEFAULT 0,
+    hours_days INTEGER NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (employee_id, month),
+    FOREIGN KEY (employee_id) REFERENCES users(employee_id) ON DELETE CASCADE
+);
+
+CREATE TABLE IF NOT EXISTS attendance_rollup_daily (
+    department TEXT NOT NULL,             -- '' for employees without one
+    date DATE NOT NULL,
+    recorded_days INTEGER NOT NULL DEFAULT 0,
+    present_days INTEGER NOT NULL DEFAULT 0,
+    absent_days INTEGER NOT NULL DEFAULT 0,
+    half_days INTEGER NOT NULL DEFAULT 0,
+    leave_days INTEGER NOT NULL DEFAULT 0,
+    ot_days INTEGER NOT NULL DEFAULT 0,
+    late_days INTEGER NOT NULL DEFAULT 0,
+    early_days INTEGER NOT NULL DEFAULT 0,
+    total_hours REAL NOT NULL DEFAULT 0,
+    present_hours REAL NOT NULL DEFAULT 0,
+    hours_days INTEGER NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (department, date)
+);
+
+CREATE INDEX IF NOT EXISTS idx_attendance_rollup_monthly_month ON attendance_rollup_monthly(month);
+CREATE INDEX IF NOT EXISTS idx_attendance_rollup_daily_date ON attendance_rollup_daily(date);
 
 -- Meal Tokens table: Daily meal entitlements based on attendance and shift
 CREATE TABLE IF NOT EXISTS meal_tokens (
@@ -117,10 +184,42 @@ CREATE TABLE IF NOT EXISTS leave_balances (
     UNIQUE(employee_id, leave_year)
 );
 
+-- Leave ledger: append-only history of every leave request state change
+CREATE TABLE IF NOT EXISTS leave_ledger (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    leave_id INTEGER,
+    employee_id TEXT NOT NULL,
+    leave_year INTEGER NOT NULL,
+    leave_month INTEGER NOT NULL,       -- month of the request's start_date
+    leave_type TEXT NOT NULL,
+    event TEXT NOT NULL,                -- SUBMITTED, APPROVED, REJECTED, CANCELLED, OPENING
+    pending_delta REAL NOT NULL DEFAULT 0,
+    approved_delta REAL NOT NULL DEFAULT 0,
+    actor TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_leave_ledger_leave ON leave_ledger(leave_id);
+CREATE INDEX IF NOT EXISTS idx_leave_ledger_emp_year ON leave_ledger(employee_id, leave_year);
+
+-- Running leave totals maintained with the ledger; leave_month 0 = whole year.
+-- Days used come from here (leave_balances keeps the yearly allowances)
+CREATE TABLE IF NOT EXISTS leave_totals (
+    employee_id TEXT NOT NULL,
+    leave_year INTEGER NOT NULL,
+    leave_month INTEGER NOT NULL,
+    leave_type TEXT NOT NULL,
+    pending_days REAL NOT NULL DEFAULT 0,
+    approved_days REAL NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (employee_id, leave_year, leave_month, leave_type)
+);
+
 -- Create indexes for leave_applications table
 CREATE INDEX IF NOT EXISTS idx_leave_applications_emp_id ON leave_applications(employee_id);
 CREATE INDEX IF NOT EXISTS idx_leave_applications_status ON leave_applications(status);
 CREATE INDEX IF NOT EXISTS idx_leave_applications_start_date ON leave_applications(start_date);
+CREATE INDEX IF NOT EXISTS idx_leave_applications_emp_start ON leave_applications(employee_id, start_date, leave_type, status);
 CREATE INDEX IF NOT EXISTS idx_leave_applications_approved_by ON leave_applications(approved_by);
 
 -- Documents table: File uploads with approval tracking
@@ -150,14 +249,17 @@ CREATE INDEX IF NOT EXISTS idx_documents_uploaded_by ON documents(uploaded_by);
 -- Holidays table: Company-wide holiday calendar
 CREATE TABLE IF NOT EXISTS holidays (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    date DATE NOT NULL UNIQUE,
+    date DATE NOT NULL,
     description TEXT NOT NULL,
     is_optional INTEGER DEFAULT 0,
+    employee_category TEXT,             -- NULL = every category
+    shift TEXT,                         -- NULL = every shift
     created_at DATETIME DEFAULT CURRENT_TIMESTAMP
 );
 
 -- Create indexes for holidays table
-CREATE INDEX IF NOT EXISTS idx_holidays_date ON holidays(date);
+-- One holiday per date and category/shift scope (NULL = every category/shift)
+CREATE UNIQUE INDEX IF NOT EXISTS uq_holidays_scope ON holidays(date, COALESCE(employee_category, ''), COALESCE(shift, ''));
 CREATE INDEX IF NOT EXISTS idx_holidays_optional ON holidays(is_optional);
 
 -- Payroll table: Monthly salary computation
@@ -201,6 +303,16 @@ CREATE INDEX IF NOT EXISTS idx_audit_logs_user_id ON audit_logs(user_id);
 CREATE INDEX IF NOT EXISTS idx_audit_logs_action ON audit_logs(action);
 CREATE INDEX IF NOT EXISTS idx_audit_logs_timestamp ON audit_logs(timestamp);
 
+-- Revoked JWTs (logout) and sessions (force login), shared by all workers
+CREATE TABLE IF NOT EXISTS revoked_tokens (
+    token_key TEXT PRIMARY KEY,         -- jti or session_id
+    expires_at REAL NOT NULL,           -- epoch seconds; row can be pruned after this
+    revoked_at REAL NOT NULL            -- epoch seconds; workers sync incrementally on this
+);
+
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at);
+CREATE INDEX IF NOT EXISTS idx_revoked_tokens_expires_at ON revoked_tokens(expires_at);
+
 -- Custom requests table: Lunch tokens, special permissions
 CREATE TABLE IF NOT EXISTS custom_requests (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -241,6 +353,74 @@ INSERT OR IGNORE INTO system_settings (setting_key, setting_value, description)
     ('company_name', 'VES Engineering Services', 'Company Name'),
     ('frontend_url', 'http://localhost:3000', 'Frontend URL for email links');
 
+-- Bumped on every settings change so each worker's settings cache reloads
+CREATE TABLE IF NOT EXISTS settings_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO settings_version (id, version) VALUES (1, 0);
+
+-- Bumped on every holiday change so each worker's work calendar recounts
+CREATE TABLE IF NOT EXISTS calendar_version (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    version INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO calendar_version (id, version) VALUES (1, 0);
+
+-- Outgoing email queue, drained by the app's background SMTP sender
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    to_email TEXT NOT NULL,
+    subject TEXT NOT NULL,
+    html_body TEXT NOT NULL,
+    purpose TEXT DEFAULT 'general',     -- welcome, password_reset, test, ...
+    status TEXT NOT NULL DEFAULT 'Pending' CHECK (status IN ('Pending', 'Sending', 'Sent', 'Failed', 'Skipped')),
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at REAL NOT NULL,      -- epoch seconds; retries back off exponentially
+    claimed_at REAL,                    -- epoch seconds; set while a worker is sending
+    last_error TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    sent_at DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS idx_email_outbox_due ON email_outbox(status, next_attempt_at);
+
+-- Background payroll runs; processed in employee_id-ordered chunks and
+-- checkpointed after each chunk so an interrupted run resumes where it stopped
+CREATE TABLE IF NOT EXISTS payroll_runs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    month TEXT NOT NULL,                -- YYYY-MM
+    employee_id TEXT,                   -- set for a single-employee run
+    status TEXT NOT NULL DEFAULT 'Queued' CHECK (status IN ('Queued', 'Running', 'Completed', 'Failed', 'Cancelled')),
+    total_employees INTEGER,
+    processed_employees INTEGER NOT NULL DEFAULT 0,
+    last_employee_id TEXT,              -- checkpoint: last employee saved
+    attempts INTEGER NOT NULL DEFAULT 0,
+    claim_token TEXT,                   -- identifies the worker that owns the run
+    heartbeat_at REAL,                  -- epoch seconds; stale = worker died
+    error TEXT,
+    requested_by TEXT,
+    created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+    started_at DATETIME,
+    finished_at DATETIME
+);
+
+CREATE INDEX IF NOT EXISTS idx_payroll_runs_status ON payroll_runs(status);
+CREATE INDEX IF NOT EXISTS idx_payroll_runs_month ON payroll_runs(month);
+
+-- Processed payroll rows invalidated by a later attendance/leave change;
+-- /api/hr/payroll/recalculate recomputes just these
+CREATE TABLE IF NOT EXISTS payroll_stale (
+    employee_id TEXT NOT NULL,
+    month TEXT NOT NULL,                -- YYYY-MM
+    reason TEXT,                        -- audit action that caused it
+    marked_at REAL NOT NULL,            -- epoch seconds
+    mark_id TEXT NOT NULL DEFAULT '',   -- new on every marking; payroll clears only the mark it read
+    PRIMARY KEY (employee_id, month)
+);
+
+CREATE INDEX IF NOT EXISTS idx_payroll_stale_month ON payroll_stale(month);
+
 -- Views for computed data
 -- Employee stats view
 CREATE VIEW IF NOT EXISTS v_employee_stats AS
@@ -301,52 +481,3 @@ INSERT OR IGNORE INTO holidays (date, description) VALUES
 ('2025-10-24', 'Dussehra'),
 ('2025-11-12', 'Diwali'),
 ('2025-12-25', 'Christmas Day');
-
--- Triggers for automatic hour calculation
--- Note: SQLite triggers have different syntax than MySQL
-
--- Trigger for INSERT
-CREATE TRIGGER IF NOT EXISTS calculate_hours_insert
-AFTER INSERT ON attendance
-FOR EACH ROW
-WHEN NEW.in_time IS NOT NULL AND NEW.out_time IS NOT NULL
-BEGIN
-    UPDATE attendance 
-    SET 
-        worked_hours = (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0,
-        status = CASE 
-            WHEN (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0 >= 8 THEN 'Present'
-            WHEN (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0 >= 4 THEN 'Half-Day'
-            WHEN (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0 > 0 THEN 'Present'
-            ELSE 'Absent'
-        END
-    WHERE id = NEW.id;
-    
-    -- Mark overtime if > 8 hours
-    UPDATE attendance 
-    SET status = 'OT'
-    WHERE id = NEW.id AND worked_hours > 8;
-END;
-
--- Trigger for UPDATE
-CREATE TRIGGER IF NOT EXISTS calculate_hours_update
-AFTER UPDATE ON attendance
-FOR EACH ROW
-WHEN NEW.in_time IS NOT NULL AND NEW.out_time IS NOT NULL
-BEGIN
-    UPDATE attendance 
-    SET 
-        worked_hours = (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0,
-        status = CASE 
-            WHEN (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0 >= 8 THEN 'Present'
-            WHEN (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0 >= 4 THEN 'Half-Day'
-            WHEN (strftime('%s', NEW.out_time) - strftime('%s', NEW.in_time)) / 3600.0 > 0 THEN 'Present'
-            ELSE 'Absent'
-        END
-    WHERE id = NEW.id;
-    
-    -- Mark overtime if > 8 hours
-    UPDATE attendance 
-    SET status = 'OT'
-    WHERE id = NEW.id AND worked_hours > 8;
-END;
\ No newline at end of file
@@ -0,0 +1,188 @@
+#!/usr/bin/env python3
+"""
+VES HRMS Check-in Load Test
+Simulates a shift-start burst: N workers all check in at once against the
+check-in endpoint, first with each request writing on its own (inline) and
+then through the group-commit writer, and reports throughput and latency.
+Usage: python load_test_checkin.py --employees 400 --concurrency 50
+
+Runs in-process against the configured database (Flask test client, rate
+limits off). Creates LOADTnnnn users and removes them, with their attendance
+and meal tokens, when it is done unless --keep is given.
+"""
+
+import argparse
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import app as hrms
+from flask_jwt_extended import create_access_token
+
+PREFIX = 'LOADT'
+SHIFTS = ('1', '2', '3')
+
+
+def create_users(count):
+    """Create (or reuse) the load-test employees; returns their usernames"""
+    conn = hrms.get_db_connection(request_scoped=False)
+    cursor = conn.cursor()
+    password_hash = hrms.password_hasher.hash('loadtest123')
+    usernames = []
+    for i in range(1, count + 1):
+        employee_id = f"{PREFIX}{i:04d}"
+        username = employee_id.lower()
+        # Every fourth employee is staff - no meal token - the rest are workers
+        category = 'S001' if i % 4 == 0 else 'W001'
+        shift = None if category == 'S001' else SHIFTS[i % len(SHIFTS)]
+        cursor.execute(hrms.db_backend.insert_ignore(
+            'users', ['employee_id', 'username', 'email', 'password_hash', 'full_name', 'role',
+                      'employee_category', 'shift', 'is_active', 'hire_date', 'account_status'],
+            ['employee_id']),
+            (employee_id, username, f"{username}@loadtest.local", password_hash, f"Load Test {i}",
+             'Employee', category, shift, 1, '2024-01-01', 'Active'))
+        usernames.append(username)
+    conn.commit()
+    conn.close()
+    return usernames
+
+
+def work_dates(cursor):
+    """(employee_id, work date) a check-in right now is recorded under, per load-test employee"""
+    now = datetime.now()
+    cursor.execute("SELECT employee_id, shift FROM users WHERE employee_id LIKE ?", (f"{PREFIX}%",))
+    return [(row['employee_id'], hrms.work_date_for(now, row['shift'])) for row in cursor.fetchall()]
+
+
+def reset_today(usernames):
+    """Forget today's check-ins and meal tokens so every run starts from scratch"""
+    conn = hrms.get_db_connection(request_scoped=False)
+    cursor = conn.cursor()
+    keys = work_dates(cursor)
+    cursor.executemany("DELETE FROM attendance WHERE employee_id = ? AND date = ?", keys)
+    cursor.executemany("DELETE FROM meal_tokens WHERE employee_id = ? AND token_date = ?", keys)
+    hrms.refresh_attendance_rollups(cursor, keys)
+    conn.commit()
+    conn.close()
+
+
+def remove_users():
+    conn = hrms.get_db_connection(request_scoped=False)
+    cursor = conn.cursor()
+    cursor.execute("SELECT employee_id, date FROM attendance WHERE employee_id LIKE ?", (f"{PREFIX}%",))
+    keys = [(row['employee_id'], row['date']) for row in cursor.fetchall()]
+    for table in ('attendance', 'attendance_rollup_monthly', 'meal_tokens', 'audit_logs'):
+        column = 'user_id' if table == 'audit_logs' else 'employee_id'
+        value = f"{PREFIX.lower()}%" if table == 'audit_logs' else f"{PREFIX}%"
+        cursor.execute(f"DELETE FROM {table} WHERE {column} LIKE ?", (value,))
+    # Take them out of the department day totals too - while their department can still be looked up
+    hrms.refresh_attendance_rollups(cursor, keys)
+    cursor.execute("DELETE FROM users WHERE employee_id LIKE ?", (f"{PREFIX}%",))
+    conn.commit()
+    conn.close()
+
+
+def use_writer(group_commit):
+    """Swap in a check-in writer with group commit on or off"""
+    hrms.checkin_writer.stop()
+    hrms.checkin_writer = hrms.CheckInWriter(
+        enabled=group_commit,
+        batch_window=hrms.app_config.CHECKIN_BATCH_WINDOW_MS / 1000,
+        batch_size=hrms.app_config.CHECKIN_BATCH_SIZE,
+        queue_size=hrms.app_config.CHECKIN_QUEUE_SIZE,
+        timeout=hrms.app_config.CHECKIN_TIMEOUT
+    )
+    hrms.checkin_writer.start()
+
+
+def run_burst(tokens, concurrency):
+    """Fire one check-in per token, `concurrency` at a time; returns (elapsed, latencies, statuses)"""
+    client = hrms.app.test_client()
+    latencies = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def check_in(token):
+        started = time.perf_counter()
+        response = client.post('/api/attendance/check-in', headers={'Authorization': f"Bearer {token}"})
+        elapsed = time.perf_counter() - started
+        with lock:
+            latencies.append(elapsed)
+            statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        list(pool.map(check_in, tokens))
+    return time.perf_counter() - started, latencies, statuses
+
+
+def verify(count):
+    """Every employee should have exactly one check-in and every worker one meal token"""
+    conn = hrms.get_db_connection(request_scoped=False)
+    cursor = conn.cursor()
+    checked_in = tokens = 0
+    for employee_id, work_date in work_dates(cursor):
+        cursor.execute("SELECT COUNT(*) AS n FROM attendance WHERE employee_id = ? AND date = ? AND clock_in IS NOT NULL",
+                       (employee_id, work_date))
+        checked_in += cursor.fetchone()['n']
+        cursor.execute("SELECT COUNT(*) AS n FROM meal_tokens WHERE employee_id = ? AND token_date = ?",
+                       (employee_id, work_date))
+        tokens += cursor.fetchone()['n']
+    conn.close()
+    expected_tokens = count - count // 4
+    ok = checked_in == count and tokens == expected_tokens
+    print(f"  verified    : {checked_in}/{count} checked in, {tokens}/{expected_tokens} meal tokens"
+          f" {'OK' if ok else 'MISMATCH'}")
+    return ok
+
+
+def report(mode, elapsed, latencies, statuses):
+    latencies = sorted(latencies)
+    pct = lambda p: latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000
+    print(f"\n{mode}")
+    print(f"  requests    : {len(latencies)} in {elapsed:.2f}s ({len(latencies) / elapsed:.1f} check-ins/s)")
+    print(f"  latency ms  : p50 {pct(0.50):.1f}  p95 {pct(0.95):.1f}  p99 {pct(0.99):.1f}  "
+          f"max {latencies[-1] * 1000:.1f}  mean {statistics.mean(latencies) * 1000:.1f}")
+    print(f"  status codes: {dict(sorted(statuses.items()))}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Shift-start check-in load test')
+    parser.add_argument('--employees', type=int, default=400, help='number of employees checking in')
+    parser.add_argument('--concurrency', type=int, default=50, help='simultaneous requests')
+    parser.add_argument('--mode', choices=('both', 'inline', 'group'), default='both')
+    parser.add_argument('--keep', action='store_true', help='keep the load-test users afterwards')
+    args = parser.parse_args()
+
+    hrms.limiter.enabled = False
+    print(f"Creating {args.employees} load-test employees...")
+    usernames = create_users(args.employees)
+    with hrms.app.app_context():
+        tokens = [create_access_token(identity=username) for username in usernames]
+    # Warm the identity cache so both modes measure only the check-in itself
+    for username in usernames:
+        hrms.resolve_identity(username)
+
+    modes = ['inline', 'group'] if args.mode == 'both' else [args.mode]
+    ok = True
+    try:
+        for mode in modes:
+            reset_today(usernames)
+            use_writer(mode == 'group')
+            report(f"{mode} ({args.concurrency} concurrent)", *run_burst(tokens, args.concurrency))
+            ok = verify(args.employees) and ok
+            if mode == 'group':
+                stats = hrms.checkin_writer.stats()
+                print(f"  batches     : {stats['batches']} (largest {stats['largest_batch']}, "
+                      f"avg {stats['committed'] / max(stats['batches'], 1):.1f} check-ins/commit)")
+    finally:
+        if not args.keep:
+            remove_users()
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -122,37 +122,27 @@
 
 
 # ============================================================
-# QUERIES THAT NEED CHANGES IN VES HRMS
+# HOW VES HRMS HANDLES THESE DIFFERENCES
 # ============================================================
 
-# In app.py, look for these patterns and update for SQL Server:
+# app.py no longer needs editing. The backend is selected by DB_TYPE in
+# production/config.py and the routes build dialect-specific SQL through
+# db_backend (see DATABASE BACKENDS in app.py):
 
-# 1. datetime('now') → GETDATE()
-# 2. strftime() → FORMAT() or CONVERT()
-# 3. LIMIT x → TOP x (or use OFFSET/FETCH)
-# 4. || for concat → + or CONCAT()
+#   db_backend.now                   datetime('now')          / GETDATE()
+#   db_backend.days_ago('?')         date('now', '-' || ? ...) / DATEADD(day, -?, GETDATE())
+#   db_backend.year_of('col')        strftime('%Y', col)      / FORMAT(col, 'yyyy')
+#   db_backend.month_of('col')       strftime('%m', col)      / FORMAT(col, 'MM')
+#   db_backend.limit(12)             LIMIT 12                 / OFFSET 0 ROWS FETCH NEXT 12 ROWS ONLY
+#   db_backend.upsert(...)           INSERT ... ON CONFLICT   / MERGE ... WHEN MATCHED
+#   db_backend.insert_ignore(...)    ON CONFLICT DO NOTHING   / MERGE ... WHEN NOT MATCHED
 
-# Example changes:
+# Example:
 
-# SQLite version:
-# cursor.execute("INSERT INTO audit_logs (timestamp) VALUES (datetime('now'))")
+# cursor.execute(
+#     f"INSERT INTO audit_logs (user_id, action, timestamp) VALUES (?, ?, {db_backend.now})",
+#     (user_id, action)
+# )
 
-# SQL Server version:
-# cursor.execute("INSERT INTO audit_logs (timestamp) VALUES (GETDATE())")
-
-
-# ============================================================
-# PRO TIP: Use try/except to support both databases
-# ============================================================
-
-# def insert_audit_log(cursor, user_id, action):
-#     if DATABASE_TYPE == 'sqlite':
-#         cursor.execute(
-#             "INSERT INTO audit_logs (user_id, action, timestamp) VALUES (?, ?, datetime('now'))",
-#             (user_id, action)
-#         )
-#     else:  # sqlserver
-#         cursor.execute(
-#             "INSERT INTO audit_logs (user_id, action, timestamp) VALUES (?, ?, GETDATE())",
-#             (user_id, action)
-#         )
+# When adding a new query, use plain ANSI SQL where possible and add a
+# fragment to DatabaseBackend (and both subclasses) for anything that isn't.
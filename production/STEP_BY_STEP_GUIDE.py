@@ -150,54 +150,19 @@ WHAT YOU NEED:
 # STEP 6: CONFIGURE THE APP
 # ============================================================
 """
-6.1 Edit app.py for SQL Server:
-    Open C:\VES_HRMS\app.py in Notepad or any editor
-
-6.2 Find this section (near the top):
-    # ============================================================
-    # DATABASE DRIVER IMPORT
-    # ============================================================
-    # DEVELOPMENT (SQLite) - Currently Active
-    import sqlite3
-
-    # PRODUCTION (SQL Server) - Uncomment for client deployment
-    # import pyodbc
-
-6.3 Change to:
-    # DEVELOPMENT (SQLite) - Comment out for production
-    # import sqlite3
-
-    # PRODUCTION (SQL Server) - Now Active
-    import pyodbc
-
-6.4 Find this section:
-    # DEVELOPMENT (SQLite) - Currently Active
-    DATABASE_TYPE = 'sqlite'
-    DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'ves_hrms.db')
-
-    # PRODUCTION (SQL Server) - Uncomment below
-    # DATABASE_TYPE = 'sqlserver'
-    # SQLSERVER_CONFIG = {...}
-
-6.5 Change to:
-    # DEVELOPMENT (SQLite) - Comment out for production
-    # DATABASE_TYPE = 'sqlite'
-    # DATABASE_PATH = os.path.join(os.path.dirname(__file__), 'ves_hrms.db')
-
-    # PRODUCTION (SQL Server) - Now Active
-    DATABASE_TYPE = 'sqlserver'
-    SQLSERVER_CONFIG = {
-        'server': 'localhost',  # Change to your server
-        'database': 'VES_HRMS',
-        'username': 'ves_hrms_app',
-        'password': 'YourPassword',  # Change to your password
-        'driver': 'ODBC Driver 17 for SQL Server'
-    }
-
-6.6 Find get_db_connection() function:
-    - Comment out the SQLite version
-    - Uncomment the SQL Server version
-    (Follow the comments in the code)
+6.1 app.py does not need to be edited. The database is selected with
+    environment variables read by production/config.py.
+
+6.2 Open Command Prompt and set (or add to the .env file):
+    set DB_TYPE=sqlserver
+    set DB_SERVER=localhost          (Change to your server)
+    set DB_NAME=VES_HRMS
+    set DB_USER=ves_hrms_app
+    set DB_PASSWORD=YourPassword     (Change to your password)
+    set DB_DRIVER=ODBC Driver 17 for SQL Server
+
+6.3 To go back to SQLite for testing:
+    set DB_TYPE=sqlite
 """
 
 # ============================================================
@@ -14,10 +14,13 @@ from datetime import timedelta
 # ============================================================
 # Set DB_TYPE to 'sqlserver' for production, 'sqlite' for development
 
-DB_TYPE = os.environ.get('DB_TYPE', 'sqlserver')  # 'sqlite' or 'sqlserver'
+DB_TYPE = os.environ.get('DB_TYPE', 'sqlite')  # 'sqlite' or 'sqlserver'
 
-# SQLite Configuration (Development)
-SQLITE_PATH = os.path.join(os.path.dirname(__file__), 'ves_hrms.db')
+# SQLite Configuration (Development) - ves_hrms.db in the project root
+SQLITE_PATH = os.environ.get(
+    'SQLITE_PATH',
+    os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'ves_hrms.db')
+)
 
 # SQL Server Configuration (Production)
 SQLSERVER_CONFIG = {
@@ -31,6 +34,43 @@ SQLSERVER_CONFIG = {
     'pool_timeout': 30,
 }
 
+# SQLite connection pool settings
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 10))
+SQLITE_POOL_TIMEOUT = int(os.environ.get('SQLITE_POOL_TIMEOUT', 30))
+
+# Idle pooled connections are pinged with SELECT 1 before reuse once they
+# have been sitting in the pool longer than this (seconds)
+DB_POOL_HEALTH_CHECK_INTERVAL = int(os.environ.get('DB_POOL_HEALTH_CHECK_INTERVAL', 60))
+
+# ============================================================
+# SQLITE PRAGMA PROFILES
+# ============================================================
+# Applied to every SQLite connection when it is opened, in the order listed.
+# 'performance' uses WAL so HR dashboard readers don't block behind check-in
+# writers, and a busy_timeout so concurrent writers wait instead of failing
+# with "database is locked". Use 'safe' if the .db file lives on a network
+# share (WAL needs shared memory on the same host).
+
+SQLITE_PRAGMA_PROFILES = {
+    'performance': {
+        'busy_timeout': 5000,        # ms to wait for a competing writer
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',     # safe with WAL, one fsync per checkpoint
+        'cache_size': -20000,        # negative = KiB, ~20MB page cache
+        'mmap_size': 268435456,      # 256MB memory-mapped reads
+        'temp_store': 'MEMORY',
+    },
+    'safe': {
+        'busy_timeout': 5000,
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'temp_store': 'MEMORY',
+    },
+    'default': {},                   # SQLite built-in defaults
+}
+
+SQLITE_PRAGMA_PROFILE = os.environ.get('SQLITE_PRAGMA_PROFILE', 'performance')
+
 # ============================================================
 # SECURITY CONFIGURATION
 # ============================================================
@@ -39,6 +79,25 @@ JWT_SECRET_KEY = os.environ.get('JWT_SECRET_KEY', 'CHANGE-THIS-IN-PRODUCTION-use
 JWT_ACCESS_TOKEN_EXPIRES = timedelta(hours=3)
 JWT_REFRESH_TOKEN_EXPIRES = timedelta(days=7)
 
+# Password hashing - bcrypt runs in a dedicated worker pool. Existing hashes
+# made with a different BCRYPT_ROUNDS are upgraded on the user's next login.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS', os.cpu_count() or 2))
+PASSWORD_HASH_MAX_PENDING = int(os.environ.get('PASSWORD_HASH_MAX_PENDING', 64))  # beyond this -> 503
+PASSWORD_HASH_TIMEOUT = float(os.environ.get('PASSWORD_HASH_TIMEOUT', 30))  # seconds
+PASSWORD_HASH_RETRY_AFTER = int(os.environ.get('PASSWORD_HASH_RETRY_AFTER', 2))  # seconds, sent with 503
+PASSWORD_HASH_USE_PROCESSES = os.environ.get('PASSWORD_HASH_USE_PROCESSES', 'True').lower() == 'true'
+
+# Logged-in user lookups (role, employee_id, category) are cached in-process.
+# HR edits invalidate immediately; the TTL bounds staleness across processes.
+IDENTITY_CACHE_TTL = int(os.environ.get('IDENTITY_CACHE_TTL', 300))  # seconds
+IDENTITY_CACHE_SIZE = int(os.environ.get('IDENTITY_CACHE_SIZE', 5000))
+
+# Revoked tokens are shared through the revoked_tokens table; each worker
+# re-reads it this often (seconds), and expired rows are pruned hourly
+REVOCATION_SYNC_INTERVAL = float(os.environ.get('REVOCATION_SYNC_INTERVAL', 5))
+REVOCATION_PRUNE_INTERVAL = int(os.environ.get('REVOCATION_PRUNE_INTERVAL', 3600))
+
 # ============================================================
 # APPLICATION CONFIGURATION
 # ============================================================
@@ -51,9 +110,59 @@ PORT = int(os.environ.get('PORT', 5000))
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', 'uploads')
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB
 
+# HR list endpoints (attendance, employees, leaves) are paged with cursors
+PAGE_SIZE_DEFAULT = int(os.environ.get('PAGE_SIZE_DEFAULT', 100))
+PAGE_SIZE_MAX = int(os.environ.get('PAGE_SIZE_MAX', 500))
+FILTER_OPTIONS_TTL = int(os.environ.get('FILTER_OPTIONS_TTL', 300))  # seconds
+
+# Report exports (CSV/XLSX) are streamed - rows read per DB round trip
+# and the size of each piece of the response body
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 1000))
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 64 * 1024))  # bytes
+
+# Payroll runs (/api/hr/payroll/runs) are processed in the background in
+# chunks of PAYROLL_CHUNK_SIZE employees, computed on PAYROLL_WORKERS
+# processes (0 = compute in the runner thread). A Running run whose heartbeat
+# is older than PAYROLL_RUN_STALE_AFTER seconds is resumed from its checkpoint.
+PAYROLL_CHUNK_SIZE = int(os.environ.get('PAYROLL_CHUNK_SIZE', 500))
+PAYROLL_WORKERS = int(os.environ.get('PAYROLL_WORKERS', 2))
+PAYROLL_USE_PROCESSES = os.environ.get('PAYROLL_USE_PROCESSES', 'True').lower() == 'true'
+PAYROLL_POLL_INTERVAL = float(os.environ.get('PAYROLL_POLL_INTERVAL', 5))  # seconds
+PAYROLL_RUN_STALE_AFTER = int(os.environ.get('PAYROLL_RUN_STALE_AFTER', 120))  # seconds
+PAYROLL_RUN_MAX_ATTEMPTS = int(os.environ.get('PAYROLL_RUN_MAX_ATTEMPTS', 3))
+
+# Bulk onboarding (/api/hr/employees/bulk) - rows accepted per upload
+BULK_ONBOARD_MAX_ROWS = int(os.environ.get('BULK_ONBOARD_MAX_ROWS', 2000))
+
+# At startup, EXPLAIN the per-employee dashboard queries and log a warning
+# if any of them scans a table instead of using its index (SQLite only)
+QUERY_PLAN_CHECKS = os.environ.get('QUERY_PLAN_CHECKS', 'True').lower() == 'true'
+
 # Logs
 LOGS_FOLDER = os.environ.get('LOGS_FOLDER', 'logs')
 
+# Log files are written by one background thread fed through a queue.
+# LOG_QUEUE_POLICY: 'block' - callers wait up to LOG_QUEUE_BLOCK_TIMEOUT
+# seconds for room (then the record is dropped), 'drop' - never wait
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', 10000))
+LOG_QUEUE_POLICY = os.environ.get('LOG_QUEUE_POLICY', 'block')
+LOG_QUEUE_BLOCK_TIMEOUT = float(os.environ.get('LOG_QUEUE_BLOCK_TIMEOUT', 1.0))
+LOG_BATCH_SIZE = int(os.environ.get('LOG_BATCH_SIZE', 500))
+
+# Audit trail - events are queued and written to audit_logs in batches
+AUDIT_BATCH_SIZE = int(os.environ.get('AUDIT_BATCH_SIZE', 200))
+AUDIT_FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 1.0))  # seconds
+AUDIT_QUEUE_SIZE = int(os.environ.get('AUDIT_QUEUE_SIZE', 10000))
+
+# Check-ins are queued for one writer thread that commits everything that
+# arrived within CHECKIN_BATCH_WINDOW_MS in a single transaction.
+# CHECKIN_GROUP_COMMIT=False writes each check-in from its own request.
+CHECKIN_GROUP_COMMIT = os.environ.get('CHECKIN_GROUP_COMMIT', 'True').lower() == 'true'
+CHECKIN_BATCH_WINDOW_MS = float(os.environ.get('CHECKIN_BATCH_WINDOW_MS', 5))
+CHECKIN_BATCH_SIZE = int(os.environ.get('CHECKIN_BATCH_SIZE', 200))
+CHECKIN_QUEUE_SIZE = int(os.environ.get('CHECKIN_QUEUE_SIZE', 2000))
+CHECKIN_TIMEOUT = float(os.environ.get('CHECKIN_TIMEOUT', 10))  # seconds a request waits for its commit
+
 # ============================================================
 # CORS CONFIGURATION
 # ============================================================
@@ -66,6 +175,13 @@ CORS_ORIGINS = os.environ.get('CORS_ORIGINS', 'http://localhost:3000').split(','
 RATE_LIMIT_DEFAULT = "200 per day"
 RATE_LIMIT_LOGIN = "10 per minute"
 
+# ============================================================
+# SYSTEM SETTINGS CACHE
+# ============================================================
+# system_settings is cached in memory; each worker checks the shared
+# settings_version counter this often (seconds) to pick up admin changes
+SETTINGS_CHECK_INTERVAL = float(os.environ.get('SETTINGS_CHECK_INTERVAL', 5))
+
 # ============================================================
 # EMAIL CONFIGURATION (Override via database settings)
 # ============================================================
@@ -73,6 +189,19 @@ SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
 SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
 SMTP_EMAIL = os.environ.get('SMTP_EMAIL', '')
 SMTP_PASSWORD = os.environ.get('SMTP_PASSWORD', '')
+# Turn off only for a local test SMTP server that doesn't offer STARTTLS
+SMTP_USE_TLS = os.environ.get('SMTP_USE_TLS', 'True').lower() == 'true'
+
+# Outgoing mail is queued in email_outbox and sent by a background thread
+# over one SMTP session that stays open between messages
+EMAIL_OUTBOX_POLL_INTERVAL = float(os.environ.get('EMAIL_OUTBOX_POLL_INTERVAL', 5))  # seconds
+EMAIL_OUTBOX_BATCH_SIZE = int(os.environ.get('EMAIL_OUTBOX_BATCH_SIZE', 50))
+EMAIL_MAX_ATTEMPTS = int(os.environ.get('EMAIL_MAX_ATTEMPTS', 6))
+EMAIL_RETRY_BASE_DELAY = int(os.environ.get('EMAIL_RETRY_BASE_DELAY', 30))  # seconds, doubled per attempt
+EMAIL_RETRY_MAX_DELAY = int(os.environ.get('EMAIL_RETRY_MAX_DELAY', 3600))
+EMAIL_SMTP_TIMEOUT = int(os.environ.get('EMAIL_SMTP_TIMEOUT', 30))
+EMAIL_SMTP_IDLE_TIMEOUT = int(os.environ.get('EMAIL_SMTP_IDLE_TIMEOUT', 60))  # close an unused session after this
+EMAIL_CLAIM_TIMEOUT = int(os.environ.get('EMAIL_CLAIM_TIMEOUT', 600))  # requeue rows a crashed worker claimed
 
 # ============================================================
 # OFFICE HOURS
@@ -81,3 +210,36 @@ OFFICE_START_TIME = '09:00'
 OFFICE_END_TIME = '18:00'
 LATE_THRESHOLD_MINUTES = 15
 EARLY_LEAVE_THRESHOLD_MINUTES = 30
+
+# Shift roster ('HH:MM' start, end); a shift that ends before it starts
+# finishes the next morning. Employees without a shift keep office hours.
+SHIFT_TIMINGS = {
+    '1': ('06:00', '14:00'),
+    '2': ('14:00', '22:00'),
+    '3': ('22:00', '06:00'),
+}
+
+# ============================================================
+# PUNCH IMPORT
+# ============================================================
+# Device punch logs (CSV or JSON lines) posted to the import endpoint or
+# dropped into PUNCH_DROP_FOLDER (empty = no folder watching). A punch up to
+# PUNCH_EARLY_HOURS before a shift starts counts towards that shift; punches
+# closer together than PUNCH_DEBOUNCE_SECONDS are treated as one.
+PUNCH_DROP_FOLDER = os.environ.get('PUNCH_DROP_FOLDER', '')
+PUNCH_DROP_POLL_INTERVAL = int(os.environ.get('PUNCH_DROP_POLL_INTERVAL', 30))  # seconds
+PUNCH_IMPORT_BATCH_SIZE = int(os.environ.get('PUNCH_IMPORT_BATCH_SIZE', 5000))  # attendance rows per transaction
+PUNCH_EARLY_HOURS = int(os.environ.get('PUNCH_EARLY_HOURS', 4))
+PUNCH_DEBOUNCE_SECONDS = int(os.environ.get('PUNCH_DEBOUNCE_SECONDS', 120))
+
+# ============================================================
+# WORK CALENDAR
+# ============================================================
+# Working days per month = days in WORK_WEEKMASK (Mon..Sun, 1 = working)
+# minus the holidays table. A category can have its own weekly pattern,
+# e.g. {'S001': '1111100'} for a five-day staff week.
+WORK_WEEKMASK = os.environ.get('WORK_WEEKMASK', '1111110')
+WORK_WEEKMASK_BY_CATEGORY = {}
+CALENDAR_CACHE_TTL = int(os.environ.get('CALENDAR_CACHE_TTL', 3600))  # seconds
+# How often each worker checks calendar_version for holiday edits made elsewhere
+CALENDAR_CHECK_INTERVAL = float(os.environ.get('CALENDAR_CHECK_INTERVAL', 5))
@@ -64,13 +64,15 @@ CREATE TABLE attendance (
     date DATE NOT NULL,
     clock_in TIME,
     clock_out TIME,
+    clock_in_at DATETIME,                 -- full timestamps; a night shift's clock-out is on the next day
+    clock_out_at DATETIME,
     status NVARCHAR(20) DEFAULT 'Absent' CHECK (status IN ('Present', 'Absent', 'Half Day', 'Leave', 'Holiday', 'Weekend')),
     hours_worked DECIMAL(5, 2),
     overtime_hours DECIMAL(5, 2) DEFAULT 0,
-    is_late BIT DEFAULT 0,
-    late_by_minutes INT DEFAULT 0,
-    is_early_leave BIT DEFAULT 0,
-    early_by_minutes INT DEFAULT 0,
+    is_late BIT NOT NULL DEFAULT 0,
+    late_by_minutes INT NOT NULL DEFAULT 0,
+    is_early_leave BIT NOT NULL DEFAULT 0,
+    early_by_minutes INT NOT NULL DEFAULT 0,
     notes NVARCHAR(MAX),
     modified_by NVARCHAR(50),
     modification_reason NVARCHAR(MAX),
@@ -83,6 +85,69 @@ GO
 
 CREATE INDEX idx_attendance_date ON attendance(date);
 CREATE INDEX idx_attendance_status ON attendance(status);
+CREATE INDEX idx_attendance_emp_date_status ON attendance(employee_id, date) INCLUDE (status, hours_worked, is_late, is_early_leave);
+CREATE INDEX idx_attendance_late ON attendance(date, employee_id) WHERE is_late = 1;
+CREATE INDEX idx_attendance_early_leave ON attendance(date, employee_id) WHERE is_early_leave = 1;
+GO
+
+-- ============================================================
+-- TABLE: attendance_punches - Raw biometric/turnstile punches
+-- ============================================================
+CREATE TABLE attendance_punches (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    employee_id NVARCHAR(50) NOT NULL,
+    punched_at DATETIME NOT NULL,
+    direction NVARCHAR(3) CHECK (direction IN ('IN', 'OUT')),  -- NULL when the device doesn't say
+    device_id NVARCHAR(50),
+    source NVARCHAR(255),                 -- file name, or 'api'
+    imported_at DATETIME DEFAULT GETDATE(),
+    CONSTRAINT uq_attendance_punches UNIQUE (employee_id, punched_at)
+);
+CREATE INDEX idx_attendance_punches_time ON attendance_punches(punched_at);
+GO
+
+-- ============================================================
+-- TABLES: attendance rollups - per employee-month and per
+-- department-day counts, kept up to date by every attendance write
+-- ============================================================
+CREATE TABLE attendance_rollup_monthly (
+    employee_id NVARCHAR(50) NOT NULL,
+    month NVARCHAR(7) NOT NULL,           -- YYYY-MM
+    recorded_days INT NOT NULL DEFAULT 0,
+    present_days INT NOT NULL DEFAULT 0,
+    absent_days INT NOT NULL DEFAULT 0,
+    half_days INT NOT NULL DEFAULT 0,
+    leave_days INT NOT NULL DEFAULT 0,
+    ot_days INT NOT NULL DEFAULT 0,
+    late_days INT NOT NULL DEFAULT 0,
+    early_days INT NOT NULL DEFAULT 0,
+    total_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+    present_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+    hours_days INT NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT GETDATE(),
+    CONSTRAINT pk_attendance_rollup_monthly PRIMARY KEY (employee_id, month),
+    CONSTRAINT fk_attendance_rollup_employee FOREIGN KEY (employee_id) REFERENCES users(employee_id) ON DELETE CASCADE
+);
+CREATE INDEX idx_attendance_rollup_monthly_month ON attendance_rollup_monthly(month);
+
+CREATE TABLE attendance_rollup_daily (
+    department NVARCHAR(100) NOT NULL,    -- '' for employees without one
+    date DATE NOT NULL,
+    recorded_days INT NOT NULL DEFAULT 0,
+    present_days INT NOT NULL DEFAULT 0,
+    absent_days INT NOT NULL DEFAULT 0,
+    half_days INT NOT NULL DEFAULT 0,
+    leave_days INT NOT NULL DEFAULT 0,
+    ot_days INT NOT NULL DEFAULT 0,
+    late_days INT NOT NULL DEFAULT 0,
+    early_days INT NOT NULL DEFAULT 0,
+    total_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+    present_hours DECIMAL(8, 2) NOT NULL DEFAULT 0,
+    hours_days INT NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT GETDATE(),
+    CONSTRAINT pk_attendance_rollup_daily PRIMARY KEY (department, date)
+);
+CREATE INDEX idx_attendance_rollup_daily_date ON attendance_rollup_daily(date);
 GO
 
 -- ============================================================
@@ -133,6 +198,41 @@ CREATE TABLE leave_balance (
 );
 GO
 
+-- ============================================================
+-- TABLE: leave_ledger - Append-only leave request state changes
+-- ============================================================
+CREATE TABLE leave_ledger (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    leave_id INT,
+    employee_id NVARCHAR(50) NOT NULL,
+    leave_year INT NOT NULL,
+    leave_month INT NOT NULL,             -- month of the request's start_date
+    leave_type NVARCHAR(20) NOT NULL,
+    event NVARCHAR(20) NOT NULL,          -- SUBMITTED, APPROVED, REJECTED, CANCELLED, OPENING
+    pending_delta FLOAT NOT NULL DEFAULT 0,
+    approved_delta FLOAT NOT NULL DEFAULT 0,
+    actor NVARCHAR(100),
+    created_at DATETIME DEFAULT GETDATE()
+);
+CREATE INDEX idx_leave_ledger_leave ON leave_ledger(leave_id);
+CREATE INDEX idx_leave_ledger_emp_year ON leave_ledger(employee_id, leave_year);
+GO
+
+-- ============================================================
+-- TABLE: leave_totals - Running totals per employee/year/month/type
+-- ============================================================
+CREATE TABLE leave_totals (
+    employee_id NVARCHAR(50) NOT NULL,
+    leave_year INT NOT NULL,
+    leave_month INT NOT NULL,             -- 0 = whole year
+    leave_type NVARCHAR(20) NOT NULL,
+    pending_days FLOAT NOT NULL DEFAULT 0,
+    approved_days FLOAT NOT NULL DEFAULT 0,
+    updated_at DATETIME DEFAULT GETDATE(),
+    CONSTRAINT pk_leave_totals PRIMARY KEY (employee_id, leave_year, leave_month, leave_type)
+);
+GO
+
 -- ============================================================
 -- TABLE: documents - Employee document uploads
 -- ============================================================
@@ -262,6 +362,22 @@ CREATE TABLE system_settings (
 );
 GO
 
+-- Bumped on every settings change so each worker's settings cache reloads
+CREATE TABLE settings_version (
+    id INT PRIMARY KEY CHECK (id = 1),
+    version INT NOT NULL DEFAULT 0
+);
+INSERT INTO settings_version (id, version) VALUES (1, 0);
+GO
+
+-- Bumped on every holiday change so each worker's work calendar recounts
+CREATE TABLE calendar_version (
+    id INT PRIMARY KEY CHECK (id = 1),
+    version INT NOT NULL DEFAULT 0
+);
+INSERT INTO calendar_version (id, version) VALUES (1, 0);
+GO
+
 -- ============================================================
 -- TABLE: password_reset_tokens - For forgot password
 -- ============================================================
@@ -291,6 +407,91 @@ CREATE TABLE otp_tokens (
 );
 GO
 
+-- ============================================================
+-- TABLE: revoked_tokens - Logged-out JWTs / force-logged-out sessions
+-- ============================================================
+CREATE TABLE revoked_tokens (
+    token_key NVARCHAR(64) PRIMARY KEY,   -- jti or session_id
+    expires_at FLOAT NOT NULL,            -- epoch seconds; pruned after this
+    revoked_at FLOAT NOT NULL             -- epoch seconds; workers sync on this
+);
+CREATE INDEX idx_revoked_tokens_revoked_at ON revoked_tokens(revoked_at);
+CREATE INDEX idx_revoked_tokens_expires_at ON revoked_tokens(expires_at);
+GO
+
+-- ============================================================
+-- TABLE: email_outbox - Outgoing email queue (background SMTP sender)
+-- ============================================================
+CREATE TABLE email_outbox (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    to_email NVARCHAR(255) NOT NULL,
+    subject NVARCHAR(500) NOT NULL,
+    html_body NVARCHAR(MAX) NOT NULL,
+    purpose NVARCHAR(50) DEFAULT 'general',
+    status NVARCHAR(20) NOT NULL DEFAULT 'Pending' CHECK (status IN ('Pending', 'Sending', 'Sent', 'Failed', 'Skipped')),
+    attempts INT NOT NULL DEFAULT 0,
+    next_attempt_at FLOAT NOT NULL,       -- epoch seconds
+    claimed_at FLOAT,                     -- epoch seconds
+    last_error NVARCHAR(MAX),
+    created_at DATETIME DEFAULT GETDATE(),
+    sent_at DATETIME
+);
+CREATE INDEX idx_email_outbox_due ON email_outbox(status, next_attempt_at);
+GO
+
+-- ============================================================
+-- TABLE: holidays - Holiday calendar (optionally per category/shift)
+-- ============================================================
+CREATE TABLE holidays (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    date DATE NOT NULL,
+    description NVARCHAR(200) NOT NULL,
+    is_optional BIT DEFAULT 0,
+    employee_category NVARCHAR(10),       -- NULL = every category
+    shift NVARCHAR(10),                   -- NULL = every shift
+    created_at DATETIME DEFAULT GETDATE(),
+    CONSTRAINT uq_holidays_scope UNIQUE (date, employee_category, shift)
+);
+GO
+
+-- ============================================================
+-- TABLE: payroll_runs - Background payroll runs with checkpoints
+-- ============================================================
+CREATE TABLE payroll_runs (
+    id INT IDENTITY(1,1) PRIMARY KEY,
+    month NVARCHAR(7) NOT NULL,
+    employee_id NVARCHAR(50),
+    status NVARCHAR(20) NOT NULL DEFAULT 'Queued' CHECK (status IN ('Queued', 'Running', 'Completed', 'Failed', 'Cancelled')),
+    total_employees INT,
+    processed_employees INT NOT NULL DEFAULT 0,
+    last_employee_id NVARCHAR(50),        -- checkpoint
+    attempts INT NOT NULL DEFAULT 0,
+    claim_token NVARCHAR(64),
+    heartbeat_at FLOAT,                   -- epoch seconds
+    error NVARCHAR(MAX),
+    requested_by NVARCHAR(100),
+    created_at DATETIME DEFAULT GETDATE(),
+    started_at DATETIME,
+    finished_at DATETIME
+);
+CREATE INDEX idx_payroll_runs_status ON payroll_runs(status);
+CREATE INDEX idx_payroll_runs_month ON payroll_runs(month);
+GO
+
+-- ============================================================
+-- TABLE: payroll_stale - Payroll rows to recompute after changes
+-- ============================================================
+CREATE TABLE payroll_stale (
+    employee_id NVARCHAR(50) NOT NULL,
+    month NVARCHAR(7) NOT NULL,
+    reason NVARCHAR(100),
+    marked_at FLOAT NOT NULL,             -- epoch seconds
+    mark_id NVARCHAR(32) NOT NULL DEFAULT '', -- new on every marking; payroll clears only the mark it read
+    CONSTRAINT pk_payroll_stale PRIMARY KEY (employee_id, month)
+);
+CREATE INDEX idx_payroll_stale_month ON payroll_stale(month);
+GO
+
 -- ============================================================
 -- INSERT DEFAULT DATA
 -- ============================================================
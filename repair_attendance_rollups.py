@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+VES HRMS Attendance Rollup Repair
+Recomputes attendance_rollup_monthly and attendance_rollup_daily from the
+attendance table. The app keeps them current on every attendance write; run
+this after changing attendance outside the app (seed.py, manual SQL) or
+after moving employees between departments.
+Usage: python repair_attendance_rollups.py
+"""
+
+import sys
+import time
+
+import app as hrms
+
+
+def main():
+    conn = hrms.get_db_connection(request_scoped=False)
+    if not conn:
+        print("Database connection failed")
+        return 1
+    started = time.perf_counter()
+    try:
+        counts = hrms.rebuild_attendance_rollups(conn.cursor())
+        conn.commit()
+    finally:
+        conn.close()
+    print(f"Rebuilt attendance rollups in {time.perf_counter() - started:.2f}s")
+    for table, rows in counts.items():
+        print(f"  {table}: {rows} rows")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())